@@ -133,7 +133,9 @@ def record_to_tensorboard(loss):
 
 def _image_callback(img):
     img = bridge.imgmsg_to_cv2(img, "bgr8")
-    img = cv2.resize(img, tuple(size[::-1]))
+    if img.shape[:2] != tuple(size):
+        # LPD_video_node clips plates at this size already
+        img = cv2.resize(img, tuple(size[::-1]))
 
     nd_img = yolo_gluon.cv_img_2_ndarray(img, ctx[0])
 
@@ -238,7 +240,9 @@ class_weight = 1.0
 export_file = args.version + '/export/'
 
 if args.mode == 'video':
+    t = time.time()
     executor = yolo_gluon.init_executor(export_file, size, ctx[0])
+    print('executor ready in %.1f ms' % ((time.time() - t) * 1000))
     bridge = CvBridge()
     rospy.init_node("OCR_node", anonymous=True)
     pub = rospy.Publisher('YOLO/OCR', String, queue_size=0)
@@ -346,4 +350,5 @@ elif args.mode == 'export':
     yolo_gluon.export(net,
                       (1, 3, size[0], size[1]),
                       ctx[0],
-                      export_file)
+                      export_file,
+                      spec={'size': size, 'classes': cls_names})
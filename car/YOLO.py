@@ -10,6 +10,10 @@ from mxnet import gluon
 from mxboard import SummaryWriter
 
 # self define modules
+from yolo_modules import anchor_grid
+from yolo_modules import batch_queue
+from yolo_modules import model_bundle
+from yolo_modules import render_pool
 from yolo_modules import yolo_gluon
 from yolo_modules import yolo_cv
 from yolo_modules import global_variable
@@ -24,7 +28,14 @@ available_mode = ['train',
                   'kmean',
                   # 'pr',
                   'valid_Nima',
-                  'valid_Nima_plot'
+                  'valid_Nima_plot',
+                  'benchmark_loss_mask',
+                  'benchmark_nms',
+                  'build_dataset_cache',
+                  'benchmark_compositing',
+                  'benchmark_engine',
+                  'benchmark_preprocess',
+                  'benchmark_bundle'
                   ]
 
 
@@ -53,20 +64,35 @@ class YOLO(object):
 
         # -------------------- Load network sprc. -------------------- #
         spec_path = os.path.join(args.version, 'spec.yaml')
-        with open(spec_path) as f:
-            spec = yaml.load(f)
+        bundle = None
+        if args.mode in ['video', 'valid', 'valid_Nima'] and not args.trt:
+            # the spec exported with the weights, no yaml parsing
+            bundle = model_bundle.find_bundle(self.export_folder)
+
+        if bundle is not None and bundle.spec:
+            spec = bundle.spec
+        else:
+            with open(spec_path) as f:
+                spec = yaml.load(f)
+        self.spec = spec
         for key in spec:
             setattr(self, key, spec[key])
         self.all_anchors = nd.array(self.all_anchors)  # anchors in each pyramid layers
         self.num_class = len(self.classes)
 
-        self._init_step()
-        self._init_area()
+        self._init_anchor_grid(spec_path)
         self._init_syxhw()
 
         self.version = args.version
+        self.topk = args.topk  # detections per image, 1: best anchor only
         # -------------------- Load "Executor" !!! -------------------- #
-        if args.mode in ['video', 'valid', 'valid_Nima']:
+        if args.mode == 'video':
+            # the video node loads its own inference_backend
+            return
+
+        self.warm_shapes = args.warm_shapes  # for benchmark_engine
+
+        if args.mode in ['valid', 'valid_Nima']:
             self.trt = args.trt
             if args.trt:
                 from yolo_modules.tensorrt_module import get_engine_wrapper
@@ -86,6 +112,9 @@ class YOLO(object):
         self._init_net(spec, args.weight)
 
         if args.mode in ['train', 'render_and_train']:
+            self.prefetch = args.prefetch
+            self.render_threads = args.render_threads
+            self.render_workers = args.render_workers
             self._init_train()
 
     # -------------------- initialization Part -------------------- #
@@ -109,50 +138,31 @@ class YOLO(object):
 
         yolo_gluon.init_NN(self.net, weight, self.ctx)
 
-    def _init_step(self):
-        num_downsample = len(self.layers)  # number of downsample
-        num_prymaid_layers = len(self.all_anchors)  # number of pyrmaid layers
-        prymaid_start = num_downsample - num_prymaid_layers + 1
-        self.steps = [2**(prymaid_start+i) for i in range(num_prymaid_layers)]
+    def _init_anchor_grid(self, spec_path):
+        steps = anchor_grid.pyramid_steps(
+            len(self.layers),  # number of downsample
+            len(self.all_anchors))  # number of pyrmaid layers
 
-    def _init_area(self):
-        h = self.size[0]
-        w = self.size[1]
-        self.area = [int(h*w/step**2) for step in self.steps]
+        # shared by every YOLO built from the same spec and size
+        self.anchor_grid = anchor_grid.get_anchor_grid(
+            spec_path, self.size, self.all_anchors.asnumpy(), steps)
+        self.steps = self.anchor_grid.steps
+        self.area = self.anchor_grid.area
 
     def _init_syxhw(self):
-        size = self.size
-
-        n = len(self.all_anchors[0])  # anchor per sub_map
-        ctx = self.ctx[0]
-        self.s = nd.zeros((1, sum(self.area), n, 1), ctx=ctx)
-        self.y = nd.zeros((1, sum(self.area), n, 1), ctx=ctx)
-        self.x = nd.zeros((1, sum(self.area), n, 1), ctx=ctx)
-        self.h = nd.zeros((1, sum(self.area), n, 1), ctx=ctx)
-        self.w = nd.zeros((1, sum(self.area), n, 1), ctx=ctx)
-
-        a_start = 0
-        for i, anchors in enumerate(self.all_anchors):  # [12*16,6*8,3*4]
-            a = self.area[i]
-            step = self.steps[i]
-            s = nd.repeat(nd.array([step], ctx=ctx), repeats=a*n)
-
-            x_num = int(size[1]/step)
-            y = nd.arange(0, size[0], step=step, repeat=n*x_num, ctx=ctx)
-
-            x = nd.arange(0, size[1], step=step, repeat=n, ctx=ctx)
-            x = nd.tile(x, int(size[0]/step))
-
-            hw = nd.tile(self.all_anchors[i], (a, 1))
-            h, w = hw.split(num_outputs=2, axis=-1)
+        grid = self.anchor_grid.get(self.ctx[0])
+        self.s, self.y, self.x, self.h, self.w = [grid[k] for k in 'syxhw']
 
-            self.s[0, a_start:a_start+a] = s.reshape(a, n, 1)
-            self.y[0, a_start:a_start+a] = y.reshape(a, n, 1)
-            self.x[0, a_start:a_start+a] = x.reshape(a, n, 1)
-            self.h[0, a_start:a_start+a] = h.reshape(a, n, 1)
-            self.w[0, a_start:a_start+a] = w.reshape(a, n, 1)
-
-            a_start += a
+    def output_shapes(self, batch=1):
+        '''
+        Returns
+        ----------
+        shapes: list of tuple
+          (batch, area, num_anchors, channels) of every pyramid layer,
+          the same as the executor outputs
+        '''
+        num_anchors = self.all_anchors.shape[1]
+        return [(batch, area, num_anchors, self.slice_point[-1]) for area in self.area]
 
     def _init_train(self):
         self.exp = datetime.datetime.now().strftime("%m-%dx%H-%M")
@@ -181,6 +191,7 @@ class YOLO(object):
         if self.use_fp16:
             self.nd_all_anchors = self.fp32_2_fp16(self.nd_all_anchors)
             self.all_anchors_ltrb = self.fp32_2_fp16(self.all_anchors_ltrb)
+            self.all_anchors_prior = self.fp32_2_fp16(self.all_anchors_prior)
 
         self.HB_loss = gluon.loss.HuberLoss()
         # self.L1_loss = gluon.loss.L1Loss()
@@ -207,37 +218,10 @@ class YOLO(object):
             os.makedirs(self.backup_dir)
 
     def _get_default_ltrb(self):
-        hw = self.size
-        LTRB = []  # nd.zeros((sum(self.area),n,4))
-        a_start = 0
-
-        for i, anchors in enumerate(self.all_anchors):  # [12*16,6*8,3*4]
-            n = len(self.all_anchors[i])
-            a = self.area[i]
-            step = float(self.steps[i])
-            h, w = anchors.split(num_outputs=2, axis=-1)
-
-            x_num = int(hw[1]/step)
-
-            y = nd.arange(step/hw[0]/2., 1, step=step/hw[0], repeat=n*x_num)
-            # [[.16, .16, .16, .16],
-            #  [.50, .50, .50, .50],
-            #  [.83, .83, .83, .83]]
-            h = nd.tile(h.reshape(-1), a)  # same shape as y
-            top = (y - 0.5*h).reshape(a, n, 1)
-            bot = (y + 0.5*h).reshape(a, n, 1)
-
-            x = nd.arange(step/hw[1]/2., 1, step=step/hw[1], repeat=n)
-            # [1/8, 3/8, 5/8, 7/8]
-            w = nd.tile(w.reshape(-1), int(hw[1]/step))
-            left = nd.tile(x - 0.5*w, int(hw[0]/step)).reshape(a, n, 1)
-            right = nd.tile(x + 0.5*w, int(hw[0]/step)).reshape(a, n, 1)
-
-            LTRB.append(nd.concat(left, top, right, bot, dim=-1))
-            a_start += a
-
-        LTRB = nd.concat(*LTRB, dim=0)
-        self.all_anchors_ltrb = [LTRB.copyto(device) for device in self.ctx]
+        grids = [self.anchor_grid.get(device) for device in self.ctx]
+        self.all_anchors_ltrb = [grid['ltrb'] for grid in grids]
+        # (sum(area)*n, 5): [center_y, center_x, step, anchor_h, anchor_w]
+        self.all_anchors_prior = [grid['prior'] for grid in grids]
 
     # -------------------- Training Main -------------------- #
     def render_and_train(self):
@@ -282,25 +266,39 @@ class YOLO(object):
 
     def train(self):
         print(global_variable.cyan)
-        print('Render And Train (Double Threads)')
-
-        self.rendering_done = False
-        self.training_done = True
         self.shutdown_training = False
+        self._init_renderer()
+
+        threads = [threading.Thread(target=self._train_thread)]
+        if self.render_workers > 0:
+            print('Render And Train (%d Render Processes)' % self.render_workers)
+            self.batch_queue = self._init_render_pool()
+
+        else:
+            print('Render And Train (%d Render Threads, Prefetch %d)' % (
+                self.render_threads, self.prefetch))
+            self.batch_queue = batch_queue.BatchQueue(self.prefetch)
+            threads += [threading.Thread(target=self._render_thread)
+                        for _ in range(self.render_threads)]
 
-        threading.Thread(target=self._render_thread).start()
-        threading.Thread(target=self._train_thread).start()
+        for t in threads:
+            t.start()
 
         while not self.shutdown_training:
             try:
-                time.sleep(0.01)
+                time.sleep(0.1)
 
             except KeyboardInterrupt:
                 self.shutdown_training = True
 
+        self.batch_queue.close()
+        for t in threads:
+            t.join()
+
         print('Shutdown Training !!!')
+        print(self.batch_queue.stats())
 
-    def _render_thread(self):
+    def _init_renderer(self):
         h, w = self.size
         self.car_renderer = RenderCar(
             h, w, self.classes, self.ctx[0], pre_load=render_thread_pre_load)
@@ -308,44 +306,77 @@ class YOLO(object):
         self.bg_iter_valid = yolo_gluon.load_background(
             'val', self.batch_size, h, w)
 
+    def _render_shapes(self):
+        h, w = self.size
+        bs = self.batch_size
+        return [(bs, 3, h, w), (bs, 1, 6+self.num_class)]
+
+    def _render_batch(self, bg):
+        '''
+        Returns
+        ----------
+        batch: tuple of mxnet.ndarray
+          (imgs, labels), the arguments of _train_batch before split,
+          shapes are _render_shapes()
+        '''
+        return self.car_renderer.render(
+            bg, 'train', render_rate=0.5, pascal_rate=0.2)
+
+    def _init_render_state(self, ctx):
+        # every render thread/process has its own background iterator
+        h, w = self.size
         bg_iter_train = yolo_gluon.load_background(
             'train', self.batch_size, h, w)
 
-        self.labels = nd.array([0])
+        return {'bg_iter': bg_iter_train, 'ctx': ctx, 'count': 0}
 
-        while not self.shutdown_training:
-            if self.rendering_done:
-                #print('render done')
-                time.sleep(0.01)
-                continue
+    def _next_render_batch(self, state):
+        # change an other batch of background
+        if state['count'] % 10 == 0:
+            bg = yolo_gluon.ImageIter_next_batch(state['bg_iter'])
+            state['bg'] = bg.as_in_context(state['ctx'])
 
-            # ready to render new images
-            if (self.backward_counter % 10 == 0 or 'bg' not in locals()):
-                bg = yolo_gluon.ImageIter_next_batch(bg_iter_train)
-                bg = bg.as_in_context(self.ctx[0])
+        state['count'] += 1
+        return self._render_batch(state['bg'])
 
-            # change an other batch of background
-            self.imgs, self.labels = self.car_renderer.render(
-                bg, 'train', render_rate=0.5, pascal_rate=0.2)
+    def _render_thread(self):
+        state = self._init_render_state(self.ctx[0])
+        while not self.shutdown_training:
+            if not self.batch_queue.put(self._next_render_batch(state)):
+                break
 
-            self.rendering_done = True
+    def _init_render_pool(self):
+        return render_pool.RenderPool(
+            self._init_render_worker,
+            self._next_render_batch,
+            self._render_shapes(),
+            num_workers=self.render_workers,
+            num_slots=max(self.prefetch, self.render_workers),
+            ctx=self.ctx[0])
+
+    def _init_render_worker(self, worker_id):
+        # runs in a forked worker, the renderer (and pre-loaded
+        # dataset) comes from the parent, only move it to cpu.
+        # The parent already holds the net and the GPU context, the
+        # worker must not touch self.net, self.ctx or any GPU ndarray,
+        # CUDA does not work after fork
+        self.car_renderer.ctx = mxnet.cpu()
+        return self._init_render_state(mxnet.cpu())
 
     def _train_thread(self):
         while not self.shutdown_training:
-            if not self.rendering_done:
-                # training images are not ready
-                # print('rendering')
-                time.sleep(0.01)
-                continue
-
-            batch_xs = self.imgs.copy()
-            car_batch_ys = self.labels.copy()
+            try:
+                batch = self.batch_queue.get()
+            except RuntimeError:
+                # a render worker failed, stop train() instead of waiting
+                self.shutdown_training = True
+                raise
 
-            batch_xs = yolo_gluon.split_render_data(batch_xs, self.ctx)
-            car_batch_ys = yolo_gluon.split_render_data(car_batch_ys, self.ctx)
+            if batch is None:
+                break
 
-            self.rendering_done = False
-            self._train_batch(batch_xs, car_batch_ys)
+            batch = [yolo_gluon.split_render_data(b, self.ctx) for b in batch]
+            self._train_batch(*batch)
 
     def _train_batch(self, bxs, car_bys, car_rotate=False):
         '''
@@ -449,7 +480,72 @@ class YOLO(object):
 
     def _loss_mask(self, label_batch, gpu_index):
         """Generate training targets given predictions and label_batch.
-        label_batch: bs*object*[class, cent_y, cent_x, box_h, box_w, rotate]
+        label_batch: bs*object*[class, cent_y, cent_x, box_h, box_w, rotate, all labels prob]
+
+        All objects of the batch are matched against all_anchors_ltrb at once,
+        and targets are scattered with a one-hot batch_dot, so no value is
+        copied back to host. If two objects of an image hit the same anchor,
+        the later one wins, the same as _loss_mask_per_object.
+        """
+        bs, num_obj = label_batch.shape[0], label_batch.shape[1]
+        a = sum(self.area)
+        n = len(self.all_anchors[0])
+        ctx = self.ctx[gpu_index]
+
+        prior = self.all_anchors_prior[gpu_index]  # (a*n, 5)
+        anc_l, anc_t, anc_r, anc_b = self.all_anchors_ltrb[gpu_index].reshape(
+            (1, 1, a*n, 4)).split(num_outputs=4, axis=-1, squeeze_axis=True)
+        label_batch = label_batch.astype(prior.dtype, copy=False)
+
+        # -------------------- IOU of all labels and anchors -------------------- #
+        L_y, L_x, L_h, L_w = label_batch.slice_axis(
+            axis=-1, begin=1, end=5).split(num_outputs=4, axis=-1)  # (bs, obj, 1)
+
+        iw = nd.minimum(L_x + L_w/2, anc_r) - nd.maximum(L_x - L_w/2, anc_l)
+        ih = nd.minimum(L_y + L_h/2, anc_b) - nd.maximum(L_y - L_h/2, anc_t)
+        inters = nd.maximum(iw, 0.) * nd.maximum(ih, 0.)
+        IOUs = inters / ((anc_r-anc_l)*(anc_b-anc_t) + L_h*L_w - inters)
+        best_match = IOUs.argmax(axis=-1)  # (bs, obj), best_pixel * n + best_anchor
+
+        # -------------------- drop invalid and overwritten labels -------------------- #
+        valid = label_batch[:, :, 0] >= 0  # (bs, obj)
+        same = nd.broadcast_equal(best_match.expand_dims(2), best_match.expand_dims(1))
+        later = nd.array(np.triu(np.ones((1, num_obj, num_obj)), 1), ctx=ctx, dtype=prior.dtype)
+        overwritten = nd.sum(same * later * valid.expand_dims(1), axis=-1) > 0
+        keep = (valid * (1 - overwritten)).expand_dims(2)  # (bs, obj, 1)
+
+        # -------------------- targets of all objects -------------------- #
+        best_prior = nd.take(prior, best_match)  # (bs, obj, 5)
+        cy, cx, step, anc_h, anc_w = best_prior.split(num_outputs=5, axis=-1)
+
+        sigmoid_ty = nd.clip((L_y - cy) * self.size[0] / step + 0.5, 0.0001, 0.9999)
+        sigmoid_tx = nd.clip((L_x - cx) * self.size[1] / step + 0.5, 0.0001, 0.9999)
+        ty = yolo_gluon.nd_inv_sigmoid(sigmoid_ty)
+        tx = yolo_gluon.nd_inv_sigmoid(sigmoid_tx)
+        # invalid labels are -1, keep log() finite, they are masked by keep
+        th = nd.log(nd.maximum(L_h, 0.0001) / anc_h)
+        tw = nd.log(nd.maximum(L_w, 0.0001) / anc_w)
+
+        target = nd.concat(
+            keep, ty, tx, th, tw, label_batch.slice_axis(axis=-1, begin=5, end=None), dim=-1)
+
+        # -------------------- scatter to anchors -------------------- #
+        one_hot = nd.one_hot(best_match, a*n, dtype=prior.dtype) * keep  # (bs, obj, a*n)
+        target = nd.batch_dot(one_hot, target, transpose_a=True)  # (bs, a*n, 6+cls)
+        target = target.reshape((bs, a, n, -1))
+
+        C_score = target.slice_axis(axis=-1, begin=0, end=1)
+        C_box_yx = target.slice_axis(axis=-1, begin=1, end=3)
+        C_box_hw = target.slice_axis(axis=-1, begin=3, end=5)
+        C_rotate = target.slice_axis(axis=-1, begin=5, end=6)
+        C_class = target.slice_axis(axis=-1, begin=6, end=None)
+        C_mask = C_score.copy()
+
+        return [C_score, C_box_yx, C_box_hw, C_rotate, C_class], C_mask
+
+    def _loss_mask_per_object(self, label_batch, gpu_index):
+        """Reference implementation of _loss_mask, one _find_best per object.
+        Only used by benchmark_loss_mask.
         """
         bs = label_batch.shape[0]
         a = sum(self.area)
@@ -533,6 +629,14 @@ class YOLO(object):
 
             self.bg_iter_valid.reset()
 
+    def _record_batch_queue(self):
+        stats = self.batch_queue.stats()
+        for k in ['depth', 'put_stall', 'get_stall']:
+            self.sw.add_scalar(
+                'Batch_Queue',
+                (self.exp + ' ' + k, stats[k]),
+                self.backward_counter)
+
     def _record_to_tensorboard_and_save(self, loss):
         self.backward_counter += 1  # do not save at first step
         if self.backward_counter % 10 == 0:
@@ -540,6 +644,9 @@ class YOLO(object):
                 loss, self.loss_name, self.sw,
                 step=self.backward_counter, exp=self.exp)
 
+            if hasattr(self, 'batch_queue'):
+                self._record_batch_queue()
+
         if self.backward_counter % self.valid_step == 0:
             self._valid_iou()
 
@@ -565,36 +672,101 @@ class YOLO(object):
         b = by + bh2
         return nd.concat(l, t, r, b, dim=-1)
 
-    def predict(self, batch_out):
+    def _decode(self, batch_out):
+        '''
+        Decode the best anchor of every image in the batch at once.
+
+        Parameter:
+        ----------
+        batch_out: list of mxnet.ndarray
+          [score, yx, hw, rotate, class] from merge_and_slice,
+          each with shape (bs, sum(area), n, c)
+
+        Returns
+        ----------
+        batch_pred: np.array
+          (bs, 6+num_class) float32,
+          [score, y, x, h, w, rotate, class...] of the best anchor
+        '''
+        score = batch_out[0]
+        bs = score.shape[0]
+        slots = score.size // bs
+        grid = self.anchor_grid.get(score.context)
+
+        # argmax of logits == argmax of sigmoid, decode only the best slot
+        best = score.reshape((bs, slots)).argmax(axis=-1)  # (bs,)
+        rows = best + nd.arange(bs, ctx=score.context) * slots
+        score, yx, hw, rotate, cls = [
+            nd.take(out.reshape((bs*slots, -1)), rows) for out in batch_out]
+        s, y, x, h, w = [
+            nd.take(grid[k].reshape((-1, 1)), best) for k in 'syxhw']
+
+        ty, tx = yx.split(num_outputs=2, axis=-1)
+        th, tw = hw.split(num_outputs=2, axis=-1)
+        by = (nd.sigmoid(ty)*s + y) / self.size[0]
+        bx = (nd.sigmoid(tx)*s + x) / self.size[1]
+        bh = nd.exp(th) * h
+        bw = nd.exp(tw) * w
+
+        batch_pred = nd.concat(
+            nd.sigmoid(score), by, bx, bh, bw, rotate, cls, dim=-1)
+
+        return np.ascontiguousarray(batch_pred.asnumpy(), dtype=np.float32)
+
+    def _sliced_output(self, batch_out):
         if self.use_fp16:
             batch_out = self.fp16_2_fp32(batch_out)
 
-        batch_out = self.merge_and_slice(batch_out, self.slice_point)
+        return self.merge_and_slice(batch_out, self.slice_point)
+
+    def predict(self, batch_out):
+        return self._decode(self._sliced_output(batch_out))
+
+    def predict_multi(self, batch_out, topk=None, threshold=0.5, overlap=0.45):
+        '''
+        Up to topk detections per image, suppressed by box_nms
+        over all sum(area)*n anchors of the whole batch.
 
-        batch_score = nd.sigmoid(batch_out[0])
-        batch_box = nd.concat(batch_out[1], batch_out[2], dim=-1)
-        batch_box = self._yxhw_to_ltrb(batch_box)
-        batch_out = nd.concat(batch_score, batch_box,
-                              batch_out[3], batch_out[4], dim=-1)
+        Parameter:
+        ----------
+        batch_out: list of mxnet.ndarray
+          network output, the same as predict
+        topk: int
+          max detections per image, default self.topk
+        threshold: float
+          min score of a detection
+        overlap: float
+          IOU threshold of NMS
 
-        batch_out = nd.split(batch_out, axis=0, num_outputs=len(batch_out))
+        Returns
+        ----------
+        batch_pred: np.array
+          (bs, topk, 6+num_class) float32,
+          [score, y, x, h, w, rotate, class...] sorted by score,
+          rows without detection are -1
+        '''
+        topk = self.topk if topk is None else topk
+        score, yx, hw, rotate, cls = self._sliced_output(batch_out)
+        bs = score.shape[0]
 
-        batch_pred = []
-        for i, out in enumerate(batch_out):
-            best_anchor_index = batch_score[i].reshape(-1).argmax(axis=0)
-            out = out.reshape((-1, 6+self.num_class))
+        box = self._yxhw_to_ltrb(nd.concat(yx, hw, dim=-1))
+        dets = nd.concat(nd.sigmoid(score), box, rotate, cls, dim=-1)
+        dets = nd.contrib.box_nms(
+            dets.reshape((bs, -1, 6+self.num_class)),
+            overlap_thresh=overlap, valid_thresh=threshold,
+            coord_start=1, score_index=0, id_index=-1,
+            force_suppress=True)
 
-            pred = out[best_anchor_index][0]  # best out
-            y = (pred[2] + pred[4]) / 2
-            x = (pred[1] + pred[3]) / 2
-            h = (pred[4] - pred[2])
-            w = (pred[3] - pred[1])
-            pred[1:5] = nd.concat(y, x, h, w, dim=-1)
-            batch_pred.append(nd.expand_dims(pred, axis=0))
+        topk = min(topk, dets.shape[1])
+        dets = dets.slice_axis(axis=1, begin=0, end=topk).asnumpy()
 
-        batch_pred = nd.concat(*batch_pred, dim=0)
+        # ltrb to yxhw, only topk rows are copied back
+        l, t, r, b = [dets[:, :, i] for i in range(1, 5)]
+        yxhw = np.stack([(t+b)/2, (l+r)/2, b-t, r-l], axis=-1)
+        valid = dets[:, :, :1] >= 0
+        dets[:, :, 1:5] = np.where(valid, yxhw, -1)
 
-        return batch_pred.asnumpy()
+        return np.ascontiguousarray(dets, dtype=np.float32)
 
     def kmean(self):
         import yolo_modules.iou_kmeans as kmeans
@@ -637,6 +809,146 @@ class YOLO(object):
         while 1:
             time.sleep(0.1)
 
+    def benchmark_loss_mask(self, num_obj=2, cycles=50):
+        '''
+        compare _loss_mask with _loss_mask_per_object on random label batches,
+        batch size is the per device batch size in spec.yaml
+        '''
+        print(global_variable.cyan)
+        print('Benchmark Target Assignment')
+
+        self.nd_all_anchors = [self.all_anchors.copyto(dev) for dev in self.ctx]
+        self._get_default_ltrb()
+
+        bs = self.batch_size
+        label_batch = nd.array(
+            self._random_label_batch(bs, num_obj), ctx=self.ctx[0])
+
+        results = []
+        for name in ['_loss_mask_per_object', '_loss_mask']:
+            loss_mask = getattr(self, name)
+            y, mask = loss_mask(label_batch, 0)  # warm up
+            mask.wait_to_read()
+
+            t = time.time()
+            for _ in range(cycles):
+                y, mask = loss_mask(label_batch, 0)
+                mask.wait_to_read()
+
+            cost = (time.time() - t) / cycles
+            results.append(y + [mask])
+            print('%s: %.2f ms/batch (bs=%d, obj=%d)' % (
+                name, cost * 1000, bs, num_obj))
+
+        for i, name in enumerate(['score', 'box_yx', 'box_hw', 'rotate', 'class', 'mask']):
+            err = nd.max(nd.abs(results[0][i] - results[1][i])).asscalar()
+            print('max abs diff of %s: %f' % (name, err))
+
+        print(global_variable.reset_color)
+
+    def benchmark_nms(self, bs=1, cycles=50):
+        '''
+        compare predict with predict_multi on random outputs of full grids
+        '''
+        print(global_variable.cyan)
+        print('Benchmark Multi Detection (size=%s, topk=%d)' % (self.size, self.topk))
+
+        n = len(self.all_anchors[0])
+        dtype = 'float16' if self.use_fp16 else 'float32'
+        batch_out = [
+            nd.random.normal(shape=(bs, a, n, self.slice_point[-1]),
+                             ctx=self.ctx[0]).astype(dtype)
+            for a in self.area]
+
+        for name in ['predict', 'predict_multi']:
+            predict = getattr(self, name)
+            outs = predict(list(batch_out))  # warm up
+
+            t = time.time()
+            for _ in range(cycles):
+                outs = predict(list(batch_out))
+
+            cost = (time.time() - t) / cycles
+            print('%s: %.2f ms/batch (bs=%d, anchors=%d)' % (
+                name, cost * 1000, bs, sum(self.area) * n))
+
+        print('detections per image: %.1f' % (
+            np.sum(outs[:, :, 0] >= 0) / float(bs)))
+        print(global_variable.reset_color)
+
+    def _random_label_batch(self, bs, num_obj, invalid_rate=0.3):
+        # bs*object*[class, cent_y, cent_x, box_h, box_w, rotate, all labels prob]
+        label_batch = np.ones((bs, num_obj, 6+self.num_class)) * (-1)
+        for b in range(bs):
+            for i in range(num_obj):
+                if np.random.rand() < invalid_rate:
+                    continue
+
+                dist = np.random.rand(self.num_class)
+                label_batch[b, i, 0] = np.argmax(dist)
+                label_batch[b, i, 1:3] = np.random.uniform(0.1, 0.9, size=2)
+                label_batch[b, i, 3:5] = np.random.uniform(0.05, 0.8, size=2)
+                label_batch[b, i, 5] = np.random.uniform(-math.pi/6, math.pi/6)
+                label_batch[b, i, 6:] = dist / dist.sum()
+
+        return label_batch
+
+    def benchmark_compositing(self):
+        h, w = self.size
+        print(global_variable.cyan)
+        print('Benchmark Compositing')
+        yolo_gluon.benchmark_compositing(bs=self.batch_size, h=h, w=w)
+
+    def benchmark_engine(self):
+        '''
+        dynamic batching throughput and latency on CPU, needs export first
+        '''
+        from yolo_modules.inference_engine import benchmark_engine
+        print(global_variable.cyan)
+        print('Benchmark Inference Engine (CPU)')
+        benchmark_engine(self.export_folder, self.size, ctx=mxnet.cpu(),
+                         warm=self.warm_shapes)
+
+    def benchmark_preprocess(self):
+        '''
+        fused frame preprocessing vs the old resize chain, 640x480 and 1280x720
+        '''
+        from yolo_modules.frame_preprocess import benchmark_preprocess
+        print(global_variable.cyan)
+        print('Benchmark Frame Preprocessing')
+        benchmark_preprocess(self.size)
+
+    def benchmark_bundle(self):
+        '''
+        startup of load_checkpoint + spec.yaml vs the model bundle on CPU,
+        needs export first, builds the bundle if there is none
+        '''
+        print(global_variable.cyan)
+        print('Benchmark Model Bundle Cold Start (CPU)')
+        model_bundle.benchmark_cold_start(
+            self.export_folder, self.size,
+            spec_path=os.path.join(self.version, 'spec.yaml'),
+            fp16=self.use_fp16)
+
+    def build_dataset_cache(self):
+        '''
+        one-time build of the training data caches on the data disk,
+        RenderCar uses them when pre_load is True
+        '''
+        print(global_variable.cyan)
+        print('Build Dataset Cache')
+
+        h, w = self.size
+        car_renderer = RenderCar(
+            h, w, self.classes, self.ctx[0], pre_load=False)
+
+        car_renderer.build_png_atlas()
+        print('png atlas: %s' % car_renderer.png_atlas_path)
+
+        car_renderer.build_pascal_index()
+        print('pascal index: %s' % car_renderer.pascal_index_path)
+        print(global_variable.reset_color)
+
     def valid(self):
         print(global_variable.cyan)
         print('Valid')
@@ -660,16 +972,21 @@ class YOLO(object):
             net_out = self.net.forward(is_train=False, data=imgs)
             # net_out = [x1, x2, x3], which shapes are
             # (1L, 640L, 3L, 30L), (1L, 160L, 3L, 30L), (1L, 40L, 3L, 30L)
-            outs = self.predict(net_out)
+            if self.topk > 1:
+                outs = self.predict_multi(net_out)[0]
+            else:
+                outs = self.predict(net_out)
 
             # -------------------- show -------------------- #
             img = yolo_gluon.batch_ndimg_2_cv2img(imgs)[0]
 
             img = yolo_cv.cv2_add_bbox(img, labels[0, 0].asnumpy(), 4, use_r=0)
-            img = yolo_cv.cv2_add_bbox(img, outs[0], 5, use_r=0)
+            for out in outs[outs[:, 0] >= 0]:
+                img = yolo_cv.cv2_add_bbox(img, out, 5, use_r=0)
             yolo_cv.matplotlib_show_img(ax1, img)
 
-            radar_prob.plot3d(outs[0, 0], outs[0, -self.num_class:])
+            if outs[0, 0] >= 0:  # -1 padding if nothing is found
+                radar_prob.plot3d(outs[0, 0], outs[0, -self.num_class:])
             raw_input('next')
 
     def export(self):
@@ -679,7 +996,8 @@ class YOLO(object):
                           self.ctx[0],
                           self.export_folder,
                           onnx=self.export_onnx,
-                          fp16=self.use_fp16)
+                          fp16=self.use_fp16,
+                          spec=self.spec)
 
     def valid_Nima(self):
         '''
@@ -892,39 +1210,12 @@ class YOLO_dense(YOLO):
 
         yolo_gluon.init_NN(self.net, weight, self.ctx)
 
-    def predict(self, batch_out):
+    def _sliced_output(self, batch_out):
         # valid: [(1L, 160L, 5L, 30L)]
         batch_out = batch_out[0] if type(batch_out) == list else batch_out
 
         batch_out = self.fp16_2_fp32(batch_out) if self.use_fp16 else batch_out
-        batch_out = self.merge_and_slice(batch_out, self.slice_point)
-
-        batch_score = nd.sigmoid(batch_out[0])
-        batch_box = nd.concat(batch_out[1], batch_out[2], dim=-1)
-        batch_box = self._yxhw_to_ltrb(batch_box)
-        batch_out = nd.concat(batch_score,
-                              batch_box,
-                              batch_out[3],
-                              batch_out[4], dim=-1)
-
-        batch_out = nd.split(batch_out, axis=0, num_outputs=len(batch_out))
-
-        batch_pred = []
-        for i, out in enumerate(batch_out):
-            best_anchor_index = batch_score[i].reshape(-1).argmax(axis=0)
-            out = out.reshape((-1, 6+self.num_class))
-
-            pred = out[best_anchor_index][0]  # best out
-            y = (pred[2] + pred[4]) / 2
-            x = (pred[1] + pred[3]) / 2
-            h = (pred[4] - pred[2])
-            w = (pred[3] - pred[1])
-            pred[1:5] = nd.concat(y, x, h, w, dim=-1)
-            batch_pred.append(nd.expand_dims(pred, axis=0))
-
-        batch_pred = nd.concat(*batch_pred, dim=0)
-
-        return batch_pred.asnumpy()
+        return self.merge_and_slice(batch_out, self.slice_point)
 
     def merge_and_slice(self, output, points):
         i = 0
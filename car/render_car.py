@@ -1,8 +1,11 @@
+import hashlib
 import math
 import numpy as np
 import os
 import scipy.io as sio
+import shutil
 import sys
+import tempfile
 from pprint import pprint
 
 import mxnet
@@ -13,6 +16,7 @@ from yolo_modules import yolo_cv
 from yolo_modules import yolo_gluon
 from yolo_modules import licence_plate_render
 from yolo_modules import global_variable
+from yolo_modules import sprite_atlas
 
 import matplotlib.pyplot as plt
 import PIL
@@ -30,12 +34,15 @@ class RenderCar():
         self.h = img_h
         self.w = img_w
         self.num_cls = len(classes)
+        self.classes = np.array(classes)
         self.ele_label = np.array(classes)[:, 1]
         self.azi_label = np.array(classes)[:, 0]
         self.ctx = ctx
         self.pre_load = pre_load
 
         self.disk = global_variable.training_data_path
+        self.label_dist_table = LabelDistTable(
+            classes, cache_dir=_join(self.disk, 'blender_car'))
         # -------------------- init image enhencement -------------------- #
         self.pil_image_enhance = yolo_cv.PILImageEnhance(
             M=0, N=0, R=30.0, G=0.3, noise_var=0)
@@ -75,9 +82,10 @@ class RenderCar():
         bs = len(bg)
         ctx = self.ctx
 
-        mask = nd.zeros((bs, 3, self.h, self.w), ctx=ctx)
-        img_batch = nd.zeros((bs, 3, self.h, self.w), ctx=ctx)
-        label_batch = nd.ones((bs, 1, 6+self.num_cls), ctx=ctx) * (-1)
+        compositor = yolo_gluon.get_roi_compositor(
+            self, bs, self.h, self.w, augs=self.augs)
+        compositor.reset(bg)
+        label_batch = np.ones((bs, 1, 6+self.num_cls), dtype=np.float32) * (-1)
 
         for i in range(bs):
             if np.random.rand() > render_rate:
@@ -111,30 +119,21 @@ class RenderCar():
             box_w = float(r_box_r - r_box_l)
 
             # -------------------- -------------------- #
-            tmp = PIL.Image.new('RGBA', (self.w, self.h))
-            tmp.paste(pil_img, (paste_x, paste_y))
+            compositor.paste(i, pil_img, paste_x, paste_y)
 
-            fg = yolo_gluon.pil_rgb_2_rgb_ndarray(tmp, augs=self.augs)
-            img_batch[i] = fg.as_in_context(ctx)
-
-            m = yolo_gluon.pil_mask_2_rgb_ndarray(tmp.split()[-1])
-            mask[i] = m.as_in_context(ctx)
-
-            label = nd.array([[
+            label_batch[i, 0, :6] = [
                 img_cls,
                 box_y/self.h,
                 box_x/self.w,
                 box_h/self.h,
                 box_w/self.w,
-                r]])
-
-            label = nd.concat(label, label_distribution, dim=-1)
-            label_batch[i] = label
+                r]
+            label_batch[i, 0, 6:] = label_distribution
 
         ####################################################################
-        img_batch = ((bg / 255.) * (1 - mask) + img_batch * mask)
-        img_batch = nd.clip(img_batch, 0, 1)
+        label_batch = nd.array(label_batch, ctx=ctx)
         # 0~1 (batch_size, channels, h, w)
+        img_batch = compositor.get(ctx)
         return img_batch, label_batch
 
     def load_mtv_images(self):
@@ -176,7 +175,7 @@ class RenderCar():
                 box = box_file[j]
                 frame_time = times[i][j]
                 azi = ang_start + frame_time * d_ang
-                img_cls, label_distribution = self.get_label_dist(0, azi)
+                img_cls, label_distribution = self.label_dist_table(0, azi)
                 pil_img = PIL.Image.open(img_path).convert('RGBA')
                 self.mtv_dataset.append([
                     pil_img,
@@ -194,60 +193,110 @@ class RenderCar():
             'train': _join(path, 'train'),
             'valid': _join(path, 'valid')}
         self.rawcar_dataset = {'train': [], 'valid': []}
+        self.rawcar_atlas = {'train': None, 'valid': None}
+        self.png_atlas_path = {
+            'train': _join(path, 'atlas_train'),
+            'valid': _join(path, 'atlas_valid')}
         print(global_variable.yellow)
         print('use png_dataset: %s' % path)
         print('\033[1;34mLoading png images')
 
         for mode in self.rawcar_dataset:
-            for cadi, cad in enumerate(os.listdir(cad_path[mode])):
-                for img in os.listdir(_join(cad_path[mode], cad)):
+            for cad in sorted(os.listdir(cad_path[mode])):
+                for img in sorted(os.listdir(_join(cad_path[mode], cad))):
                     img_path = _join(cad_path[mode], cad, img)
-                    if False:  # self.pre_load:
-                        azi = float(img.split('azi')[1].split('_')[0])
-                        ele = float(img.split('ele')[1].split('.')[0])
+                    self.rawcar_dataset[mode].append(img_path)
 
-                        azi = azi * math.pi / 18000.
-                        ele = ele * math.pi / 18000.
-
-                        img_cls, label_dist = self.get_label_dist(ele, azi)
-                        with PIL.Image.open(img_path).convert('RGBA') as f:
-                            pil_img = np.array(f, dtype="uint8")
-                        self.rawcar_dataset[mode].append(
-                            [pil_img, img_cls, label_dist])
-
-                    else:
-                        self.rawcar_dataset[mode].append(img_path)
+            if self.pre_load:
+                self.rawcar_atlas[mode] = self._load_png_atlas(mode)
 
         print('Loading %d png images is done' % len(
             self.rawcar_dataset['train']))
+        if self.rawcar_atlas['train'] is not None:
+            print('Use png atlas: %s' % self.png_atlas_path['train'])
         print(global_variable.reset_color)
 
+    def _load_png_atlas(self, mode):
+        atlas = sprite_atlas.load_sprite_atlas(
+            self.png_atlas_path[mode], paths=self.rawcar_dataset[mode])
+
+        # label_dist depends on classes in spec.yaml
+        if atlas is not None and \
+           not np.array_equal(atlas.meta['classes'], self.classes):
+            print('png atlas %s uses other classes' % self.png_atlas_path[mode])
+            return None
+
+        return atlas
+
+    def build_png_atlas(self):
+        '''
+        Crop all png cars to their alpha bbox and pack them with
+        [azi, ele, class, label distribution] into a memory-mapped atlas,
+        _render_png uses it when pre_load is True.
+        '''
+        for mode in self.rawcar_dataset:
+            meta = {'azi': [], 'ele': [], 'classes': self.classes}
+
+            for img_path in self.rawcar_dataset[mode]:
+                ele, azi = _png_ele_azi(img_path)
+                meta['ele'].append(ele)
+                meta['azi'].append(azi)
+
+            img_cls, label_dist = self.label_dist_table.lookup(
+                meta['ele'], meta['azi'])
+            meta['cls'] = img_cls
+            meta['label_dist'] = label_dist
+
+            sprite_atlas.build_sprite_atlas(
+                self.rawcar_dataset[mode], self.png_atlas_path[mode], meta)
+            self.rawcar_atlas[mode] = self._load_png_atlas(mode)
+
     def load_pascal_images(self):
         # -------------------- set pascal path-------------------- #
         path = _join(self.disk, 'HP_31/pascal3d_image_and_label')
-        label_path = _join(path, 'car_imagenet_label')
-        pascal_path = {
+        self.pascal_label_path = _join(path, 'car_imagenet_label')
+        self.pascal_index_path = _join(path, 'pascal_index')
+        self.pascal_path = {
             'train': _join(path, 'car_imagenet_train'),
             'valid': _join(path, 'car_imagenet_valid')}
 
         # -------------------- load pascal label -------------------- #
-        self.pascal3d_anno = {}
-        for f in os.listdir(label_path):
-            self.pascal3d_anno[f] = sio.loadmat(_join(label_path, f))
+        self.pascal_index = self._load_pascal_index()
+        if self.pascal_index is None and os.path.exists(self.pascal_index_path):
+            # images or labels changed since the index was built
+            self.build_pascal_index()
+
+        if self.pascal_index is None:
+            self.pascal3d_anno = {}
+            for f in os.listdir(self.pascal_label_path):
+                self.pascal3d_anno[f] = sio.loadmat(_join(self.pascal_label_path, f))
 
         print(global_variable.yellow)
         print('Loading pascal images')
         # -------------------- load pascal image -------------------- #
         self.pascal_dataset = {'train': [], 'valid': []}
         for mode in self.pascal_dataset:
-            for img in os.listdir(pascal_path[mode]):
-                img_path = _join(pascal_path[mode], img)
+            if self.pascal_index is not None:
+                index = self.pascal_index[mode]
+                for n, img_path in enumerate(index['path']):
+                    if self.pre_load:
+                        self.pascal_dataset[mode].append(
+                            [PIL.Image.open(img_path).convert('RGBA'),
+                             index['box'][n],
+                             index['cls'][n],
+                             index['label_dist'][n]])
+                    else:
+                        self.pascal_dataset[mode].append(img_path)
+                continue
+
+            for img in os.listdir(self.pascal_path[mode]):
+                img_path = _join(self.pascal_path[mode], img)
                 if self.pre_load:
                     ele, azi, box, skip = self.get_pascal3d_azi_ele(img_path)
                     if skip:
                         continue
 
-                    img_cls, label_distribution = self.get_label_dist(ele, azi)
+                    img_cls, label_distribution = self.label_dist_table(ele, azi)
                     self.pascal_dataset[mode].append(
                         [PIL.Image.open(img_path).convert('RGBA'),
                          box,
@@ -257,8 +306,90 @@ class RenderCar():
                     self.pascal_dataset[mode].append(img_path)
         print('Loading %d pascal images is done' % len(
             self.pascal_dataset['train']))
+        if self.pascal_index is not None:
+            print('Use pascal index: %s' % self.pascal_index_path)
         print(global_variable.reset_color)
 
+    def build_pascal_index(self):
+        '''
+        Write box, azi, ele and image name of single-car pascal3d images
+        as .npy columns in self.pascal_index_path, so startup does not
+        load every .mat and _render_pascal does not retry. The image count
+        and folder mtimes it is built from are saved with the columns,
+        load_pascal_images builds it again when they change.
+        '''
+        tmp_dir = self.pascal_index_path + '.tmp'
+        if not os.path.exists(tmp_dir):
+            os.makedirs(tmp_dir)
+
+        for mode in self.pascal_path:
+            columns = {'box': [], 'azi': [], 'ele': [], 'name': []}
+            for img in sorted(os.listdir(self.pascal_path[mode])):
+                f = img.split('.')[0] + '.mat'
+                mat = sio.loadmat(_join(self.pascal_label_path, f))
+                ele, azi, box, skip = _pascal3d_record(mat)
+                if skip:
+                    continue
+
+                columns['box'].append(box)
+                columns['azi'].append(azi)
+                columns['ele'].append(ele)
+                columns['name'].append(img)
+
+            np.save(_join(tmp_dir, mode + '_box.npy'), np.array(columns['box'], dtype=np.int32))
+            np.save(_join(tmp_dir, mode + '_azi.npy'), np.array(columns['azi'], dtype=np.float32))
+            np.save(_join(tmp_dir, mode + '_ele.npy'), np.array(columns['ele'], dtype=np.float32))
+            np.save(_join(tmp_dir, mode + '_name.npy'), np.array(columns['name'], dtype=np.string_))
+            np.save(_join(tmp_dir, mode + '_source.npy'), self._pascal_source(mode))
+            print('%s: %d single-car images' % (mode, len(columns['name'])))
+
+        if os.path.exists(self.pascal_index_path):
+            shutil.rmtree(self.pascal_index_path)
+        os.rename(tmp_dir, self.pascal_index_path)
+        self.pascal_index = self._load_pascal_index()
+
+    def _pascal_source(self, mode):
+        # [number of images, mtime of the image and the label folder]
+        return np.array([
+            len(os.listdir(self.pascal_path[mode])),
+            os.path.getmtime(self.pascal_path[mode]),
+            os.path.getmtime(self.pascal_label_path)], dtype=np.float64)
+
+    def _load_pascal_index(self):
+        '''
+        Returns
+        ----------
+        pascal_index: dict
+          None if there is no index, or it is not built from the images
+          and labels on disk now
+        '''
+        if not os.path.exists(self.pascal_index_path):
+            return None
+
+        pascal_index = {}
+        for mode in self.pascal_path:
+            source = _join(self.pascal_index_path, mode + '_source.npy')
+            if not os.path.exists(source) or \
+               not np.array_equal(np.load(source), self._pascal_source(mode)):
+                print(global_variable.yellow)
+                print('Pascal index %s is stale' % self.pascal_index_path)
+                print(global_variable.reset_color)
+                return None
+
+            index = {}
+            for k in ['box', 'azi', 'ele', 'name']:
+                index[k] = np.load(
+                    _join(self.pascal_index_path, '%s_%s.npy' % (mode, k)),
+                    mmap_mode='r')
+
+            index['path'] = [_join(self.pascal_path[mode], name.decode('utf-8'))
+                             for name in index['name']]
+            index['cls'], index['label_dist'] = self.label_dist_table.lookup(
+                index['ele'], index['azi'])
+            pascal_index[mode] = index
+
+        return pascal_index
+
     def _render_pascal(self, mode, r1=1.0):
         '''
         Parameters
@@ -275,6 +406,14 @@ class RenderCar():
             pil_img, box, img_cls, label_distribution = \
                 self.pascal_dataset[mode][n]
 
+        elif self.pascal_index is not None:
+            # only single-car images are indexed, no retry
+            index = self.pascal_index[mode]
+            box = index['box'][n]
+            img_cls = index['cls'][n]
+            label_distribution = index['label_dist'][n]
+            pil_img = PIL.Image.open(index['path'][n]).convert('RGBA')
+
         else:
             skip = True
             while skip:
@@ -284,7 +423,7 @@ class RenderCar():
                 if not skip:
                     break
 
-            img_cls, label_distribution = self.get_label_dist(ele, azi)
+            img_cls, label_distribution = self.label_dist_table(ele, azi)
             pil_img = PIL.Image.open(img_path).convert('RGBA')
 
         box_l, box_t, box_r, box_b = box
@@ -343,20 +482,18 @@ class RenderCar():
         ----------
         '''
         n = np.random.randint(len(self.rawcar_dataset[mode]))
+        atlas = self.rawcar_atlas[mode]
 
-        if False:  # self.pre_load:
-            pil_img, img_cls, label_distribution = self.rawcar_dataset[mode][n]
+        if atlas is not None:
+            pil_img = atlas.pil(n)
+            img_cls = atlas.meta['cls'][n]
+            label_distribution = atlas.meta['label_dist'][n]
 
         else:
             img_path = self.rawcar_dataset[mode][n]
-            img = img_path.split('/')[-1]
-            ele = float(img.split('ele')[1].split('.')[0])
-            azi = float(img.split('azi')[1].split('_')[0])
-
-            ele = ele * math.pi / 18000.
-            azi = azi * math.pi / 18000.
+            ele, azi = _png_ele_azi(img_path)
 
-            img_cls, label_distribution = self.get_label_dist(ele, azi)
+            img_cls, label_distribution = self.label_dist_table(ele, azi)
             pil_img = PIL.Image.open(img_path).convert('RGBA')
 
         min_scale = PNG_MIN_SCALE
@@ -442,21 +579,7 @@ class RenderCar():
         # mat = sio.loadmat('/media/nolan/SSD1/
         #                   HP_31/pascal3d_image_and_label/car_imagenet_label/n03770085_6172.mat')
         #mat = sio.loadmat(_join(self.pascal3d_anno, f))
-        mat = self.pascal3d_anno[f]
-        mat = mat['record'][0][0][1][0]
-
-        # if more then one car in an image, do not use it, so skip
-        if len(mat) > 1:
-            return 0, 0, 0, True
-
-        box = [int(i) for i in mat[0][1][0]]
-        # mat[0][3][0][0]: [azi_coarse, ele_coarse, azi, ele, distance, focal,
-        #                   px, py, theta, error, interval_azi, interval_ele,
-        #                   num_anchor, viewport]
-        ele = mat[0][3][0][0][3][0] * math.pi / 180.
-        azi = mat[0][3][0][0][2][0] * math.pi / 180.
-
-        return ele, azi, box, False
+        return _pascal3d_record(self.pascal3d_anno[f])
     '''
     def get_pascal3d_label(self, img_path, num_cls):
         f = img_path.split('/')[-1].split('.')[0]+'.mat'
@@ -498,6 +621,176 @@ class RenderCar():
     '''
 
 
+class LabelDistTable(object):
+    '''
+    RenderCar.get_label_dist on a quantized (elevation, azimuth) grid,
+    built once per classes/sigma and cached as .npz in cache_dir.
+    '''
+    def __init__(self, classes, sigma=0.1, resolution=1.0, cache_dir=None):
+        '''
+        Parameter:
+        ----------
+        classes: list
+          [[azi, ele], ...] in degree, spec['classes']
+        sigma: float
+          same as get_label_dist
+        resolution: float
+          grid step in degree
+        cache_dir: string
+          where the table is saved, None: do not save
+        '''
+        self.classes = np.array(classes, dtype=np.float32)
+        self.sigma = sigma
+        self.resolution = resolution
+        self.num_ele = int(round(180. / resolution)) + 1  # -90 ~ 90
+        self.num_azi = int(round(360. / resolution))  # 0 ~ 360
+
+        key = hashlib.md5(
+            self.classes.tobytes() + str((sigma, resolution)).encode()).hexdigest()
+        self.path = None if cache_dir is None else \
+            _join(cache_dir, 'label_dist_%s.npz' % key[:8])
+
+        if not self._load():
+            self.cls, self.dist = self._build()
+            self._save()
+
+    def __call__(self, ele, azi):
+        '''
+        Returns
+        ----------
+        class_label: int
+          Maximum likelihood of classes
+        class_label_distribution: np.array
+          (num_cls,) probability of each class
+        '''
+        cls, dist = self.lookup([ele], [azi])
+        return cls[0], dist[0]
+
+    def lookup(self, ele, azi):
+        '''
+        Parameter:
+        ----------
+        ele: list or np.array
+          angle of elevation in rad, shape (N,)
+        azi: list or np.array
+          angle of azimuth in rad, shape (N,)
+
+        Returns
+        ----------
+        class_label: np.array
+          (N,) int
+        class_label_distribution: np.array
+          (N, num_cls) float32
+        '''
+        ele = np.rad2deg(np.asarray(ele, dtype=np.float64))
+        azi = np.rad2deg(np.asarray(azi, dtype=np.float64))
+
+        ei = np.clip(np.round((ele + 90.) / self.resolution), 0, self.num_ele - 1)
+        ai = np.round(azi / self.resolution) % self.num_azi
+
+        return self.cls[ei.astype(int), ai.astype(int)], \
+            self.dist[ei.astype(int), ai.astype(int)]
+
+    def _build(self):
+        # the same great-circle distance as get_label_dist,
+        # shape (num_ele, num_azi, num_cls)
+        ele = _deg_2_rad(np.arange(self.num_ele) * self.resolution - 90.)
+        azi = _deg_2_rad(np.arange(self.num_azi) * self.resolution)
+        ele = ele.reshape(-1, 1, 1)
+        azi = azi.reshape(1, -1, 1)
+        ele_label = _deg_2_rad(self.classes[:, 1]).reshape(1, 1, -1)
+        azi_label = _deg_2_rad(self.classes[:, 0]).reshape(1, 1, -1)
+
+        cos_ang = np.arccos(np.clip(
+            np.sin(ele) * np.sin(ele_label) +
+            np.cos(ele) * np.cos(ele_label) * np.cos(azi - azi_label),
+            -1, 1))
+
+        dist = np.exp(-cos_ang**2 / self.sigma)
+        dist = dist / np.sum(dist, axis=-1, keepdims=True)
+
+        return np.argmin(cos_ang, axis=-1), dist.astype(np.float32)
+
+    def _load(self):
+        '''
+        Returns
+        ----------
+        loaded: bool
+          False if there is no table or it can not be used (truncated,
+          other keys or shape), then it is built again
+        '''
+        if self.path is None or not os.path.exists(self.path):
+            return False
+
+        try:
+            with np.load(self.path) as f:
+                cls, dist, classes = f['cls'], f['dist'], f['classes']
+
+            grid = (self.num_ele, self.num_azi)
+            if cls.shape != grid or dist.shape != grid + (len(self.classes),) or \
+               not np.array_equal(classes, self.classes):
+                raise ValueError('shape %s, %s or classes do not match' % (
+                    cls.shape, dist.shape))
+
+        except Exception as e:
+            print(global_variable.yellow)
+            print('Load label distribution table %s failed, build it again' % self.path)
+            print(e)
+            print(global_variable.reset_color)
+            return False
+
+        self.cls, self.dist = cls, dist
+        return True
+
+    def _save(self):
+        if self.path is None:
+            return
+
+        tmp = None
+        try:
+            # a file of our own, render workers of other runs can be
+            # saving the same table, rename replaces the table at once
+            fd, tmp = tempfile.mkstemp(
+                suffix='.tmp', dir=os.path.dirname(self.path) or '.')
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, cls=self.cls, dist=self.dist, classes=self.classes)
+            os.rename(tmp, self.path)
+
+        except (IOError, OSError) as e:
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+            print(global_variable.yellow)
+            print('Save label distribution table %s failed' % self.path)
+            print(e)
+            print(global_variable.reset_color)
+
+
+def _pascal3d_record(mat):
+    mat = mat['record'][0][0][1][0]
+
+    # if more then one car in an image, do not use it, so skip
+    if len(mat) > 1:
+        return 0, 0, 0, True
+
+    box = [int(i) for i in mat[0][1][0]]
+    # mat[0][3][0][0]: [azi_coarse, ele_coarse, azi, ele, distance, focal,
+    #                   px, py, theta, error, interval_azi, interval_ele,
+    #                   num_anchor, viewport]
+    ele = mat[0][3][0][0][3][0] * math.pi / 180.
+    azi = mat[0][3][0][0][2][0] * math.pi / 180.
+
+    return ele, azi, box, False
+
+
+def _png_ele_azi(img_path):
+    # azi and ele in the file name are in 0.01 degree
+    img = img_path.split('/')[-1]
+    ele = float(img.split('ele')[1].split('.')[0])
+    azi = float(img.split('azi')[1].split('_')[0])
+
+    return ele * math.pi / 18000., azi * math.pi / 18000.
+
+
 def _deg_2_rad(deg):
 
     return deg * math.pi / 180.
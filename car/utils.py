@@ -9,6 +9,11 @@ from yolo_modules import basic_yolo
 from yolo_modules import yolo_cv
 
 
+def shape_type(string):
+    # 4x320x512 -> (4, 320, 512)
+    return tuple(int(i) for i in string.split('x'))
+
+
 def yolo_Parser():
     parser = argparse.ArgumentParser(prog="python YOLO.py")
 
@@ -19,6 +24,11 @@ def yolo_Parser():
     parser.add_argument("--gpu", help="gpu index", dest="gpu", default="0")
     parser.add_argument("--record", dest="record", default=1, type=int, help="record to tensorboard or not")
     parser.add_argument("--weight", dest="weight", default=None, help="pretrain weight file")
+    parser.add_argument("--topk", dest="topk", default=1, type=int, help="max detections per image, 1: best anchor only")
+    parser.add_argument("--prefetch", dest="prefetch", default=4, type=int, help="max rendered batches waiting for training")
+    parser.add_argument("--render_threads", dest="render_threads", default=1, type=int, help="number of render threads")
+    parser.add_argument("--render_workers", dest="render_workers", default=0, type=int, help="number of render processes, 0: use render threads")
+    parser.add_argument("--warm_shapes", dest="warm_shapes", default=[], nargs='*', type=shape_type, help="executor shapes bound at startup, ex: 1x320x512 4x160x256")
 
     parser.parse_args().record = bool(parser.parse_args().record)
 
@@ -37,6 +47,7 @@ def video_Parser():
     parser.add_argument("--LP", dest="LP", default=1, type=int, help="show affined licence plate, if show, add LP box")
     parser.add_argument("--car", dest="car", default=1, type=int, help="add car box")
     parser.add_argument("--record", dest="record", default=0, type=int, help="record or not")
+    parser.add_argument("--topk", dest="topk", default=1, type=int, help="max detections per image, 1: best anchor only")
     parser = yolo_cv.add_video_parser(parser)
 
     parser.parse_args().radar = bool(parser.parse_args().radar)
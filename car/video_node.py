@@ -1,21 +1,20 @@
 import copy
 import cv2
 import threading
+import time
 import os
 import sys
 
-import rospy
-from std_msgs.msg import Float32
-from std_msgs.msg import Float32MultiArray
-from std_msgs.msg import MultiArrayDimension
-
-from sensor_msgs.msg import Image
-from cv_bridge import CvBridge, CvBridgeError
-
 import mxnet
 from mxnet import gpu
 from mxnet import nd
 
+from yolo_modules import frame_mailbox
+from yolo_modules import frame_preprocess
+from yolo_modules import inference_backend
+from yolo_modules import metrics
+from yolo_modules import pipeline
+from yolo_modules import transport
 from yolo_modules import yolo_cv
 from yolo_modules import yolo_gluon
 from yolo_modules import licence_plate_render
@@ -39,64 +38,91 @@ _sin_offset = np.array([math.sin(x*math.pi/180) for x in range(0, 360, _step)])
 
 
 def main(Video, args):
-    if args.trt and args.radar:
-        args.trt = False
+    args.backend = inference_backend.backend_name(args)
+    if args.backend == 'trt' and args.radar:
+        args.backend = 'mxnet'
         print(global_variable.magenta+'--trt, --radar cant use at the same time')
         print('Use Mxnet For Inference')
         print(global_variable.reset_color)
+    args.trt = args.backend == 'trt'
+
+    if args.bench_backends:
+        yolo = Video.load_yolo(args)
+        inference_backend.benchmark_backends(
+            yolo.export_folder, yolo.size, yolo.output_shapes(),
+            cycles=args.bench_backends, threads=args.onnx_threads, fp16=yolo.use_fp16)
+        return
 
+    if args.bench:
+        # no ros master and no display on a build machine
+        args.dev, args.show, args.radar = args.bench, False, False
+
+    t = time.time()
     video = Video(args)
-    if video.radar:
-        video.run()  # One thread, matplotlib is not thread safty
-    else:
-        video()  # Two thread
+    print(global_variable.green)
+    print('cold start: %.1f ms' % ((time.time() - t) * 1000))
+    print(global_variable.reset_color)
+    video()
 
 
 class Video(object):
     def __init__(self, args=None):
+        self.yolo = self.load_yolo(args)
+        self.car_threshold = 0.5
+        self._init(args)
+
+    @classmethod
+    def load_yolo(cls, args):
         if args.version in['v1', 'v2', 'v3', 'v4']:
-            self.yolo = YOLO(args)
+            return YOLO(args)
         elif args.version in['v11']:
-            self.yolo = YOLO_dense(args)
+            return YOLO_dense(args)
         else:
             print(global_variable.red+'Version Error')
             print(global_variable.reset_color)
             sys.exit(0)
 
-        self.car_threshold = 0.5
-        self._init(args)
-
-        if args.trt:
-            global do_inference_wrapper
-            from yolo_modules.tensorrt_module import do_inference_wrapper
-        else:
-            shape = (1, 3, self.yolo.size[0], self.yolo.size[1])
-            #yolo_gluon.test_inference_rate(self.yolo.net, shape, cycles=200)
-
     def _init(self, args):
         # -------------------- init_args -------------------- #
-        self.trt = args.trt
         self.dev = args.dev
         self.topic = args.topic
         self.show = args.show
         self.radar = args.radar
         self.flip = args.flip
         self.clip = (args.clip_h, args.clip_w)
+        self.topk = args.topk
         self.ctx = yolo_gluon.get_ctx(args.gpu)
-
-        # -------------------- init_ros -------------------- #
-        rospy.init_node("YOLO_ros_node", anonymous=True)
-        self.bridge = CvBridge()
-        self.img_pub = rospy.Publisher(self.yolo.pub_img, Image, queue_size=1)
-        self.car_pub = rospy.Publisher(self.yolo.pub_box, Float32MultiArray, queue_size=1)
+        self.preprocess_workers = args.preprocess_workers
+        self.queue_size = args.queue_size
+        self.bench = bool(args.bench)
+        self.bench_rate = args.bench_rate
+        self.async_forward = bool(args.async_forward)
+
+        # -------------------- init_transport -------------------- #
+        # ros, or in memory for --bench
+        self.transport = transport.get_transport(self.bench, "YOLO_ros_node")
+        self.img_pub = self.transport.publisher(self.yolo.pub_img, 'image')
+        self.car_pub = self.transport.publisher(self.yolo.pub_box, 'array')
         self.depth_image = None
-        self.image = None
-        self.mat_car = Float32MultiArray()
+        # latest frame of the camera, dropped frames are never inferred
+        self.mailbox = frame_mailbox.FrameMailbox(max_age=args.max_frame_age)
+        self.transport.on_shutdown(self.mailbox.close)
+
+        # -------------------- init_metrics -------------------- #
+        publish_fn = None
+        if args.metrics_topic:
+            publish_fn = self.transport.publisher(args.metrics_topic, 'string').publish
+        self.metrics, self.metrics_writer = metrics.init_metrics(args, 'yolo', publish_fn)
+        self.metrics.gauge('dropped', lambda: self.mailbox.stats()['dropped'])
+        self.metrics.gauge('duplicates', lambda: self.mailbox.stats()['duplicates'])
 
         # -------------------- init_dev -------------------- #
+        self.frames_read = 0
+        self.frames_done = 0
+        self.capture_done = False
         if self.dev == 'ros':
-            rospy.Subscriber(DEPTH_TOPIC, Image, self._depth_callback)
-            rospy.Subscriber(self.topic, Image, self._image_callback)
+            self.transport.subscribe(DEPTH_TOPIC, 'depth', self._depth_callback)
+            self.transport.subscribe(self.topic, 'image', self._image_callback)
             print(global_variable.green)
             print('Image Topic: %s' % self.topic)
             print('Depth Topic: %s' % DEPTH_TOPIC)
@@ -106,6 +132,20 @@ class Video(object):
             #pass
             threading.Thread(target=self._get_frame).start()
 
+        # -------------------- init_backend -------------------- #
+        self.backend = inference_backend.get_backend(
+            args.backend, self.yolo.export_folder, self.yolo.size, self.ctx[0],
+            output_shapes=self.yolo.output_shapes(),
+            fp16=self.yolo.use_fp16, threads=args.onnx_threads,
+            buffers=2 if self.async_forward else 1)
+
+        # -------------------- init_preprocess -------------------- #
+        # raw camera frames, clip + flip + resize is one warp,
+        # written straight into the backend's input
+        self.preprocess = frame_preprocess.FramePreprocessor(
+            self.yolo.size, clip=self.clip, flip=self.flip,
+            data=self.backend.data, ctx=self.ctx[0])
+
         # -------------------- init_radar -------------------- #
         if self.radar:
             self.radar_prob = yolo_cv.RadarProb(
@@ -125,122 +165,157 @@ class Video(object):
 
     def __call__(self):
         print(global_variable.green)
-        print('Start Double Thread Video Node')
-
-        h, w = self.yolo.size
-        threading.Thread(target=self._video_thread).start()
-        self.net_thread_start = True
+        print('Start Video Pipeline')
+        print(global_variable.reset_color)
 
-        while not rospy.is_shutdown():
-            if self.image is None:
-                print('Net thread Wait For Image')
-                time.sleep(1.0)
-                continue
+        self.net_img_seq = -1
+        pipe = self.build_pipeline()
+        start = time.time()
+        pipe.run(is_shutdown=self._is_shutdown)
+        elapsed = time.time() - start
 
-            if not self.net_thread_start:
-                time.sleep(0.01)
-                continue
-            try:
-                # ------------------ additional image info In ------------------ #
-                now = rospy.get_rostime()
-                net_img_time, net_img_seq = self.img_cb_time, self.img_cb_seq
-                net_img, net_dep = copy.copy(self.image), copy.copy(self.depth_image)
-                yolo_gluon.switch_print('cam to net: %f' % (now - net_img_time).to_sec(), verbose)
+        self.transport.signal_shutdown('video pipeline stopped')
+        if self.metrics_writer is not None:
+            self.metrics_writer.close()
 
-                net_out = self.inference(cv2.resize(net_img, (w, h)))
+        print('frame mailbox: %s' % self.mailbox.stats())
+        for name, stats in pipe.stats().items():
+            print('%s: %s' % (name, stats))
 
-                # -------------------- additional image info-------------------- #
-                now = rospy.get_rostime()
-                yolo_gluon.switch_print('net done time: %f' % (now - net_img_time).to_sec(), verbose)
+        if self.bench:
+            self.bench_report(elapsed)
 
-                # ------------------ additional image info Out ------------------ #
-                self.net_img_time, self.net_img_seq = net_img_time, net_img_seq
-                self.net_dep, self.net_img, self.net_out = net_dep, net_img, net_out
-                self.net_thread_start = False
+    def _is_shutdown(self):
+        if self.transport.is_shutdown():
+            return True
 
-            except Exception as e:
-                rospy.signal_shutdown('main_thread Error')
-                print(global_variable.red + e + global_variable.reset_color)
+        # --bench stops after the last frame of the video is published
+        dropped = self.mailbox.stats()['dropped']
+        return self.capture_done and \
+            self.frames_done + dropped >= self.frames_read
 
-        sys.exit(0)
+    def bench_report(self, elapsed):
+        snapshot = self.metrics.snapshot()
+        frames = max(self.frames_done, 1)
 
-    def _video_thread(self):
-        while not hasattr(self, 'net_out') or not hasattr(self, 'net_img'):
-            time.sleep(0.1)
-
-        print(global_variable.reset_color)
-        while not rospy.is_shutdown():
-            net_dep = copy.copy(self.net_dep)
-            net_out = copy.copy(self.net_out)
-            net_img = copy.copy(self.net_img)
+        print(global_variable.yellow)
+        print('bench: %s' % self.dev)
+        print('%d frames in %.2f s, %.2f fps, %d dropped' % (
+            self.frames_done, elapsed, self.frames_done / elapsed,
+            self.mailbox.stats()['dropped']))
 
-            self.net_thread_start = True
-            try:
-                self.process(net_img, net_out, net_dep)
+        for name, v in sorted(snapshot['latency'].items()):
+            print('%-12s p50 %8.2f ms, p90 %8.2f ms, p99 %8.2f ms' % (
+                name, v[0] * 1000, v[1] * 1000, v[2] * 1000))
 
-            except Exception as e:
-                rospy.signal_shutdown(global_variable.red+'_video_thread Error')
-                print(e)
-                print(global_variable.reset_color)
+        for name, (total, _) in sorted(snapshot['counters'].items()):
+            if name.endswith('detections'):
+                print('%s per frame: %.2f' % (name, total / float(frames)))
 
-    def run(self):
-        print(global_variable.green)
-        print('Start Single Thread Video Node')
         print(global_variable.reset_color)
 
-        h, w = self.yolo.size
-        rate = rospy.Rate(30)
-        while not rospy.is_shutdown():
-            if self.image is None:
-                print('Wait For Image')
-                rate.sleep()
-                continue
-            try:
-                # -------------------- additional image info-------------------- #
-                now = rospy.get_rostime()
-                net_img_time, net_img_seq = self.img_cb_time, self.img_cb_seq
-                net_img, net_dep = copy.copy(self.image), copy.copy(self.depth_image)
-                yolo_gluon.switch_print('cam to net: %f' % (now - net_img_time).to_sec(), verbose)
-
-                net_out = self.inference(cv2.resize(net_img, (w, h)))
-
-                # -------------------- additional image info-------------------- #
-                now = rospy.get_rostime()
-                self.net_img_time, self.net_img_seq = net_img_time, net_img_seq
-                yolo_gluon.switch_print('net done time: %f' % (now - net_img_time).to_sec(), verbose)
-
-                self.process(net_img, net_out, net_dep)
-                rate.sleep()
-
-            except Exception as e:
-                rospy.signal_shutdown('main_thread Error')
-                print(global_variable.red + e + global_variable.reset_color)
+    def build_pipeline(self):
+        '''
+        capture -> preprocess -> infer -> decode -> publish, every stage
+        passes a dict of the frame and what is computed so far.
+        matplotlib(radar) and TensorRT only work in the main thread.
+        '''
+        q = self.queue_size
+        main = 'infer' if self.backend.main_thread else 'publish'
+        stages = [
+            pipeline.Stage('capture', self._capture),
+            pipeline.Stage('preprocess', self._preprocess,
+                           workers=self.preprocess_workers, maxsize=q),
+            pipeline.Stage('infer', self._infer, maxsize=q),
+            pipeline.Stage('decode', self._decode, maxsize=q),
+            pipeline.Stage('publish', self._publish, maxsize=q)]
+
+        for stage in stages:
+            if stage.name == main:
+                stage.workers = 0
+
+        return pipeline.Pipeline(stages, metrics=self.metrics)
+
+    # -------------------- pipeline stages -------------------- #
+    def _capture(self):
+        frame = self.mailbox.get(self.net_img_seq, timeout=1.0)
+        if frame is None:
+            print('Wait For Image')
+            return None
+
+        net_img, self.net_img_seq, net_img_time = frame
+        now = self.transport.now()
+        self.metrics.observe('cam_to_net', now - net_img_time)
+        yolo_gluon.switch_print('cam to net: %f' % (now - net_img_time), verbose)
+
+        return {'img': net_img, 'time': net_img_time,
+                'dep': copy.copy(self.depth_image)}
+
+    def _preprocess(self, item):
+        item['resized'] = self.preprocess.warp(item['img'])
+        return item
+
+    def _infer(self, item):
+        item['out'] = self.inference(item.pop('resized'))
+
+        now = self.transport.now()
+        yolo_gluon.switch_print('net done time: %f' % (now - item['time']), verbose)
+        return item
+
+    def _decode(self, item):
+        if self.async_forward:
+            # the forward of the next frame is already pushed
+            with self.metrics.timer('forward_wait'):
+                for out in item['out']:
+                    out.wait_to_read()
+
+        with self.metrics.timer('predict'):
+            item['pred'] = self.decode(item.pop('out'), item['dep'])
+        return item
+
+    def _publish(self, item):
+        self.net_img_time = item['time']
+        # the published image is the clipped and flipped frame, the
+        # boxes are relative to it
+        img = yolo_cv.cv2_flip_and_clip_frame(item['img'], self.clip, self.flip)
+        self.publish(img, item['pred'])
+
+        self.metrics.observe('cam_to_pub', self.transport.now() - item['time'])
+        self.metrics.count('frames')
+        self.frames_done += 1
 
     def inference(self, net_img):
-        if self.trt:
-            trt_outputs = do_inference_wrapper(self.yolo.net, net_img)
-            net_out = nd.array(trt_outputs).as_in_context(self.ctx[0])
-            net_out = [net_out.reshape((1, 160, 5, 30))]
-
-        else:
-            nd_img = yolo_gluon.cv_img_2_ndarray(net_img, self.ctx[0])
-            # if self.yolo.use_fp16:
-            #     nd_img = nd_img.astype('float16')
-            # nd_img = yolo_gluon.nd_white_balance(nd_img, bgr=[1.0, 1.0, 1.0])
-            net_out = self.yolo.net.forward(is_train=False, data=nd_img)
-            net_out[0].wait_to_read()
+        '''
+        Parameter:
+        ----------
+        net_img: np.array
+          (h, w, 3) uint8, resized to the network input
+
+        Returns
+        ----------
+        net_out: list of mxnet.ndarray
+          copies, the next forward does not overwrite them,
+          still being computed if --async_forward
+        '''
+        with self.metrics.timer('forward'):
+            self.preprocess.load(net_img, data=self.backend.data)
+            net_out = self.backend.forward(wait=not self.async_forward)
 
         return net_out
 
-    def process(self, net_img, net_out, net_dep):
+    def decode(self, net_out, net_dep):
+        '''
+        Returns
+        ----------
+        pred_car: np.array
+          (n, 6+num_class), data[5] is azi
+        '''
+        if self.topk > 1:
+            return self.decode_multi(net_out, net_dep)
+
         pred_car = self.yolo.predict(net_out[:3])
         # --------------- data[5] is depth --------------- #
-        if net_dep:  # net_dep != None
-            x = int(net_dep.shape[1] * pred_car[0, 2])
-            y = int(net_dep.shape[0] * pred_car[0, 1])
-            pred_car[0, 5] = net_dep[y, x]
-        else:
-            pred_car[0, 5] = -1
+        pred_car[0, 5] = self.depth_at(net_dep, pred_car[0, 1], pred_car[0, 2])
 
         # ---------------- data[5] is azi ---------------- #
         x = pred_car[0, -24:]
@@ -250,8 +325,63 @@ class Video(object):
         vec_ang = math.atan2(s, c)
         pred_car[0, 5] = vec_ang
         # ------------------------------------------------- #
-        yolo_gluon.switch_print('cam to pub: %f' % (rospy.get_rostime() - self.net_img_time).to_sec(), verbose)
-        self.ros_publish_array(self.car_pub, self.mat_car, pred_car[0])
+        return pred_car
+
+    def depth_at(self, net_dep, y, x):
+        '''
+        Parameter:
+        ----------
+        net_dep: np.array
+          raw depth image of the camera, not clipped nor flipped
+        y, x: float or np.array
+          0~1 in the clipped and flipped frame, ex: pred_car[:, 1], [:, 2]
+
+        Returns
+        ----------
+        depth: float or np.array
+          -1 if there is no depth image
+        '''
+        if net_dep is None:
+            return np.zeros_like(x) - 1
+
+        H, W = net_dep.shape[:2]
+        top = int((1-self.clip[0]) * H / 2.) if self.clip[0] < 1 else 0
+        left = int((1-self.clip[1]) * W / 2.) if self.clip[1] < 1 else 0
+        ch, cw = H - 2 * top, W - 2 * left
+
+        row = np.clip((ch * np.asarray(y)).astype(int), 0, ch - 1)
+        col = np.clip((cw * np.asarray(x)).astype(int), 0, cw - 1)
+        if self.flip == 1 or self.flip == -1:
+            col = cw - 1 - col
+        if self.flip == 0 or self.flip == -1:
+            row = ch - 1 - row
+
+        return net_dep[top + row, left + col]
+
+    def decode_multi(self, net_out, net_dep):
+        pred_car = self.yolo.predict_multi(
+            net_out[:3], topk=self.topk, threshold=self.car_threshold)[0]
+        pred_car = pred_car[pred_car[:, 0] >= 0]
+
+        # --------------- data[5] is depth --------------- #
+        pred_car[:, 5] = self.depth_at(net_dep, pred_car[:, 1], pred_car[:, 2])
+
+        # ---------------- data[5] is azi ---------------- #
+        x = pred_car[:, -len(_cos_offset):]
+        prob = np.exp(x) / np.sum(np.exp(x), axis=-1, keepdims=True)
+        pred_car[:, 5] = np.arctan2(prob.dot(_sin_offset), prob.dot(_cos_offset))
+        # ------------------------------------------------- #
+        return pred_car
+
+    def publish(self, net_img, pred_car):
+        yolo_gluon.switch_print('cam to pub: %f' % (self.transport.now() - self.net_img_time), verbose)
+        self.metrics.count('detections', int(np.sum(pred_car[:, 0] > self.car_threshold)))
+        if self.topk > 1:
+            # [car_0, car_1, ...], each car is (6+num_class)
+            self.publish_array(self.car_pub, pred_car.reshape(-1))
+        else:
+            self.publish_array(self.car_pub, pred_car[0])
+
         self.visualize(pred_car, net_img)
 
     def _get_frame(self):
@@ -267,7 +397,10 @@ class Video(object):
             os.path.exists(dev):
             print('Image Source: ' + dev)
             cap = cv2.VideoCapture(dev)
-            rate = rospy.Rate(30)
+            if not self.bench:
+                rate = self.transport.rate(30)
+            elif self.bench_rate > 0:
+                rate = self.transport.rate(self.bench_rate)
 
         elif dev.isdigit() and os.path.exists('/dev/video' + dev):
             print('Image Source: /dev/video' + dev)
@@ -276,58 +409,58 @@ class Video(object):
         else:
             print(global_variable.red)
             print('dev should be jetson / video_path(mp4, avi, m2ts) / device_index')
-            rospy.signal_shutdown('')
+            self.transport.signal_shutdown('')
             sys.exit(0)
 
         print(global_variable.reset_color)
-        seq = 0
-        while not rospy.is_shutdown():
+        # --bench as fast as possible: every frame goes through the net
+        block = self.bench and self.bench_rate <= 0
+        while not self.transport.is_shutdown():
             ret, img = cap.read()
             if img is None:
+                if self.bench:  # end of the video
+                    self.capture_done = True
+                    break
                 continue
-            self.img_cb_time = rospy.get_rostime()
-            self.img_cb_seq = seq
-            self.image = yolo_cv.cv2_flip_and_clip_frame(img, self.clip, self.flip)
-            seq += 1
+            self.frames_read += 1
+            self.mailbox.put(img, stamp=self.transport.now(), block=block)
             if 'rate' in locals():
                 rate.sleep()
 
         cap.release()
 
-    def _image_callback(self, img):
-        self.img_cb_time = img.header.stamp  # .secs + img.header.stamp.nsecs * 10**-6
-        self.img_cb_seq = img.header.seq
-        img = self.bridge.imgmsg_to_cv2(img, "bgr8")
-        self.image = yolo_cv.cv2_flip_and_clip_frame(img, self.clip, self.flip)
+    def _image_callback(self, img, stamp, seq):
+        # raw frame, clipped and flipped by the preprocess warp
+        self.mailbox.put(img, stamp=stamp, source_seq=seq)
 
-    def _depth_callback(self, depth_msgs):
-        depth_image = self.bridge.imgmsg_to_cv2(depth_msgs, "32FC1")
-        depth_image = np.array(depth_image, dtype=np.float32)
-        self.depth_image = yolo_cv.cv2_flip_and_clip_frame(
-            depth_image, self.clip, self.flip)
+    def _depth_callback(self, depth_image, stamp, seq):
+        # raw depth, depth_at() maps a detection into it
+        self.depth_image = depth_image
 
     def visualize(self, pred, img):
-        Cout = pred[0]
-
-        if self.radar:
-            self.radar_prob.plot3d(
-                Cout[0], Cout[-self.yolo.num_class:])
+        with self.metrics.timer('draw'):
+            if self.radar and len(pred) > 0:
+                Cout = pred[0]
+                self.radar_prob.plot3d(
+                    Cout[0], Cout[-self.yolo.num_class:])
 
-        if Cout[0] > self.car_threshold:
-            yolo_cv.cv2_add_bbox(img, Cout, 4, use_r=False)
+            for Cout in pred:
+                if Cout[0] > self.car_threshold:
+                    yolo_cv.cv2_add_bbox(img, Cout, 4, use_r=False)
 
-        if self.save_video:
-            self.out.write(img)
+            if self.save_video:
+                self.out.write(img)
 
-        if self.show:
-            cv2.imshow('img', img)
-            cv2.waitKey(1)
+            if self.show:
+                cv2.imshow('img', img)
+                cv2.waitKey(1)
 
-        self.img_pub.publish(self.bridge.cv2_to_imgmsg(img, 'bgr8'))
+        with self.metrics.timer('ros_publish'):
+            self.img_pub.publish(img)
 
-    def ros_publish_array(self, ros_publisher, mat, data):
-        mat.data = data
-        ros_publisher.publish(mat)
+    def publish_array(self, publisher, data):
+        with self.metrics.timer('ros_publish'):
+            publisher.publish(data)
 
 
 if __name__ == '__main__':
@@ -120,6 +120,12 @@ class YOLO(car_YOLO.YOLO, LP_detection.LicencePlateDetectioin):
 
         yolo_gluon.init_NN(self.net, weight, self.ctx)
 
+    def output_shapes(self, batch=1):
+        # LP branch is on the shallowest pyramid layer, (batch, h, w, channels)
+        h, w = self.size[0] / self.steps[0], self.size[1] / self.steps[0]
+        LP_shape = (batch, h, w, self.LP_slice_point[-1])
+        return car_YOLO.YOLO.output_shapes(self, batch) + [LP_shape]
+
     # -------------------- LP -------------------- #
     def _score_weight_LP(self, mask, ctx):
         n = self.LP_negative_weight
@@ -214,53 +220,21 @@ class YOLO(car_YOLO.YOLO, LP_detection.LicencePlateDetectioin):
             raw_input()
             '''
 
-    def _render_thread(self):
+    def _init_renderer(self):
+        car_YOLO.YOLO._init_renderer(self)
         h, w = self.size
-        bs = self.batch_size
-
-        self.bg_iter_valid = yolo_gluon.load_background('val', bs, h, w)
-        bg_iter_train = yolo_gluon.load_background('train', bs, h, w)
-        LP_generator = licence_plate_render.LPGenerator(h, w)
+        self.LP_generator = licence_plate_render.LPGenerator(h, w)
 
-        self.car_renderer = RenderCar(
-            h, w, self.classes, self.ctx[0], pre_load=render_thread_pre_load)
+    def _render_shapes(self):
+        # LP label: bs*1*[score, 6D pose..., LP_type], see LPGenerator.add
+        return car_YOLO.YOLO._render_shapes(self) + [(self.batch_size, 1, 10)]
 
-        while not self.shutdown_training:
-            if self.rendering_done:
-                #print('render done')
-                time.sleep(0.01)
-                continue
+    def _render_batch(self, bg):
+        imgs, labels = car_YOLO.YOLO._render_batch(self, bg)
+        imgs, LP_labels = self.LP_generator.add(
+            imgs, self.LP_r_max, add_rate=0.5)
 
-            # ready to render new images
-            if (self.backward_counter % 10 == 0 or 'bg' not in locals()):
-                bg = yolo_gluon.ImageIter_next_batch(bg_iter_train)
-                bg = bg.as_in_context(self.ctx[0])
-
-            # change an other batch of background
-            imgs, self.labels = self.car_renderer.render(
-                bg, 'train', render_rate=0.5, pascal_rate=0.2)
-
-            self.imgs, self.LP_labels = LP_generator.add(
-                imgs, self.LP_r_max, add_rate=0.5)
-            self.rendering_done = True
-
-    def _train_thread(self):
-        while not self.shutdown_training:
-            if not self.rendering_done:
-                # training images are not ready
-                #print('rendering')
-                time.sleep(0.01)
-                continue
-
-            batch_xs = self.imgs.copy()
-            car_batch_ys = self.labels.copy()
-            LP_batch_ys = self.LP_labels.copy()
-            batch_xs = yolo_gluon.split_render_data(batch_xs, self.ctx)
-            car_batch_ys = yolo_gluon.split_render_data(car_batch_ys, self.ctx)
-            LP_batch_ys = yolo_gluon.split_render_data(LP_batch_ys, self.ctx)
-
-            self.rendering_done = False
-            self._train_batch(batch_xs, car_batch_ys, LP_batch_ys)
+        return imgs, labels, LP_labels
 
     def _train_batch(self, bxs, car_bys, LP_bys, car_rotate=False):
         all_gpu_loss = []
@@ -390,7 +364,8 @@ class YOLO(car_YOLO.YOLO, LP_detection.LicencePlateDetectioin):
             self.ctx[0],
             self.export_folder,
             onnx=False,
-            fp16=False)
+            fp16=False,
+            spec=self.spec)
 
 
 # -------------------- Main -------------------- #
@@ -1,12 +1,7 @@
 import copy
+import sys
 import threading
 
-import rospy
-from std_msgs.msg import Float32MultiArray
-
-from sensor_msgs.msg import Image
-from cv_bridge import CvBridge, CvBridgeError
-
 from yolo_modules import yolo_cv
 from yolo_modules import yolo_gluon
 from yolo_modules import licence_plate_render
@@ -26,13 +21,7 @@ verbose = 0
 
 class CarLPVideo(Video):
     def __init__(self, args):
-        if args.version in['v1', 'v2', 'v3', 'v4']:
-            self.yolo = YOLO(args)
-        else:
-            print(global_variable.red+'Version Error')
-            print(global_variable.reset_color)
-            sys.exit(0)
-
+        self.yolo = self.load_yolo(args)
         self.project_rect_6d = licence_plate_render.ProjectRectangle6D(
             int(380*1.1), int(160*1.1))
 
@@ -41,20 +30,23 @@ class CarLPVideo(Video):
         self._init(args)
 
         # -------------------- init LP -------------------- #
-        self.LP_pub = rospy.Publisher(self.yolo.pub_LP, Float32MultiArray, queue_size=1)
-        self.clipped_LP_pub = rospy.Publisher(self.yolo.pub_clipped_LP, Image, queue_size=1)
-        self.mat_LP = Float32MultiArray()
+        self.LP_pub = self.transport.publisher(self.yolo.pub_LP, 'array')
+        self.clipped_LP_pub = self.transport.publisher(self.yolo.pub_clipped_LP, 'image')
 
-    def process(self, net_img, net_out, net_dep):
+    @classmethod
+    def load_yolo(cls, args):
+        if args.version in['v1', 'v2', 'v3', 'v4']:
+            return YOLO(args)
+        else:
+            print(global_variable.red+'Version Error')
+            print(global_variable.reset_color)
+            sys.exit(0)
+
+    def decode(self, net_out, net_dep):
         pred_LP = self.yolo.predict_LP([net_out[-1]])
         pred_car = self.yolo.predict(net_out[:3])
         # --------------- data[5] is depth --------------- #
-        if net_dep:  # net_dep != None
-            x = int(net_dep.shape[1] * pred_car[0, 2])
-            y = int(net_dep.shape[0] * pred_car[0, 1])
-            pred_car[0, 5] = net_dep[y, x]
-        else:
-            pred_car[0, 5] = -1
+        pred_car[0, 5] = self.depth_at(net_dep, pred_car[0, 1], pred_car[0, 2])
         # ---------------- data[5] is azi ---------------- #
         '''
         x = pred_car[0, -24:]
@@ -65,10 +57,16 @@ class CarLPVideo(Video):
         pred_car[0, 5] = vec_ang
         '''
         # ------------------------------------------------- #
-        yolo_gluon.switch_print('cam to pub: %f' % (rospy.get_rostime() - self.net_img_time).to_sec(), verbose)
+        return pred_car, pred_LP
 
-        self.ros_publish_array(self.LP_pub, self.mat_LP, pred_LP[0])
-        self.ros_publish_array(self.car_pub, self.mat_car, pred_car[0])
+    def publish(self, net_img, pred):
+        pred_car, pred_LP = pred
+        yolo_gluon.switch_print('cam to pub: %f' % (self.transport.now() - self.net_img_time), verbose)
+        self.metrics.count('detections', int(pred_car[0, 0] > self.car_threshold))
+        self.metrics.count('LP_detections', int(pred_LP[0, 0] > self.LP_threshold))
+
+        self.publish_array(self.LP_pub, pred_LP[0])
+        self.publish_array(self.car_pub, pred_car[0])
         self.visualize_carlp(pred_car, pred_LP, net_img)
 
     def visualize_carlp(self, pred_car, pred_LP, img):
@@ -76,9 +74,11 @@ class CarLPVideo(Video):
 
         # -------------------- Licence Plate -------------------- #
         if LP_out[0] > self.LP_threshold:
-            img, clipped_LP = self.project_rect_6d.add_edges(img,  LP_out[1:])
-            clipped_LP_msg = self.bridge.cv2_to_imgmsg(clipped_LP, 'bgr8')
-            self.clipped_LP_pub.publish(clipped_LP_msg)
+            with self.metrics.timer('draw'):
+                img, clipped_LP = self.project_rect_6d.add_edges(img,  LP_out[1:])
+
+            with self.metrics.timer('ros_publish'):
+                self.clipped_LP_pub.publish(clipped_LP)
 
             #if self.show:
                 #cv2.imshow('Licence Plate', clipped_LP)
@@ -27,6 +27,8 @@ import matplotlib.patches as patches
 import PIL.Image as PILIMG
 from PIL import ImageFilter, ImageEnhance
 
+from yolo_modules.frame_mailbox import FrameMailbox
+
 
 cos_offset = np.array([math.cos(x*math.pi/180) for x in range(0,360,30)])
 sin_offset = np.array([math.sin(x*math.pi/180) for x in range(0,360,30)])
@@ -300,21 +302,26 @@ class Video():
         cap = cv2.VideoCapture(0)
         #cap = cv2.VideoCapture('/home/nolan/Desktop/mxnet/video/DJI_0048.MP4')
         while not rospy.is_shutdown():
-            ret, self.img = cap.read()
+            ret, img = cap.read()
             #img = cv2.flip(img, -1)
+            if img is not None:
+                self.mailbox.put(img)
         cap.release()
     
     def _image_callback(self, img):
         ##################### Convert and Predict #####################
+        stamp, seq = img.header.stamp, img.header.seq
         img = self.bridge.imgmsg_to_cv2(img, "bgr8")
-        self.img = img
+        self.mailbox.put(img, stamp=stamp, source_seq=seq)
     
     def run(self, topic=False, show=True, radar=False, ctx=gpu(0)):
         self.radar = radar
         self.show = show
 
         self.topk = 1
+        self.mailbox = FrameMailbox()
         self._init_ros()
+        rospy.on_shutdown(self.mailbox.close)
         self.resz = image.ForceResizeAug((self.size[1], self.size[0]))
 
         if radar:
@@ -331,17 +338,21 @@ class Video():
             rospy.Subscriber(topic, Image, self._image_callback)
             print('\033[1;33;40m Image Topic: %s\033[0m'%topic)
         
-        rate = rospy.Rate(30)
+        seq = -1
         while not rospy.is_shutdown():
-            if hasattr(self, 'img'):
-                nd_img = nd.array(self.img)
-                nd_img = self.resz(nd_img).as_in_context(ctx)
-
-                nd_img =  nd_img.transpose((2,0,1)).expand_dims(axis=0)/255.        
-                out = self.predict(nd_img)
-                self.visualize(out)
-                #rate.sleep()
-            #else: print('Wait For Image')      
+            # blocks until a new frame, never infer the same one twice
+            frame = self.mailbox.get(seq, timeout=1.0)
+            if frame is None:
+                continue
+            img, seq, _ = frame
+            self.img = img  # visualize() draws on it
+
+            nd_img = nd.array(img)
+            nd_img = self.resz(nd_img).as_in_context(ctx)
+
+            nd_img =  nd_img.transpose((2,0,1)).expand_dims(axis=0)/255.        
+            out = self.predict(nd_img)
+            self.visualize(out)
         
 class RenderCar():
     def __init__(self, batch_size, img_h, img_w, ctx):
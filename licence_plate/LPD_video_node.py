@@ -1,18 +1,22 @@
 import cv2
+import numpy as np
 import os
 import sys
 import threading
 import time
 
-import rospy
-from cv_bridge import CvBridge
-from sensor_msgs.msg import Image
-from std_msgs.msg import Float32MultiArray
-
 from LP_detection import LicencePlateDetectioin, Parser
 from yolo_modules import yolo_gluon
 from yolo_modules import global_variable
+from yolo_modules.frame_mailbox import FrameMailbox
+from yolo_modules.frame_preprocess import FramePreprocessor
+from yolo_modules.inference_backend import backend_name, benchmark_backends, get_backend
+from yolo_modules.metrics import init_metrics
+from yolo_modules.model_bundle import find_bundle
+from yolo_modules.pipeline import Pipeline, Stage
+from yolo_modules.transport import get_transport
 from yolo_modules.licence_plate_render import ProjectRectangle6D
+from yolo_modules.licence_plate_render.plate_rectifier import PlateRectifier
 from yolo_modules.yolo_cv import cv2_flip_and_clip_frame
 
 
@@ -28,135 +32,215 @@ def main():
     global args, LPD
     args = Parser()
     args.mode = 'video'
+    if args.bench:
+        # no ros master and no display on a build machine
+        args.dev, args.show = args.bench, False
+    args.backend = backend_name(args)
+    args.trt = args.backend == 'trt'
     LPD = LicencePlateDetectioin(args)
+
+    if args.bench_backends:
+        benchmark_backends(
+            LPD.export_file, LPD.size, LPD.output_shapes(),
+            cycles=args.bench_backends, threads=args.onnx_threads)
+        return
+
     video(args)
 
 
 def video(args):
-    global net_img_g, net_out_g, net_thread_start
+    global backend, preprocess, mailbox, net_img_seq, metrics
+    global transport, frames_read, frames_done, capture_done
     h, w = LPD.size
+    mailbox = FrameMailbox(max_age=args.max_frame_age)
+
+    backend = get_backend(
+        args.backend, LPD.export_file, (h, w), LPD.ctx[0],
+        output_shapes=LPD.output_shapes(), threads=args.onnx_threads,
+        buffers=2 if args.async_forward else 1)
+    if args.backend == 'mxnet' and find_bundle(LPD.export_file) is None:
+        yolo_gluon.test_inference_rate(backend.executor, (1, 3, h, w), cycles=100, ctx=LPD.ctx[0])
+
+    # raw frames, clip + flip + resize is one warp, the same path as
+    # car/video_node, loaded straight into the backend's input
+    preprocess = FramePreprocessor(
+        (h, w), clip=(args.clip_h, args.clip_w), flip=args.flip,
+        data=backend.data, ctx=LPD.ctx[0])
+
+    # ros, or in memory for --bench
+    transport = get_transport(bool(args.bench), "LP_Detection_Video_Node")
+    transport.on_shutdown(mailbox.close)
+    frames_read, frames_done, capture_done = 0, 0, False
+    _init_publish()
+
+    publish_fn = None
+    if args.metrics_topic:
+        publish_fn = transport.publisher(args.metrics_topic, 'string').publish
+    metrics, metrics_writer = init_metrics(args, 'lpd', publish_fn)
+    metrics.gauge('dropped', lambda: mailbox.stats()['dropped'])
+    metrics.gauge('duplicates', lambda: mailbox.stats()['duplicates'])
 
-    if args.trt:  # tensorRT Inference can't in thread
-        import numpy as np
-        from yolo_modules.tensorrt_module import do_inference_wrapper
-        from yolo_modules.tensorrt_module import get_engine_wrapper
-        engine_wrapper = get_engine_wrapper(args.version)
-        net_out_shape = (
-            1, LPD.LP_slice_point[-1],
-            h/2**LPD.num_downsample,
-            w/2**LPD.num_downsample)
-    else:
-        import mxnet
-        # mx_resize = mxnet.image.ForceResizeAug((w, h), interp=2)  # not always available
-        net = yolo_gluon.init_executor(LPD.export_file, (h, w), LPD.ctx[0])
-        yolo_gluon.test_inference_rate(net, (1, 3, h, w), cycles=100, ctx=LPD.ctx[0])
-
-    rospy.init_node("LP_Detection_Video_Node", anonymous=True)
-    threading.Thread(target=_video_thread).start()
-    net_thread_start = True
-    while not rospy.is_shutdown():
-        if 'img_g' not in globals() or img_g is None:
-            print('Wait For Image')
-            time.sleep(1.0)
-            continue
-
-        if not net_thread_start:
-            time.sleep(0.01)
-            continue
-        try:
-            net_start_time = time.time()  # tic
-            net_img = img_g.copy()  # (480, 640, 3), np.float32
-            net_img = cv2.resize(net_img, (w, h))  # (320, 512, 3)
-
-            if args.trt:
-                # if cuMemcpyHtoDAsync failed: invalid argument, check input image size
-                trt_outputs = do_inference_wrapper(engine_wrapper, net_img)
-                net_out = np.array(trt_outputs).reshape(net_out_shape)  # list to np.array
-
-            else:
-                nd_img = yolo_gluon.cv_img_2_ndarray(net_img, LPD.ctx[0])#, mxnet_resize=mx_resize)
-                net_out = net.forward(is_train=False, data=nd_img)[0]
-                net_out[-1].wait_to_read()
-
-            yolo_gluon.switch_print(time.time()-net_start_time, video_verbose)
-            net_img_g = net_img
-            net_out_g = net_out
-            net_thread_start = False
-
-        except Exception as e:
-            print(global_variable.red)
-            rospy.signal_shutdown('main_thread Error')
-            print(e)
-            print(global_variable.reset_color)
+    # -------------------- video record -------------------- #
+    '''
+    if record:
+        start_time = datetime.datetime.now().strftime("%m-%dx%H-%M")
+        out_file = os.path.join('video', 'LPD_ % s.avi' % start_time)
+        fourcc = cv2.VideoWriter_fourcc(*'XVID')
+        v_size = (640, 480)
+        video_out = cv2.VideoWriter(out_file, fourcc, 30, v_size)
+    '''
+    # capture -> preprocess -> infer -> decode -> publish
+    # TensorRT and cv2.imshow only work in the main thread
+    q = args.queue_size
+    main = 'infer' if backend.main_thread else 'publish'
+    stages = [
+        Stage('capture', _capture),
+        Stage('preprocess', _preprocess, workers=args.preprocess_workers, maxsize=q),
+        Stage('infer', _infer, maxsize=q),
+        Stage('decode', _decode, maxsize=q),
+        Stage('publish', _publish, maxsize=q)]
+    for stage in stages:
+        if stage.name == main:
+            stage.workers = 0
+
+    net_img_seq = -1
+    pipe = Pipeline(stages, metrics=metrics)
+    start = time.time()
+    pipe.run(is_shutdown=_is_shutdown)
+    elapsed = time.time() - start
+
+    transport.signal_shutdown('video pipeline stopped')
+    if metrics_writer is not None:
+        metrics_writer.close()
+
+    print('frame mailbox: %s' % mailbox.stats())
+    for name, stats in pipe.stats().items():
+        print('%s: %s' % (name, stats))
+
+    if args.bench:
+        _bench_report(elapsed)
     sys.exit(0)
 
 
-def _video_thread(record=False):
-    global bridge, net_thread_start  # for _image_callback()
+def _is_shutdown():
+    if transport.is_shutdown():
+        return True
+
+    # --bench stops after the last frame of the video is published
+    return capture_done and \
+        frames_done + mailbox.stats()['dropped'] >= frames_read
+
+
+def _bench_report(elapsed):
+    snapshot = metrics.snapshot()
+
+    print(global_variable.yellow)
+    print('bench: %s' % args.dev)
+    print('%d frames in %.2f s, %.2f fps, %d dropped' % (
+        frames_done, elapsed, frames_done / elapsed, mailbox.stats()['dropped']))
+
+    for name, v in sorted(snapshot['latency'].items()):
+        print('%-12s p50 %8.2f ms, p90 %8.2f ms, p99 %8.2f ms' % (
+            name, v[0] * 1000, v[1] * 1000, v[2] * 1000))
+
+    total = snapshot['counters'].get('LP_detections', (0, 0))[0]
+    print('LP_detections per frame: %.2f' % (total / float(max(frames_done, 1))))
+    print(global_variable.reset_color)
+
+
+def _init_publish():
+    global rectifier, ps_pub, LP_pub, pose_msg
 
-    pjct_6d = ProjectRectangle6D(int(380*1.05), int(160*1.05))
-    ps_pub = rospy.Publisher(LPD.pub_LP, Float32MultiArray, queue_size=0)
-    LP_pub = rospy.Publisher(LPD.pub_clipped_LP, Image, queue_size=0)
+    # clipped plates at the OCR input size, OCR does not resize them
+    rectifier = PlateRectifier(ProjectRectangle6D(int(380*1.05), int(160*1.05)))
+    ps_pub = transport.publisher(LPD.pub_LP, 'array', queue_size=0)
+    LP_pub = transport.publisher(LPD.pub_clipped_LP, 'image', queue_size=0)
 
-    pose_msg = Float32MultiArray()
-    bridge = CvBridge()
-    rate = rospy.Rate(30)
+    pose_msg = []
 
     if args.dev == 'ros':
-        rospy.Subscriber(args.topic, Image, _image_callback)
+        transport.subscribe(args.topic, 'image', _image_callback)
         print('Image Topic: %s' % args.topic)
 
     else:
         threading.Thread(target=_get_frame).start()
 
-    # -------------------- video record -------------------- #
-    '''
-    if record:
-        start_time = datetime.datetime.now().strftime("%m-%dx%H-%M")
-        out_file = os.path.join('video', 'LPD_ % s.avi' % start_time)
-        fourcc = cv2.VideoWriter_fourcc(*'XVID')
-        v_size = (640, 480)
-        video_out = cv2.VideoWriter(out_file, fourcc, 30, v_size)
-    '''
-    while not rospy.is_shutdown():
-        if 'net_out_g' not in globals() or 'net_img_g' not in globals():
-            time.sleep(1)
-            print('Wait For Net')
-            continue
-        try:
-            img = net_img_g.copy()
-            net_out = net_out_g.copy()
-            net_thread_start = True
 
-            img = cv2_flip_and_clip_frame(img, (args.clip_h, args.clip_w), args.flip)
-            pred = LPD.predict_LP(net_out)
-            ps_pub.publish(pose_msg)
+# -------------------- pipeline stages -------------------- #
+def _capture():
+    global net_img_seq
+    frame = mailbox.get(net_img_seq, timeout=1.0)
+    if frame is None:
+        print('Wait For Image')
+        return None
+
+    net_img, net_img_seq, stamp = frame  # (480, 640, 3)
+    metrics.observe('cam_to_net', transport.now() - stamp)
+    return {'img': net_img, 'time': time.time(), 'stamp': stamp}
+
+
+def _preprocess(item):
+    item['resized'] = preprocess.warp(item['img'])  # (320, 512, 3)
+    return item
+
+
+def _infer(item):
+    with metrics.timer('forward'):
+        preprocess.load(item.pop('resized'), data=backend.data)
+        net_out = backend.forward(wait=not args.async_forward)[0]
+
+    yolo_gluon.switch_print(time.time()-item['time'], video_verbose)
+    item['out'] = net_out
+    return item
+
+
+def _decode(item):
+    if args.async_forward:
+        # the forward of the next frame is already pushed
+        with metrics.timer('forward_wait'):
+            item['out'].wait_to_read()
+
+    with metrics.timer('predict'):
+        item['pred'] = LPD.predict_LP(item.pop('out'))
+    return item
+
+
+def _publish(item):
+    img = cv2_flip_and_clip_frame(item['img'], (args.clip_h, args.clip_w), args.flip)
+    pred = item['pred']
+    with metrics.timer('ros_publish'):
+        ps_pub.publish(pose_msg)
+
+    if pred[0] > video_threshold:
+        with metrics.timer('rectify'):
+            _, corners = rectifier([img], pred[None, 1:7])
+
+        with metrics.timer('ros_publish'):
+            LP_pub.publish(rectifier.crops[0])
+
+        with metrics.timer('draw'):
+            cv2.polylines(img, corners.astype(np.int32), 1, (0, 0, 255), 2)
 
-            if pred[0] > video_threshold:
-                img, clipped_LP = pjct_6d.add_edges(img, pred[1:])
-                clipped_LP = bridge.cv2_to_imgmsg(clipped_LP, 'bgr8')
-                LP_pub.publish(clipped_LP)
+    if args.show:
+        with metrics.timer('draw'):
+            cv2.imshow('img', img)
+            cv2.waitKey(1)
+    #video_out.write(ori_img)
 
-            if args.show:
-                cv2.imshow('img', img)
-                cv2.waitKey(1)
-            #video_out.write(ori_img)
-            #rate.sleep()
+    metrics.observe('cam_to_pub', transport.now() - item['stamp'])
+    metrics.count('frames')
+    metrics.count('LP_detections', int(pred[0] > video_threshold))
 
-        except Exception as e:
-            print(global_variable.red)
-            rospy.signal_shutdown('_video_thread Error')
-            print(e)
-            print(global_variable.reset_color)
+    global frames_done
+    frames_done += 1
 
 
-def _image_callback(img):
-    global img_g
-    img_g = bridge.imgmsg_to_cv2(img, "bgr8")
+def _image_callback(img, stamp, seq):
+    mailbox.put(img, stamp=stamp, source_seq=seq)
 
 
 def _get_frame():
-    global img_g
+    global frames_read, capture_done
     from yolo_modules import global_variable
 
     print(global_variable.green)
@@ -170,7 +254,10 @@ def _get_frame():
     elif dev.split('.')[-1] in ['mp4', 'avi', 'm2ts']:
         print('Image Source: ' + dev)
         cap = cv2.VideoCapture(dev)
-        rate = rospy.Rate(30)
+        if not args.bench:
+            rate = transport.rate(30)
+        elif args.bench_rate > 0:
+            rate = transport.rate(args.bench_rate)
 
     elif dev.isdigit() and os.path.exists('/dev/video' + dev):
         print('Image Source: /dev/video' + dev)
@@ -179,14 +266,20 @@ def _get_frame():
     else:
         print(global_variable.red)
         print('dev should be jetson / video_path(mp4, avi, m2ts) / device_index')
-        rospy.signal_shutdown('_get_frame Error')
+        transport.signal_shutdown('_get_frame Error')
 
     print(global_variable.reset_color)
-    while not rospy.is_shutdown():
+    # --bench as fast as possible: every frame goes through the net
+    block = bool(args.bench) and args.bench_rate <= 0
+    while not transport.is_shutdown():
         ret, img = cap.read()
         if img is None:
+            if args.bench:  # end of the video
+                capture_done = True
+                break
             continue
-        img_g = img
+        frames_read += 1
+        mailbox.put(img, stamp=transport.now(), block=block)
 
         if 'rate' in locals():
             rate.sleep()
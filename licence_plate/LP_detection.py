@@ -5,6 +5,7 @@ import math
 import numpy as np
 import os
 import sys
+import time
 import yaml
 
 import mxboard
@@ -15,6 +16,8 @@ from gluoncv.model_zoo.densenet import _make_dense_block, _make_transition
 
 from yolo_modules import global_variable
 from yolo_modules import licence_plate_render
+from yolo_modules.licence_plate_render import plate_rectifier
+from yolo_modules import model_bundle
 from yolo_modules import yolo_cv
 from yolo_modules import yolo_gluon
 
@@ -25,7 +28,8 @@ os.environ['MXNET_CUDNN_AUTOTUNE_DEFAULT'] = '0'
 def main():
     args = Parser()
     LP_detection = LicencePlateDetectioin(args)
-    available_mode = ['train', 'valid', 'export']
+    available_mode = ['train', 'valid', 'export', 'benchmark_add', 'benchmark_rectify',
+                      'benchmark_loss_mask_LP']
     assert args.mode in available_mode, \
         'Available Modes Are {}'.format(available_mode)
 
@@ -100,9 +104,18 @@ class LPDenseNet(mxnet.gluon.HybridBlock):
 class LicencePlateDetectioin():
     def __init__(self, args):
         spec_path = os.path.join(args.version, 'spec.yaml')
-        with open(spec_path) as f:
-            spec = yaml.load(f)
-
+        bundle = None
+        if args.mode == 'video' and not args.trt:
+            # the spec exported with the weights, no yaml parsing
+            bundle = model_bundle.find_bundle(args.version + '/export/')
+
+        if bundle is not None and bundle.spec:
+            spec = bundle.spec
+        else:
+            with open(spec_path) as f:
+                spec = yaml.load(f)
+
+        self.spec = spec
         for key in spec:
             setattr(self, key, spec[key])
 
@@ -111,8 +124,9 @@ class LicencePlateDetectioin():
         self.export_file = args.version + '/export/'
         self.num_downsample = len(self.block_config) + 1
 
-        assert args.mode in ['train', 'valid', 'export', 'video']
-        if args.mode == 'video':
+        benchmarks = ['benchmark_add', 'benchmark_rectify', 'benchmark_loss_mask_LP']
+        assert args.mode in ['train', 'valid', 'export', 'video'] + benchmarks
+        if args.mode == 'video' or args.mode in benchmarks:
             return
 
         self.backup_dir = os.path.join(args.version, 'backup')
@@ -140,9 +154,86 @@ class LicencePlateDetectioin():
 
         self._train_or_valid('val')
 
+    def benchmark_add(self):
+        '''
+        LPGenerator.add, full-frame projection vs ROI warp, samples/s
+        '''
+        print(global_variable.cyan)
+        print('Benchmark Licence Plate Rendering')
+        licence_plate_render.benchmark_add(h=self.size[0], w=self.size[1])
+
+    def benchmark_rectify(self):
+        '''
+        clipped plates for OCR, add_edges one by one vs PlateRectifier
+        '''
+        print(global_variable.cyan)
+        print('Benchmark Licence Plate Rectification')
+        plate_rectifier.benchmark_rectify(
+            licence_plate_render.ProjectRectangle6D(int(380*1.05), int(160*1.05)),
+            img_shape=tuple(self.size))
+
+    def benchmark_loss_mask_LP(self, num_obj=2, cycles=50):
+        '''
+        compare _loss_mask_LP with _loss_mask_LP_per_object on random
+        label batches, batch size is the one in spec.yaml
+        '''
+        print(global_variable.cyan)
+        print('Benchmark LP Target Assignment')
+
+        bs = self.batch_size
+        label_batch = nd.array(
+            self._random_LP_label_batch(bs, num_obj), ctx=self.ctx[0])
+
+        results = []
+        for name in ['_loss_mask_LP_per_object', '_loss_mask_LP']:
+            loss_mask = getattr(self, name)
+            y, mask = loss_mask(label_batch, 0)  # warm up
+            mask.wait_to_read()
+
+            t = time.time()
+            for _ in range(cycles):
+                y, mask = loss_mask(label_batch, 0)
+                mask.wait_to_read()
+
+            cost = (time.time() - t) / cycles
+            results.append(y + [mask])
+            print('%s: %.2f ms/batch (bs=%d, obj=%d)' % (
+                name, cost * 1000, bs, num_obj))
+
+        for i, name in enumerate(['score', 'xy', 'z', 'r', 'class', 'mask']):
+            err = nd.max(nd.abs(results[0][i] - results[1][i])).asscalar()
+            print('max abs diff of %s: %f' % (name, err))
+
+        print(global_variable.reset_color)
+
+    def _random_LP_label_batch(self, bs, num_obj, invalid_rate=0.3):
+        # bs*object*[1, X, Y, Z, r1, r2, r3, x, y, LP_type]
+        label_batch = np.ones((bs, num_obj, 10)) * (-1)
+        for b in range(bs):
+            for o in range(num_obj):
+                if np.random.rand() < invalid_rate:
+                    continue
+
+                Z = np.random.uniform(1500., 5000.)
+                r = np.random.uniform(-0.99, 0.99, 3) * self.LP_r_max
+                label_batch[b, o] = np.concatenate((
+                    [1, Z * np.random.uniform(-0.3, 0.3),
+                     Z * np.random.uniform(-0.2, 0.2), Z],
+                    r * math.pi / 180.,
+                    [np.random.uniform(0, self.size[1]),
+                     np.random.uniform(0, self.size[0]),
+                     np.random.randint(self.LP_num_class)]))
+
+        return label_batch
+
     def export(self):
         shape = (1, 3, self.size[0], self.size[1])
-        yolo_gluon.export(self.net, shape, self.ctx[0], self.export_file, onnx=1, epoch=0)
+        yolo_gluon.export(self.net, shape, self.ctx[0], self.export_file, onnx=1, epoch=0,
+                          spec=self.spec)
+
+    def output_shapes(self, batch=1):
+        h, w = self.size[0] / 2**self.num_downsample, self.size[1] / 2**self.num_downsample
+        return [(batch, self.LP_slice_point[-1], h, w)]
 
     def predict_LP(self, batch_out):
         use_np = True if type(batch_out) == np.ndarray else False
@@ -282,7 +373,69 @@ class LicencePlateDetectioin():
 
     def _loss_mask_LP(self, label_batch, gpu_index):
         """Generate training targets given predictions and label_batch.
-        label_batch: bs*object*[class, cent_y, cent_x, box_h, box_w, rotate]
+        label_batch: bs*object*[1, X, Y, Z, r1, r2, r3, x, y, LP_type]
+
+        Cells and targets of all plates of the batch are computed at once
+        and scattered with a one-hot batch_dot, so no value is copied back
+        to host. If two plates of an image fall in the same cell, the later
+        one wins. Unlike _loss_mask_LP_per_object (the loop this replaced),
+        that holds for LP_class too: the loop left the class bit of the
+        earlier plate set, so the cell had two classes, here it has only
+        the one of the later plate.
+        """
+        bs, num_obj = label_batch.shape[0], label_batch.shape[1]
+        ctx = self.ctx[gpu_index]
+        step = 2**self.num_downsample
+        h_ = self.size[0] / step
+        w_ = self.size[1] / step
+        label_batch = label_batch.astype('float32', copy=False)
+
+        # -------------------- feature cell of all plates -------------------- #
+        L_x = label_batch[:, :, 7]  # (bs, obj)
+        L_y = label_batch[:, :, 8]
+        h_f = nd.clip(nd.floor(L_y / step), 0, h_ - 1)
+        w_f = nd.clip(nd.floor(L_x / step), 0, w_ - 1)
+        cell = h_f * w_ + w_f
+
+        # -------------------- drop invalid and overwritten labels -------------------- #
+        valid = label_batch[:, :, 0] >= 0  # (bs, obj)
+        same = nd.broadcast_equal(cell.expand_dims(2), cell.expand_dims(1))
+        later = nd.array(np.triu(np.ones((1, num_obj, num_obj)), 1), ctx=ctx)
+        overwritten = nd.sum(same * later * valid.expand_dims(1), axis=-1) > 0
+        keep = (valid * (1 - overwritten)).expand_dims(2)  # (bs, obj, 1)
+
+        # -------------------- targets of all plates -------------------- #
+        t_XYZ = label_batch.slice_axis(axis=-1, begin=1, end=4) / 1000.
+
+        r_max = nd.array(self.LP_r_max, ctx=ctx).reshape((1, 1, 3)) * math.pi / 180.
+        sigmoid_r = label_batch.slice_axis(axis=-1, begin=4, end=7) / r_max / 2. + 0.5
+        t_r = yolo_gluon.nd_inv_sigmoid(sigmoid_r)
+
+        LP_class = nd.one_hot(label_batch[:, :, 9], self.LP_num_class)
+
+        target = nd.concat(keep, t_XYZ, t_r, LP_class, dim=-1)
+        # invalid labels are -1, their t_r can be nan, and nan * 0 is nan
+        target = nd.where(
+            nd.broadcast_like(keep, target) > 0, target, nd.zeros_like(target))
+
+        # -------------------- scatter to cells -------------------- #
+        one_hot = nd.one_hot(cell, h_ * w_) * keep  # (bs, obj, h_*w_)
+        target = nd.batch_dot(one_hot, target, transpose_a=True)  # (bs, h_*w_, 7+cls)
+        target = target.reshape((bs, h_, w_, -1))
+
+        score = target.slice_axis(axis=-1, begin=0, end=1)
+        pose_xy = target.slice_axis(axis=-1, begin=1, end=3)
+        pose_z = target.slice_axis(axis=-1, begin=3, end=4)
+        pose_r = target.slice_axis(axis=-1, begin=4, end=7)
+        LP_class = target.slice_axis(axis=-1, begin=7, end=None)
+        mask = score.copy()
+
+        return [score, pose_xy, pose_z, pose_r, LP_class], mask
+
+    def _loss_mask_LP_per_object(self, label_batch, gpu_index):
+        """Reference implementation of _loss_mask_LP, one _find_best_LP
+        per plate. Only used by benchmark_loss_mask_LP, where class can
+        differ if two plates share a cell (see _loss_mask_LP).
         """
         bs = label_batch.shape[0]
         ctx = self.ctx[gpu_index]
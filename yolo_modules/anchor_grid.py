@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+import os
+import threading
+
+import numpy
+from mxnet import nd
+
+from yolo_modules import global_variable
+
+_anchor_grids = {}
+_anchor_grids_lock = threading.Lock()
+
+
+def pyramid_steps(num_downsample, num_pyramid_layers):
+    '''
+    Parameter:
+    ----------
+    num_downsample: int
+      len(spec['layers'])
+    num_pyramid_layers: int
+      len(spec['all_anchors'])
+
+    Returns
+    ----------
+    steps: list of int
+      stride of each pyramid layer, ex: [16, 32, 64]
+    '''
+    pyramid_start = num_downsample - num_pyramid_layers + 1
+    return [2**(pyramid_start+i) for i in range(num_pyramid_layers)]
+
+
+def get_anchor_grid(spec_path, size, all_anchors, steps):
+    '''
+    memoized AnchorGrid, cached as .npz next to spec.yaml
+
+    Parameter:
+    ----------
+    spec_path: string
+      path of spec.yaml
+    size: list of int
+      [h, w]
+    all_anchors: list or np.array
+      (num_pyramid_layers, num_anchors, 2), anchor [h, w] in 0~1
+    steps: list of int
+      stride of each pyramid layer
+
+    Returns
+    ----------
+    grid: AnchorGrid
+      the same object for the same spec, size and anchors
+    '''
+    all_anchors = numpy.array(all_anchors, dtype=numpy.float32)
+    key = (os.path.abspath(spec_path), tuple(size), tuple(steps),
+           all_anchors.tobytes())
+
+    with _anchor_grids_lock:
+        if key not in _anchor_grids:
+            path = os.path.join(
+                os.path.dirname(spec_path),
+                'anchor_grid_%dx%d.npz' % (size[0], size[1]))
+            _anchor_grids[key] = AnchorGrid(size, all_anchors, steps, path=path)
+
+    return _anchor_grids[key]
+
+
+class AnchorGrid(object):
+    '''
+    Priors of all anchor slots. Slot order is (pyramid layer, pixel, anchor),
+    the same as the network output after merge_and_slice.
+    numpy arrays are loaded from (or built and saved to) self.path at the
+    first get(), NDArrays are memoized per (ctx, dtype).
+    '''
+    def __init__(self, size, all_anchors, steps, path=None):
+        self.size = [int(size[0]), int(size[1])]
+        self.all_anchors = numpy.array(all_anchors, dtype=numpy.float32)
+        self.steps = [int(step) for step in steps]
+        self.area = [int(self.size[0]*self.size[1]/step**2) for step in self.steps]
+        self.num_anchors = len(self.all_anchors[0])
+        self.path = path
+
+        self._np_grid = None
+        self._nd_grid = {}
+        self._lock = threading.Lock()
+
+    def get(self, ctx, dtype='float32'):
+        '''
+        Returns
+        ----------
+        grid: dict of mxnet.ndarray
+          s, y, x: (1, sum(area), n, 1), stride and top-left of the pixel
+          h, w: (1, sum(area), n, 1), anchor size (0~1)
+          ltrb: (sum(area), n, 4), default boxes (0~1)
+          prior: (sum(area)*n, 5), [center_y, center_x, step, anchor_h, anchor_w]
+          anchors: (num_pyramid_layers, n, 2)
+        '''
+        key = (ctx, numpy.dtype(dtype).name)
+        with self._lock:
+            if key not in self._nd_grid:
+                np_grid = self._numpy_grid()
+                self._nd_grid[key] = dict(
+                    [(k, nd.array(v, ctx=ctx, dtype=dtype))
+                     for k, v in np_grid.items()])
+
+        return self._nd_grid[key]
+
+    def _numpy_grid(self):
+        if self._np_grid is None:
+            self._np_grid = self._load()
+
+        if self._np_grid is None:
+            self._np_grid = self._build()
+            self._save(self._np_grid)
+
+        a = sum(self.area)
+        n = self.num_anchors
+        grid = dict(self._np_grid)
+        for k in ['s', 'y', 'x', 'h', 'w']:
+            grid[k] = grid[k].reshape((1, a, n, 1))
+
+        cy = (grid['ltrb'][:, :, 1] + grid['ltrb'][:, :, 3]).reshape(-1) / 2
+        cx = (grid['ltrb'][:, :, 0] + grid['ltrb'][:, :, 2]).reshape(-1) / 2
+        grid['prior'] = numpy.stack([
+            cy, cx,
+            grid['s'].reshape(-1),
+            grid['h'].reshape(-1),
+            grid['w'].reshape(-1)], axis=-1)
+        grid['anchors'] = self.all_anchors
+
+        return grid
+
+    def _build(self):
+        n = self.num_anchors
+        h_img, w_img = self.size
+        grid = {'s': [], 'y': [], 'x': [], 'h': [], 'w': [], 'ltrb': []}
+
+        for i, anchors in enumerate(self.all_anchors):  # [12*16,6*8,3*4]
+            step = self.steps[i]
+            row, col, anc = numpy.meshgrid(
+                numpy.arange(h_img // step),
+                numpy.arange(w_img // step),
+                numpy.arange(n), indexing='ij')
+
+            row = row.reshape((-1, n))
+            col = col.reshape((-1, n))
+            h = anchors[anc.reshape((-1, n)), 0]
+            w = anchors[anc.reshape((-1, n)), 1]
+
+            cy = (row + 0.5) * step / float(h_img)
+            cx = (col + 0.5) * step / float(w_img)
+
+            grid['s'].append(numpy.ones_like(h) * step)
+            grid['y'].append(row * step)
+            grid['x'].append(col * step)
+            grid['h'].append(h)
+            grid['w'].append(w)
+            grid['ltrb'].append(numpy.stack(
+                [cx - 0.5*w, cy - 0.5*h, cx + 0.5*w, cy + 0.5*h], axis=-1))
+
+        for k in grid:
+            grid[k] = numpy.concatenate(grid[k], axis=0).astype(numpy.float32)
+
+        return grid
+
+    def _load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return None
+
+        try:
+            with numpy.load(self.path) as f:
+                if list(f['size']) != self.size or \
+                   list(f['steps']) != self.steps or \
+                   not numpy.array_equal(f['all_anchors'], self.all_anchors):
+                    print(global_variable.yellow)
+                    print('anchor grid %s is outdated, rebuild' % self.path)
+                    print(global_variable.reset_color)
+                    return None
+
+                return dict([(k, f[k]) for k in ['s', 'y', 'x', 'h', 'w', 'ltrb']])
+
+        except Exception as e:
+            print(global_variable.red)
+            print('Load anchor grid %s failed, rebuild' % self.path)
+            print(e)
+            print(global_variable.reset_color)
+            return None
+
+    def _save(self, grid):
+        if self.path is None:
+            return
+
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                numpy.savez(
+                    f, size=self.size, steps=self.steps,
+                    all_anchors=self.all_anchors, **grid)
+            os.rename(tmp_path, self.path)
+
+        except (IOError, OSError) as e:
+            print(global_variable.yellow)
+            print('Save anchor grid %s failed' % self.path)
+            print(e)
+            print(global_variable.reset_color)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+class BatchQueue(object):
+    '''
+    Bounded producer/consumer queue of rendered batches.
+    Any number of render threads put(), the training thread get().
+    After close(), put() returns False and get() returns None once
+    the queue is drained, so both sides can leave their loops.
+    '''
+    def __init__(self, maxsize=4, poll=0.1):
+        '''
+        Parameter:
+        ----------
+        maxsize: int
+          max number of batches in flight
+        poll: float
+          seconds between checks of close() while blocked
+        '''
+        self.maxsize = maxsize
+        self.poll = poll
+
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._closed = threading.Event()
+        self._lock = threading.Lock()
+
+        self.put_count = 0
+        self.get_count = 0
+        self.put_stall = 0.  # seconds producers wait for a free slot
+        self.get_stall = 0.  # seconds the consumer waits for a batch
+
+    @property
+    def closed(self):
+        return self._closed.is_set()
+
+    def close(self):
+        self._closed.set()
+
+    def put(self, batch):
+        '''
+        Returns
+        ----------
+        ok: bool
+          False if the queue is closed, the batch is dropped
+        '''
+        t = time.time()
+        while not self.closed:
+            try:
+                self._queue.put(batch, timeout=self.poll)
+
+            except queue.Full:
+                continue
+
+            with self._lock:
+                self.put_count += 1
+                self.put_stall += time.time() - t
+            return True
+
+        return False
+
+    def get(self):
+        '''
+        Returns
+        ----------
+        batch: object
+          None if the queue is closed and empty
+        '''
+        t = time.time()
+        while True:
+            try:
+                batch = self._queue.get(timeout=self.poll)
+
+            except queue.Empty:
+                if self.closed:
+                    return None
+                continue
+
+            with self._lock:
+                self.get_count += 1
+                self.get_stall += time.time() - t
+            return batch
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        '''
+        Returns
+        ----------
+        stats: dict
+          depth, put/get count and mean put/get stall in second
+        '''
+        with self._lock:
+            return {
+                'depth': self.depth(),
+                'put_count': self.put_count,
+                'get_count': self.get_count,
+                'put_stall': self.put_stall / max(self.put_count, 1),
+                'get_stall': self.get_stall / max(self.get_count, 1)}
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+import collections
+import os
+import threading
+
+import numpy
+import mxnet
+
+from yolo_modules import global_variable
+from yolo_modules import model_bundle
+
+
+class ExecutorCache(object):
+    '''
+    Executors of one exported network keyed by (batch, h, w, dtype).
+    The parameters are loaded once, from the model bundle if there is one
+    (memory-mapped, the first shape of a dtype binds on them), else from
+    the checkpoint (the first shape of a dtype is bound with simple_bind
+    and copy_params_from). Every other shape is bound on the parameter arrays
+    of that base executor with its own input, internal and output memory,
+    so all of them share one set of parameters, a new shape costs a bind,
+    not a reload and copy, and a forward of one shape never touches the
+    outputs of another. Least recently used shapes are evicted when there
+    are more than capacity, the base executors never are.
+    '''
+    def __init__(self, export_folder, ctx, step=0, capacity=8, warm=None):
+        '''
+        Parameter:
+        ----------
+        export_folder: string
+          folder of export-symbol.json, export-%04d.params and the bundle
+        ctx: mxnet.gpu/cpu
+        capacity: int
+          max number of executors, base executors included
+        warm: list of tuple
+          (batch, h, w) or (batch, h, w, dtype) bound at startup
+        '''
+        print('checkpoint folder: %s' % export_folder)
+        self.bundle = model_bundle.find_bundle(export_folder, step)
+        if self.bundle is not None:
+            # memory-mapped params, no load_checkpoint and copy_params_from
+            print('load bundle: %s' % self.bundle.path)
+            self.sym = self.bundle.symbol()
+            self.arg_params, self.aux_params = self.bundle.params(ctx)
+        else:
+            self.sym, self.arg_params, self.aux_params = mxnet.model.load_checkpoint(
+                os.path.join(export_folder, 'export'), step)
+
+        self.ctx = ctx
+        self.capacity = capacity
+
+        self._lock = threading.Lock()
+        self._base = {}  # dtype: executor
+        self._cache = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        for shape in warm or []:
+            self.get(*shape)
+
+    def get(self, batch, h, w, dtype=numpy.float32):
+        '''
+        Returns
+        ----------
+        executor: mxnet.executor.Executor
+          data shape is (batch, 3, h, w). Executors of one dtype share
+          the parameter arrays and nothing else, a forward of one leaves
+          the outputs of the others as they are.
+        '''
+        key = (batch, h, w, numpy.dtype(dtype).name)
+        with self._lock:
+            if key in self._cache:
+                self.hits += 1
+                executor = self._cache.pop(key)
+                self._cache[key] = executor  # most recently used
+                return executor
+
+            self.misses += 1
+            executor = self._bind(key)
+            self._cache[key] = executor
+            self._evict()
+            return executor
+
+    def warm(self, shapes):
+        for shape in shapes:
+            self.get(*shape)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._cache),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'shapes': list(self._cache.keys())}
+
+    def _bind(self, key):
+        batch, h, w, dtype = key
+        shape = (batch, 3, h, w)
+
+        if dtype not in self._base and self.bundle is not None:
+            # same as ModelBundle.bind, on the arrays loaded once
+            args = dict(self.arg_params)
+            args['data'] = mxnet.nd.zeros(shape, ctx=self.ctx, dtype=dtype)
+            aux = dict([(k, self.aux_params[k])
+                        for k in self.sym.list_auxiliary_states()])
+            executor = self.sym.bind(
+                self.ctx, args, aux_states=aux, grad_req='null')
+            self._base[dtype] = executor
+            return executor
+
+        if dtype not in self._base:
+            executor = self.sym.simple_bind(
+                ctx=self.ctx,
+                data=shape,
+                type_dict={'data': numpy.dtype(dtype)},
+                grad_req='null',
+                force_rebind=True)
+            executor.copy_params_from(self.arg_params, self.aux_params)
+            self._base[dtype] = executor
+            return executor
+
+        # parameters of the base, a new data array and new internal and
+        # output memory, reshape() would share those with the base
+        base = self._base[dtype]
+        args = dict(base.arg_dict)
+        args['data'] = mxnet.nd.zeros(shape, ctx=self.ctx, dtype=dtype)
+        return self.sym.bind(
+            self.ctx, args, aux_states=base.aux_dict, grad_req='null')
+
+    def _evict(self):
+        bases = set(id(e) for e in self._base.values())
+        for key in list(self._cache.keys()):
+            if len(self._cache) <= self.capacity:
+                break
+            if id(self._cache[key]) in bases:
+                continue
+
+            del self._cache[key]
+            self.evictions += 1
+
+        if len(self._cache) > self.capacity:
+            print(global_variable.yellow)
+            print('executor cache: %d base executors > capacity %d' % (
+                len(self._base), self.capacity))
+            print(global_variable.reset_color)
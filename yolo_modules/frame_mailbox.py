@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+import threading
+import time
+
+
+class FrameMailbox(object):
+    '''
+    Holds only the latest frame of a camera, with its sequence number and
+    capture stamp. The capture side put()s every frame, the inference side
+    get()s and blocks until a frame newer than the last one it took
+    arrives, so the same image is never inferred twice and nobody has to
+    sleep-poll.
+
+    dropped: frames overwritten before anyone took them, or too old
+    duplicates: put() of the same source frame twice
+    '''
+    def __init__(self, max_age=None):
+        '''
+        Parameter:
+        ----------
+        max_age: float
+          seconds, get() skips a frame that waited longer than this,
+          None or <= 0 to keep frames of any age
+        '''
+        self.max_age = max_age if max_age and max_age > 0 else None
+
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self._frame = None
+        self._seq = -1
+        self._stamp = None
+        self._source_seq = None
+        self._put_time = None
+        self._taken = True
+
+        self.put_count = 0
+        self.get_count = 0
+        self.dropped = 0
+        self.duplicates = 0
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def put(self, frame, stamp=None, source_seq=None, block=False):
+        '''
+        Parameter:
+        ----------
+        frame: object
+          ex: np.array cv2 image
+        stamp: object
+          capture time from the source, ex: ros header stamp,
+          passed through to get()
+        source_seq: int
+          sequence number from the source, ex: ros header seq, a frame
+          with the same source_seq as the current one is a duplicate.
+          The mailbox numbers frames by itself, a source that restarts
+          from 0 is fine.
+        block: bool
+          wait until the current frame is taken instead of dropping it,
+          for a source that must not lose frames, ex: a benchmark video
+
+        Returns
+        ----------
+        seq: int
+          mailbox sequence number of the frame, None if it is a duplicate
+        '''
+        with self._cond:
+            if source_seq is not None and source_seq == self._source_seq:
+                self.duplicates += 1
+                return None
+
+            while block and not self._taken and not self._closed:
+                self._cond.wait(0.1)
+
+            if not self._taken:
+                self.dropped += 1
+
+            self._seq += 1
+            self._frame = frame
+            self._stamp = stamp
+            self._source_seq = source_seq
+            self._put_time = time.time()
+            self._taken = False
+
+            self.put_count += 1
+            self._cond.notify_all()
+            return self._seq
+
+    def get(self, last_seq=-1, timeout=None):
+        '''
+        Parameter:
+        ----------
+        last_seq: int
+          mailbox seq of the frame the caller took last time
+        timeout: float
+          seconds to wait, None to wait until a frame or close()
+
+        Returns
+        ----------
+        frame, seq, stamp: tuple
+          seq is the mailbox sequence number, None if timeout or closed
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while not self._closed:
+                if self._seq > last_seq and not self._taken:
+                    if self.max_age is None or \
+                       time.time() - self._put_time <= self.max_age:
+                        self._taken = True
+                        self.get_count += 1
+                        self._cond.notify_all()  # wake a blocked put()
+                        return self._frame, self._seq, self._stamp
+
+                    # too old, wait for the next one
+                    self._taken = True
+                    self.dropped += 1
+                    self._cond.notify_all()
+
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    self._cond.wait(remaining)
+
+            return None
+
+    def stats(self):
+        '''
+        Returns
+        ----------
+        stats: dict
+          put/get count, dropped and duplicate frames
+        '''
+        with self._cond:
+            return {
+                'put_count': self.put_count,
+                'get_count': self.get_count,
+                'dropped': self.dropped,
+                'duplicates': self.duplicates}
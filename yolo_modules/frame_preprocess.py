@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+import time
+
+import cv2
+import numpy
+import mxnet
+from mxnet import nd
+
+from yolo_modules import global_variable
+from yolo_modules import yolo_cv
+from yolo_modules import yolo_gluon
+
+
+class FramePreprocessor(object):
+    '''
+    Camera frame -> network input in one pass and without allocation:
+    clip + flip + resize is one cv2.warpAffine into a preallocated uint8
+    buffer, channel order, HWC->CHW, 1/255 and white balance gains are one
+    numpy.multiply into a preallocated float buffer, then one copy into
+    data, which can be the executor's own input array.
+    '''
+    def __init__(self, size, clip=(1., 1.), flip=3, rgb=False, gains=None,
+                 data=None, ctx=mxnet.cpu()):
+        '''
+        Parameter:
+        ----------
+        size: list of int
+          [h, w] of the network input
+        clip: tuple of float
+          (h_clip_ratio, w_clip_ratio), same as yolo_cv.cv2_flip_and_clip_frame
+        flip: int
+          1: left-right, 0: top-down, -1: both, others: no flip
+        rgb: bool
+          swap the cv2 bgr frame to rgb, the current models are trained
+          with bgr, keep it False for them
+        gains: list of float
+          per-channel gains of the output channel order,
+          same as yolo_cv.nd_white_balance
+        data: mxnet.ndarray or np.array
+          (1, 3, h, w) array to write into, ex: executor.arg_dict['data']
+          or InferenceBackend.data, allocated on ctx if None
+        '''
+        assert type(clip) == tuple and len(clip) == 2, (
+            global_variable.red +
+            'clip should be a tuple, (height_ratio, width_ratio')
+
+        self.size = size
+        self.clip = clip
+        self.flip = flip
+
+        h, w = size
+        if data is None:
+            data = nd.zeros((1, 3, h, w), ctx=ctx)
+        assert data.shape == (1, 3, h, w), (
+            global_variable.red + 'data shape should be (1, 3, h, w)')
+        self.data = data
+
+        gains = (1., 1., 1.) if gains is None else gains
+        self.scale = numpy.array(gains, dtype=numpy.float32) / 255.
+        self.scale = self.scale.reshape((3, 1, 1))
+        # a slice keeps chw a view, a list of channels would copy it
+        self._channel_slice = slice(None, None, -1) if rgb else slice(None)
+
+        self.resized = numpy.zeros((h, w, 3), dtype=numpy.uint8)
+        self.chw = numpy.zeros((3, h, w), dtype=data.dtype)
+        self._matrix = {}
+
+    def matrix(self, shape):
+        '''
+        Inverse affine map from a network pixel to a frame pixel,
+        pixel centers are aligned the same way as cv2.resize.
+
+        Parameter:
+        ----------
+        shape: tuple
+          frame shape, (H, W, 3)
+
+        Returns
+        ----------
+        M: np.array
+          (2, 3) float32, for cv2.WARP_INVERSE_MAP
+        '''
+        if shape in self._matrix:
+            return self._matrix[shape]
+
+        H, W = shape[:2]
+        h, w = self.size
+        top = int((1-self.clip[0]) * H / 2.) if self.clip[0] < 1 else 0
+        left = int((1-self.clip[1]) * W / 2.) if self.clip[1] < 1 else 0
+        ch, cw = H - 2 * top, W - 2 * left
+
+        sy, sx = ch / float(h), cw / float(w)
+        ay, by = sy, 0.5 * sy - 0.5 + top
+        ax, bx = sx, 0.5 * sx - 0.5 + left
+
+        if self.flip == 1 or self.flip == -1:
+            ax, bx = -sx, cw - 1 - (0.5 * sx - 0.5) + left
+
+        if self.flip == 0 or self.flip == -1:
+            ay, by = -sy, ch - 1 - (0.5 * sy - 0.5) + top
+
+        M = numpy.array([[ax, 0, bx], [0, ay, by]], dtype=numpy.float32)
+        self._matrix[shape] = M
+        return M
+
+    def __call__(self, frame):
+        '''
+        Parameter:
+        ----------
+        frame: np.array
+          (H, W, 3) uint8 cv2 image, any size
+
+        Returns
+        ----------
+        data: mxnet.ndarray or np.array
+          (1, 3, h, w), the same array every call
+        '''
+        return self.load(self.warp(frame, out=self.resized))
+
+    def warp(self, frame, out=None):
+        '''
+        clip + flip + resize only, a pipeline can do this in another
+        thread than load()
+
+        Returns
+        ----------
+        resized: np.array
+          (h, w, 3) uint8, out or a new array
+        '''
+        h, w = self.size
+        return cv2.warpAffine(
+            frame, self.matrix(frame.shape), (w, h), dst=out,
+            flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+            borderMode=cv2.BORDER_REPLICATE)
+
+    def load(self, resized, data=None):
+        '''
+        channel order, HWC->CHW, 1/255 and gains into data
+
+        Parameter:
+        ----------
+        resized: np.array
+          (h, w, 3) uint8 from warp()
+        data: mxnet.ndarray or np.array
+          (1, 3, h, w) to write into instead of self.data,
+          ex: the free buffer of a ping-pong backend
+        '''
+        data = self.data if data is None else data
+        chw = resized.transpose((2, 0, 1))[self._channel_slice]
+        numpy.multiply(chw, self.scale, out=self.chw, casting='unsafe')
+        data[0] = self.chw
+
+        return data
+
+
+def benchmark_preprocess(size, inputs=((480, 640), (720, 1280)),
+                         clip=(0.8, 0.9), flip=1, cycles=200,
+                         ctx=mxnet.cpu()):
+    '''
+    Compare FramePreprocessor with the old chain, cv2_flip_and_clip_frame
+    -> cv2.resize -> cv_img_2_ndarray -> nd_white_balance.
+    Prints ms/frame of both and the max difference.
+    '''
+    gains = (1.0, 0.9, 1.1)
+    print(global_variable.yellow)
+    for H, W in inputs:
+        frame = numpy.random.randint(0, 256, (H, W, 3)).astype(numpy.uint8)
+        h, w = size
+
+        def chain():
+            img = yolo_cv.cv2_flip_and_clip_frame(frame, clip, flip)
+            img = cv2.resize(img, (w, h))
+            nd_img = yolo_gluon.cv_img_2_ndarray(img, ctx)
+            return yolo_cv.nd_white_balance(nd_img, bgr=gains)
+
+        fused = FramePreprocessor(size, clip=clip, flip=flip, gains=gains, ctx=ctx)
+
+        for name, fn in [('chain', chain), ('fused', lambda: fused(frame))]:
+            fn().wait_to_read()  # warm up
+            t = time.time()
+            for _ in range(cycles):
+                out = fn()
+            out.wait_to_read()
+            print('%dx%d %s: %.3f ms/frame' % (
+                W, H, name, (time.time() - t) * 1000 / cycles))
+
+        diff = nd.abs(chain() - fused(frame)).max().asscalar() * 255
+        print('%dx%d max diff: %.2f gray level' % (W, H, diff))
+
+    print(global_variable.reset_color)
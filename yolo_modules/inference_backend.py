@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+import os
+import time
+
+import numpy
+import mxnet
+from mxnet import nd
+
+from yolo_modules import global_variable
+
+available_backends = ['mxnet', 'onnx', 'trt']
+
+
+def backend_name(args):
+    '''
+    --trt 1 is kept as a shortcut of --backend trt
+    '''
+    return 'trt' if args.trt else args.backend
+
+
+def get_backend(name, export_folder, size, ctx, output_shapes=None,
+                fp16=False, threads=0, buffers=1):
+    '''
+    Parameter:
+    ----------
+    name: string
+      'mxnet', 'onnx' or 'trt'
+    export_folder: string
+      folder of export-symbol.json and onnx/out.onnx
+    size: list of int
+      [h, w] of the input
+    ctx: mxnet.gpu/cpu
+      where the outputs are, and the executor for mxnet
+    output_shapes: list of tuple
+      from the spec, ex: YOLO.output_shapes(), TensorRT returns flat
+      arrays and needs them
+    threads: int
+      intra-op threads of onnxruntime, 0: one per physical core
+    buffers: int
+      input/output buffers of mxnet used in turn, 2: ping-pong, the next
+      frame is loaded while the forward of this one is still running
+
+    Returns
+    ----------
+    backend: InferenceBackend
+    '''
+    assert name in available_backends, (
+        global_variable.red + 'backend should be one of %s' % available_backends)
+
+    if name == 'mxnet':
+        return MXNetBackend(export_folder, size, ctx, fp16=fp16, buffers=buffers)
+    elif name == 'onnx':
+        return OnnxBackend(export_folder, size, ctx, threads=threads)
+    else:
+        return TensorRTBackend(export_folder, size, ctx, output_shapes)
+
+
+class InferenceBackend(object):
+    '''
+    One network, whatever runs it.
+    self.data is the (1, 3, h, w) input, FramePreprocessor can write
+    into it directly, forward() runs on it and returns the outputs as
+    a list of mxnet.ndarray on ctx, the same for every backend.
+    Only mxnet can return before the outputs are ready, the others
+    ignore wait.
+    '''
+    name = None
+    main_thread = False  # True: forward only works in the main thread
+
+    def infer(self, batch):
+        '''
+        Parameter:
+        ----------
+        batch: np.array or mxnet.ndarray
+          (1, 3, h, w), already scaled to 0~1
+
+        Returns
+        ----------
+        outputs: list of mxnet.ndarray
+          copies, the next forward does not overwrite them
+        '''
+        if isinstance(self.data, numpy.ndarray) and isinstance(batch, nd.NDArray):
+            batch = batch.asnumpy()
+        self.data[:] = batch
+        return self.forward()
+
+    def forward(self, wait=True):
+        raise NotImplementedError
+
+
+class MXNetBackend(InferenceBackend):
+    '''
+    With buffers > 1, executors bound on the same parameters but with
+    their own input, output and workspace are used in turn, so loading
+    frame N+1 does not wait for the forward of frame N to read its input.
+    '''
+    name = 'mxnet'
+
+    def __init__(self, export_folder, size, ctx, fp16=False, buffers=1):
+        from yolo_modules import yolo_gluon
+        self.executor = yolo_gluon.init_executor(export_folder, size, ctx, fp16=fp16)
+        self.executors = [self.executor]
+
+        if buffers > 1:
+            sym = mxnet.sym.load(os.path.join(export_folder, 'export-symbol.json'))
+            for _ in range(buffers - 1):
+                args = dict(self.executor.arg_dict)
+                args['data'] = nd.zeros_like(args['data'])
+                self.executors.append(sym.bind(
+                    ctx, args, aux_states=self.executor.aux_dict, grad_req='null'))
+
+        self._next = 0
+
+    @property
+    def data(self):
+        # input of the executor the next forward runs on
+        return self.executors[self._next].arg_dict['data']
+
+    def forward(self, wait=True):
+        '''
+        Parameter:
+        ----------
+        wait: bool
+          False: return right after the forward is pushed to the mxnet
+          engine, asnumpy()/wait_to_read() of the outputs blocks instead
+        '''
+        executor = self.executors[self._next]
+        self._next = (self._next + 1) % len(self.executors)
+
+        outputs = executor.forward(is_train=False)
+        # copies are pushed after the forward, the next forward of this
+        # executor can not overwrite them
+        outputs = [out.copy() for out in outputs]
+        if wait:
+            outputs[0].wait_to_read()
+        return outputs
+
+
+class OnnxBackend(InferenceBackend):
+    '''
+    onnxruntime on CPU with all graph optimizations (constant folding,
+    conv+bn+relu fusion, layout transforms), sequential execution and
+    intra-op threads only, one frame at a time does not need more.
+    '''
+    name = 'onnx'
+
+    def __init__(self, export_folder, size, ctx, threads=0):
+        import onnxruntime
+
+        onnx_file = os.path.join(export_folder, 'onnx', 'out.onnx')
+        assert os.path.exists(onnx_file), (
+            global_variable.red + '%s not found, export with onnx first' % onnx_file)
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = \
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+
+        print('onnxruntime: %s, %s threads' % (onnx_file, threads or 'auto'))
+        self.session = onnxruntime.InferenceSession(
+            onnx_file, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_names = [o.name for o in self.session.get_outputs()]
+
+        self.ctx = ctx
+        self.data = numpy.zeros((1, 3, size[0], size[1]), dtype=numpy.float32)
+
+    def forward(self, wait=True):
+        outputs = self.session.run(self.output_names, {self.input_name: self.data})
+        return [nd.array(out, ctx=self.ctx) for out in outputs]
+
+
+class TensorRTBackend(InferenceBackend):
+    '''
+    TensorRT engine built from (or cached next to) onnx/out.onnx.
+    self.data is the page-locked host input buffer itself.
+    '''
+    name = 'trt'
+    main_thread = True
+
+    def __init__(self, export_folder, size, ctx, output_shapes):
+        from yolo_modules import tensorrt_module
+
+        assert output_shapes is not None, (
+            global_variable.red + 'TensorRT backend needs output_shapes')
+
+        onnx_folder = os.path.join(export_folder, 'onnx')
+        engine = tensorrt_module.get_engine(
+            os.path.join(onnx_folder, 'out.onnx'),
+            os.path.join(onnx_folder, 'out.trt'))
+
+        self.do_inference = tensorrt_module.do_inference
+        self.context = engine.create_execution_context()
+        self.inputs, self.outputs, self.bindings, self.stream = \
+            tensorrt_module.allocate_buffers(engine)
+
+        shape = (1, 3, size[0], size[1])
+        self.data = self.inputs[0].host[:int(numpy.prod(shape))].reshape(shape)
+        self.output_shapes = output_shapes
+        self.ctx = ctx
+
+    def forward(self, wait=True):
+        outputs = self.do_inference(
+            self.context, bindings=self.bindings, inputs=self.inputs,
+            outputs=self.outputs, stream=self.stream)
+
+        return [nd.array(out[:int(numpy.prod(shape))].reshape(shape), ctx=self.ctx)
+                for out, shape in zip(outputs, self.output_shapes)]
+
+
+def benchmark_backends(export_folder, size, output_shapes=None, names=('mxnet', 'onnx'),
+                       cycles=100, threads=0, fp16=False):
+    '''
+    Latency of every backend on the same random inputs on CPU, and the
+    max output difference against the first backend that loads.
+    Backends that can not load, ex: onnxruntime not installed, are skipped.
+    '''
+    ctx = mxnet.cpu()
+    h, w = size
+    inputs = [numpy.random.rand(1, 3, h, w).astype(numpy.float32) for _ in range(4)]
+
+    print(global_variable.yellow)
+    reference = None
+    for name in names:
+        try:
+            backend = get_backend(
+                name, export_folder, size, ctx, output_shapes=output_shapes,
+                fp16=fp16, threads=threads)
+        except Exception as e:
+            print('%-6s skipped: %s' % (name, e))
+            continue
+
+        outputs = backend.infer(inputs[0])  # warm up
+        latency = []
+        for i in range(cycles):
+            t = time.time()
+            backend.infer(inputs[i % len(inputs)])
+            latency.append(time.time() - t)
+
+        latency = numpy.array(latency) * 1000
+        line = '%-6s p50 %7.2f ms, p90 %7.2f ms, p99 %7.2f ms' % (
+            name, numpy.percentile(latency, 50), numpy.percentile(latency, 90),
+            numpy.percentile(latency, 99))
+
+        outputs = [out.asnumpy() for out in outputs]
+        if reference is None:
+            reference = outputs
+        else:
+            diff = max([numpy.abs(a - b).max() for a, b in zip(reference, outputs)])
+            line += ', max diff %.2e' % diff
+
+        print(line)
+
+    print(global_variable.reset_color)
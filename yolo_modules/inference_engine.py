@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import numpy
+import mxnet
+from mxnet import nd
+
+from yolo_modules import global_variable
+from yolo_modules.executor_cache import ExecutorCache
+
+
+class InferenceRequest(object):
+    '''
+    One frame submitted to InferenceEngine, wait() for its outputs.
+    '''
+    def __init__(self, frame, source=None, stamp=None, callback=None):
+        self.frame = frame
+        self.source = source
+        self.stamp = stamp  # capture time from the source, passed through
+        self.callback = callback
+
+        self.submit_time = time.time()
+        self.done_time = None
+        self.batch_size = None
+        self.outputs = None
+        self.error = None  # exception of the forward of its batch
+        self._done = threading.Event()
+
+    def wait(self, timeout=None):
+        '''
+        Returns
+        ----------
+        outputs: list of mxnet.ndarray
+          same as executor.outputs, batch size 1, None if timeout
+
+        Raises the exception of the forward if the batch failed.
+        '''
+        self._done.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.outputs
+
+    @property
+    def latency(self):
+        return self.done_time - self.submit_time
+
+
+class InferenceEngine(object):
+    '''
+    Collect frames from any number of sources into batches of up to
+    max_batch, or whatever arrived within max_latency, and run them
+    through executors bound per batch-size bucket. The buckets come from
+    an ExecutorCache, so all of them share one set of parameters.
+    A library for now, benchmark_engine (car/YOLO.py benchmark_engine)
+    is its only caller, the video nodes still run one camera each.
+    '''
+    def __init__(self, export_folder, size, ctx, max_batch=8,
+                 max_latency=0.005, fp16=False, step=0, cache=None, warm=None):
+        '''
+        Parameter:
+        ----------
+        export_folder: string
+          folder of export-symbol.json, export-%04d.params
+        size: list of int
+          [h, w] of the network input
+        ctx: mxnet.gpu/cpu
+        max_batch: int
+          largest batch, buckets are 1, 2, 4 ... max_batch
+        max_latency: float
+          seconds the first frame of a batch waits for more frames
+        cache: executor_cache.ExecutorCache
+          share executors and parameters with other engines, ex: one
+          engine per resolution, a new cache of export_folder if None
+        warm: list of tuple
+          (batch, h, w) bound in a new cache at startup besides the
+          buckets, ex: other resolutions, see --warm_shapes
+        '''
+        self.size = size
+        self.ctx = ctx
+        self.max_latency = max_latency
+        self.dtype = numpy.float16 if fp16 else numpy.float32
+
+        self.buckets = [1]
+        while self.buckets[-1] < max_batch:
+            self.buckets.append(min(self.buckets[-1] * 2, max_batch))
+        self.max_batch = self.buckets[-1]
+
+        if cache is None:
+            warm = [tuple(shape) + (self.dtype,) for shape in warm or []]
+            cache = ExecutorCache(
+                export_folder, ctx, step,
+                capacity=len(self.buckets) + len(warm), warm=warm)
+        self.cache = cache
+        self.executors = self._bind()
+
+        self.num_batches = 0
+        self.num_frames = 0
+
+        self._queue = queue.Queue()
+        self._shutdown = False
+        self._lock = threading.Lock()  # no submit after close drains
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _bind(self):
+        # the first bucket loads the parameters, the others bind on them
+        h, w = self.size
+        return dict([(bs, self.cache.get(bs, h, w, self.dtype))
+                     for bs in reversed(self.buckets)])
+
+    def submit(self, frame, source=None, stamp=None, callback=None):
+        '''
+        Parameter:
+        ----------
+        frame: np.array
+          (h, w, 3) uint8, already resized to size,
+          the same input as yolo_gluon.cv_img_2_ndarray
+        source: object
+          who sent the frame, ex: ros topic
+        stamp: object
+          timestamp of the frame, returned with the result
+        callback: function
+          callback(request), called in the engine thread when done
+
+        Returns
+        ----------
+        request: InferenceRequest
+        '''
+        h, w = self.size
+        assert getattr(frame, 'shape', None) == (h, w, 3), (
+            global_variable.red +
+            'frame shape should be (%d, %d, 3), got %s' % (
+                h, w, getattr(frame, 'shape', type(frame))))
+
+        request = InferenceRequest(frame, source, stamp, callback)
+        with self._lock:
+            assert not self._shutdown, (
+                global_variable.red + 'inference engine is closed')
+            self._queue.put(request)
+        return request
+
+    def close(self):
+        '''
+        Stop the engine thread, requests still in the queue are done
+        with an error, so wait() raises instead of blocking forever.
+        '''
+        with self._lock:
+            self._shutdown = True
+        self._thread.join()
+
+        error = RuntimeError('inference engine closed')
+        while True:
+            try:
+                request = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            request.error = error
+            self._finish(request, time.time())
+
+    def stats(self):
+        return {
+            'batches': self.num_batches,
+            'frames': self.num_frames,
+            'mean_batch': self.num_frames / float(max(self.num_batches, 1))}
+
+    def _loop(self):
+        while not self._shutdown:
+            try:
+                batch = [self._queue.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+
+            deadline = batch[0].submit_time + self.max_latency
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            # take whatever is already waiting, up to max_batch
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self._forward(batch)
+            except Exception as e:
+                # the engine keeps running, wait() of the batch raises e
+                print(global_variable.red)
+                print('inference engine: batch of %d failed, %s' % (len(batch), e))
+                print(global_variable.reset_color)
+                done_time = time.time()
+                for request in batch:
+                    if not request._done.is_set():
+                        request.error = e
+                        self._finish(request, done_time)
+
+    def _finish(self, request, done_time):
+        request.done_time = done_time
+        request._done.set()
+        if request.callback is None:
+            return
+
+        try:
+            request.callback(request)
+        except Exception as e:
+            print(global_variable.red)
+            print('inference engine: callback of %s failed, %s' % (request.source, e))
+            print(global_variable.reset_color)
+
+    def _forward(self, batch):
+        bs = [b for b in self.buckets if b >= len(batch)][0]
+        h, w = self.size
+
+        frames = numpy.zeros((bs, h, w, 3), dtype=numpy.uint8)
+        for i, request in enumerate(batch):
+            frames[i] = request.frame
+
+        data = nd.array(frames, ctx=self.ctx, dtype=numpy.uint8)
+        data = data.transpose((0, 3, 1, 2)).astype(self.dtype) / 255.
+
+        executor = self.executors[bs]
+        executor.forward(is_train=False, data=data)
+        # outputs are overwritten by the next forward of this bucket,
+        # other buckets have their own memory
+        outputs = [out.copy() for out in executor.outputs]
+        outputs[0].wait_to_read()
+
+        self.num_batches += 1
+        self.num_frames += len(batch)
+
+        done_time = time.time()
+        for i, request in enumerate(batch):
+            request.outputs = [out[i:i+1] for out in outputs]
+            request.batch_size = len(batch)
+            self._finish(request, done_time)
+
+
+def benchmark_engine(export_folder, size, ctx=mxnet.cpu(),
+                     streams=(1, 2, 4, 8), duration=10., **kwargs):
+    '''
+    Each stream submits a frame, waits for its result and submits the
+    next one (a camera that drops frames while the net is busy).
+    Prints frames/s and latency of every number of streams.
+    '''
+    h, w = size
+    frame = numpy.random.randint(0, 256, (h, w, 3)).astype(numpy.uint8)
+
+    for num_streams in streams:
+        engine = InferenceEngine(export_folder, size, ctx, **kwargs)
+        latency = [[] for _ in range(num_streams)]
+
+        def stream(i):
+            start = time.time()
+            while time.time() - start < duration:
+                request = engine.submit(frame, source=i)
+                request.wait()
+                latency[i].append(request.latency)
+
+        engine.submit(frame).wait()  # warm up
+        threads = [threading.Thread(target=stream, args=(i,))
+                   for i in range(num_streams)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        engine.close()
+        latency = numpy.concatenate(latency) * 1000
+        print(global_variable.yellow)
+        print('%d streams: %.1f frames/s, latency mean %.1f ms, p90 %.1f ms, mean batch %.2f' % (
+            num_streams, len(latency) / duration,
+            numpy.mean(latency), numpy.percentile(latency, 90),
+            engine.stats()['mean_batch']))
+
+    print(global_variable.reset_color)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+import os
+import threading
+
+import numpy as np
+import PIL
+from PIL import Image
+
+from yolo_modules import yolo_cv
+
+_atlases = {}
+_atlases_lock = threading.Lock()
+
+# plate size (w, h), background, glyph size (w, h) and top, left of every
+# character, index of the dot in x, and whether 4 is left out
+LAYOUTS = {
+    0: {  # ABC-1234
+        'size': (380, 160), 'color': yolo_cv._color[6],
+        'glyph': (45, 90), 'top': 35,
+        'x': [7, 56, 106, 158, 175, 225, 274, 324], 'dot': 3, 'no_four': True},
+    1: {  # AB-1234
+        'size': (320, 150), 'color': yolo_cv._color[7],
+        'glyph': (40, 80), 'top': 40,
+        'x': [7, 57, 109, 130, 177, 223, 269], 'dot': 2, 'no_four': False}}
+
+
+def get_plate_atlas(layout=0):
+    '''
+    memoized PlateAtlas, fonts are read and resized once per process
+
+    Returns
+    ----------
+    atlas: PlateAtlas
+      the same object for every LPGenerator
+    '''
+    with _atlases_lock:
+        if layout not in _atlases:
+            _atlases[layout] = PlateAtlas(layout)
+
+    return _atlases[layout]
+
+
+class PlateAtlas(object):
+    '''
+    Glyphs of one plate layout as one numpy array, and the plate
+    background with the dot already on it, so N plates are N copies of
+    the background plus one fancy-indexed assignment per character slot.
+    The pixels are the same as pasting the PIL glyphs one by one.
+    '''
+    chunk = 4  # plates per assignment
+
+    def __init__(self, layout=0):
+        spec = LAYOUTS[layout]
+        self.layout = layout
+        self.w, self.h = spec['size']
+        self.glyph_w, self.glyph_h = spec['glyph']
+        self.top = spec['top']
+        self.no_four = spec['no_four']
+
+        x = spec['x']
+        dot = spec['dot']
+        self.x = np.array(x[:dot] + x[dot+1:])  # left of every character
+        self.num_letters = dot
+        self.num_digits = len(x) - dot - 1
+
+        fonts_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts')
+
+        # (34, glyph_h, glyph_w, 4) uint8, 0~9 digits, 10~33 letters
+        glyphs = []
+        for font_name in range(0, 34):
+            f = Image.open(os.path.join(fonts_dir, '%d.png' % font_name))
+            f = f.resize(spec['glyph'], PIL.Image.BILINEAR).convert('RGBA')
+            glyphs.append(np.asarray(f))
+        self.glyphs = np.stack(glyphs)
+
+        base = Image.new('RGBA', spec['size'], spec['color'])
+        dot_img = Image.open(os.path.join(fonts_dir, '34.png'))
+        base.paste(dot_img.resize((10, 70), PIL.Image.BILINEAR), (x[dot], 45))
+        self.base = np.asarray(base).copy()
+
+    def random_chars(self, n):
+        '''
+        Returns
+        ----------
+        chars: np.array
+          (n, num_letters+num_digits) int, glyph index of every character
+        '''
+        letters = np.random.randint(10, 34, size=(n, self.num_letters))
+        if self.no_four:
+            digits = np.random.randint(0, 9, size=(n, self.num_digits))
+            digits[digits == 4] = 9
+        else:
+            digits = np.random.randint(0, 10, size=(n, self.num_digits))
+
+        return np.concatenate((letters, digits), axis=1)
+
+    def synthesize(self, n, chars=None):
+        '''
+        Parameter:
+        ----------
+        n: int
+          number of plates
+        chars: np.array
+          (n, num_chars) glyph indices, random if None
+
+        Returns
+        ----------
+        plates: np.array
+          (n, h, w, 4) uint8 RGBA
+        chars: np.array
+          (n, num_chars) int
+        boxes: np.array
+          (n, num_chars, 2) float32, [left, right] of every character,
+          0~1 of the plate width
+        '''
+        chars = self.random_chars(n) if chars is None else np.asarray(chars)
+
+        plates = np.empty((n, self.h, self.w, 4), dtype=np.uint8)
+
+        # a few plates at a time stay in cache, the whole batch does not
+        t, b = self.top, self.top + self.glyph_h
+        for s in range(0, n, self.chunk):
+            chunk = plates[s:s+self.chunk]
+            chunk[:] = self.base
+            for k, left in enumerate(self.x):
+                chunk[:, t:b, left:left+self.glyph_w] = self.glyphs[chars[s:s+self.chunk, k]]
+
+        boxes = np.stack((self.x, self.x + self.glyph_w), axis=-1) / float(self.w)
+        boxes = np.tile(boxes.astype(np.float32), (n, 1, 1))
+
+        return plates, chars, boxes
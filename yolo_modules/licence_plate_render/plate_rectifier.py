@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+import time
+
+import cv2
+import numpy as np
+
+from yolo_modules import global_variable
+
+
+class PlateRectifier(object):
+    '''
+    Predicted plate poses -> OCR input. The homographies of all plates
+    are solved in one batched call, every crop is one warp at the OCR
+    size into a preallocated buffer, and HWC->CHW and 1/255 of the whole
+    batch is one numpy.multiply. A plate seen again with its corners
+    moved less than tolerance gets a remap table, built once from the
+    homography of its first frame and used until it moves more.
+    Crops are the same as ProjectRectangle6D.add_edges at size.
+    '''
+    def __init__(self, project_rect_6d, size=(160, 384), capacity=8,
+                 tolerance=0.5, rgb=False):
+        '''
+        Parameter:
+        ----------
+        project_rect_6d: ProjectRectangle6D
+        size: tuple
+          (h, w) of the OCR input
+        capacity: int
+          plates per batch the buffers are allocated for, they grow
+          if a batch has more
+        tolerance: float
+          max corner movement in image pixel to use the remap table of
+          the last batch again, 0: always build new ones
+        rgb: bool
+          swap the cv2 bgr frame to rgb, OCR is trained with bgr
+        '''
+        self.project_rect_6d = project_rect_6d
+        self.size = size
+        self.tolerance = tolerance
+        self.rgb = rgb
+        self.scale = np.float32(1 / 255.)
+
+        h, w = size
+        # 2----------->3
+        # ^            |
+        # |  ABC-1234  |
+        # |            |
+        # 1<-----------0
+        self.LP_corner = np.float64([[w, h], [0, h], [0, 0], [w, 0]])
+
+        # crop pixel [u, v, 1] of every output pixel, (3, h*w)
+        u, v = np.meshgrid(np.arange(w, dtype=np.float64), np.arange(h, dtype=np.float64))
+        self.grid = np.stack((u.reshape(-1), v.reshape(-1), np.ones(h * w)))
+
+        self._tables = {}  # key: [corners, homography, (map1, map2) or None]
+        self.hits = 0
+        self.misses = 0
+
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        h, w = self.size
+        self.capacity = capacity
+        self.crops = np.zeros((capacity, h, w, 3), dtype=np.uint8)
+        self.batch = np.zeros((capacity, 3, h, w), dtype=np.float32)
+
+    def corners(self, poses, img_shape):
+        '''
+        Returns
+        ----------
+        corners: np.array
+          (N, 4, 2) corners of every plate in image pixel
+        '''
+        poses = np.asarray(poses, dtype=np.float64)
+        poses = poses.reshape(-1, poses.shape[-1])
+        return self.project_rect_6d.project(poses, img_shape[:2])
+
+    def homographies(self, corners):
+        '''
+        cv2.getPerspectiveTransform(LP_corner, corners) of N plates,
+        one batched solve of the 8x8 systems
+
+        Parameter:
+        ----------
+        corners: np.array
+          (N, 4, 2) in image pixel
+
+        Returns
+        ----------
+        M: np.array
+          (N, 3, 3), crop pixel -> image pixel, for cv2.WARP_INVERSE_MAP
+        '''
+        n = len(corners)
+        x, y = self.LP_corner[:, 0], self.LP_corner[:, 1]
+        X, Y = corners[:, :, 0], corners[:, :, 1]  # (N, 4)
+
+        zeros = np.zeros((n, 4))
+        ones = np.ones((n, 4))
+        x, y = x + zeros, y + zeros
+
+        # rows of x' and y' of the 4 points, (N, 4, 8) each
+        row_x = np.stack((x, y, ones, zeros, zeros, zeros, -x*X, -y*X), axis=-1)
+        row_y = np.stack((zeros, zeros, zeros, x, y, ones, -x*Y, -y*Y), axis=-1)
+        A = np.concatenate((row_x, row_y), axis=1)
+        b = np.concatenate((X, Y), axis=1)
+
+        m = np.linalg.solve(A, b[:, :, None])[:, :, 0]
+        M = np.concatenate((m, np.ones((n, 1))), axis=1)
+        return M.reshape(n, 3, 3)
+
+    def _warp_tables(self, keys, corners):
+        '''
+        Returns
+        ----------
+        tables: list
+          (map1, map2) fixed-point remap table of a plate seen again,
+          (3, 3) homography of the others
+        '''
+        if len(self._tables) > 4 * self.capacity:
+            # plates that are gone
+            self._tables = dict(
+                [(k, self._tables[k]) for k in keys if k in self._tables])
+
+        tables = [None] * len(keys)
+        new, build = [], []
+        for i, key in enumerate(keys):
+            cached = self._tables.get(key)
+            if cached is None or \
+               np.abs(cached[0] - corners[i]).max() >= self.tolerance:
+                self.misses += 1
+                new.append(i)
+            elif cached[2] is None:
+                self.hits += 1
+                build.append(i)
+            else:
+                self.hits += 1
+                tables[i] = cached[2]
+
+        if new:
+            M = self.homographies(corners[new])
+            for j, i in enumerate(new):
+                self._tables[keys[i]] = [corners[i].copy(), M[j], None]
+                tables[i] = M[j]
+
+        if build:
+            # tables of all plates seen again in one matmul, (n, 3, h*w)
+            h, w = self.size
+            M = np.stack([self._tables[keys[i]][1] for i in build])
+            p = np.matmul(M, self.grid)
+            map_x = (p[:, 0] / p[:, 2]).astype(np.float32).reshape(-1, h, w)
+            map_y = (p[:, 1] / p[:, 2]).astype(np.float32).reshape(-1, h, w)
+
+            for j, i in enumerate(build):
+                maps = cv2.convertMaps(map_x[j], map_y[j], cv2.CV_16SC2)
+                self._tables[keys[i]][2] = maps
+                tables[i] = maps
+
+        return tables
+
+    def __call__(self, imgs, poses, frames=None, keys=None):
+        '''
+        Parameter:
+        ----------
+        imgs: list of np.array or np.array
+          (H, W, 3) uint8 cv2 frames of one camera
+        poses: np.array
+          (N, 6+) [X, Y, Z, r1, r2, r3, ...] of every plate,
+          ex: predict_LP()[1:] of every detection
+        frames: list of int
+          index in imgs of the frame of every plate, all 0 if None
+        keys: list
+          identity of every plate for remap table reuse,
+          ex: (camera, slot), 0~N-1 if None
+
+        Returns
+        ----------
+        batch: np.array
+          (N, 3, h, w) float32 0~1, a view of the preallocated batch
+        corners: np.array
+          (N, 4, 2) of every plate in image pixel, for drawing
+        '''
+        poses = np.asarray(poses)
+        n = len(poses)
+        frames = [0] * n if frames is None else frames
+        keys = range(n) if keys is None else keys
+
+        if n > self.capacity:
+            self._allocate(n)
+
+        corners = self.corners(poses, imgs[0].shape) if n else np.zeros((0, 4, 2))
+        tables = self._warp_tables(keys, corners)
+
+        h, w = self.size
+        for i, table in enumerate(tables):
+            if isinstance(table, tuple):
+                cv2.remap(
+                    imgs[frames[i]], table[0], table[1], cv2.INTER_LINEAR,
+                    dst=self.crops[i], borderMode=cv2.BORDER_CONSTANT)
+            else:
+                cv2.warpPerspective(
+                    imgs[frames[i]], table, (w, h), dst=self.crops[i],
+                    flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                    borderMode=cv2.BORDER_CONSTANT)
+
+        chw = self.crops[:n].transpose((0, 3, 1, 2))
+        if self.rgb:
+            chw = chw[:, ::-1]
+        np.multiply(chw, self.scale, out=self.batch[:n], casting='unsafe')
+
+        return self.batch[:n], corners
+
+    def stats(self):
+        return {
+            'plates': len(self._tables),
+            'hits': self.hits,
+            'misses': self.misses}
+
+
+def benchmark_rectify(project_rect_6d, img_shape=(320, 512), plates=(1, 8, 32),
+                      cycles=50):
+    '''
+    ms per batch of add_edges at the OCR size, one plate at a time,
+    against PlateRectifier on new plates and on plates seen again,
+    and the max pixel difference of the crops.
+    '''
+    img = np.random.randint(0, 256, img_shape + (3,)).astype(np.uint8)
+    img = cv2.GaussianBlur(img, (0, 0), 3)  # not pure noise, like a frame
+    rectifier = PlateRectifier(project_rect_6d)
+    h, w = rectifier.size
+
+    print(global_variable.yellow)
+    for n in plates:
+        Z = np.random.uniform(1500., 5000., n)
+        poses = np.stack((
+            Z * 0.2 * np.random.uniform(-1, 1, n),
+            Z * 0.15 * np.random.uniform(-1, 1, n),
+            Z,
+            np.random.uniform(-0.5, 0.5, n),
+            np.random.uniform(-0.5, 0.5, n),
+            np.random.uniform(-0.5, 0.5, n)), axis=-1)
+
+        def one_by_one():
+            crops = []
+            for pose in poses:
+                _, crop = project_rect_6d.add_edges(
+                    img.copy(), pose, LP_size=(h, w))
+                crops.append(crop.transpose((2, 0, 1)) / 255.)
+            return np.stack(crops)
+
+        def new_plates():
+            rectifier.tolerance = 0
+            return rectifier([img], poses)[0]
+
+        def seen_again():
+            rectifier.tolerance = 0.5
+            return rectifier([img], poses)[0]
+
+        for name, fn in [('add_edges', one_by_one), ('rectifier, new', new_plates),
+                         ('rectifier, again', seen_again)]:
+            fn()  # warm up
+            t = time.time()
+            for _ in range(cycles):
+                out = fn()
+            print('%2d plates %-18s %7.2f ms/batch' % (
+                n, name, (time.time() - t) * 1000 / cycles))
+
+        diff = np.abs(one_by_one() - seen_again()).max() * 255
+        print('%2d plates max diff: %.0f gray level' % (n, diff))
+
+    print(global_variable.reset_color)
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+import csv
+import os
+import threading
+import time
+
+import numpy
+
+from yolo_modules import global_variable
+
+
+class LatencyHistogram(object):
+    '''
+    Rolling window of the last samples for p50/p90/p99, plus the
+    cumulative count and sum.
+    '''
+    def __init__(self, window=1000):
+        self.samples = numpy.zeros(window, dtype=numpy.float64)
+        self.window = window
+        self.count = 0
+        self.sum = 0.
+
+    def add(self, seconds):
+        self.samples[self.count % self.window] = seconds
+        self.count += 1
+        self.sum += seconds
+
+    def percentiles(self, q=(50, 90, 99)):
+        n = min(self.count, self.window)
+        if n == 0:
+            return [0.] * len(q)
+        return list(numpy.percentile(self.samples[:n], q))
+
+
+class _Timer(object):
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.time() - self.start)
+
+
+class Metrics(object):
+    '''
+    Latency histograms, counters and gauges of one node, thread-safe.
+
+    with metrics.timer('forward'):
+        net.forward(...)
+    metrics.count('frames')
+    metrics.gauge('dropped', lambda: mailbox.stats()['dropped'])
+    '''
+    quantiles = (50, 90, 99)
+
+    def __init__(self, prefix='yolo', window=1000):
+        '''
+        Parameter:
+        ----------
+        prefix: string
+          prefix of the prometheus metric names
+        window: int
+          number of samples the percentiles are computed on
+        '''
+        self.prefix = prefix
+        self.window = window
+
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+
+        self._last_time = time.time()
+        self._last_counters = {}
+
+    def timer(self, name):
+        return _Timer(self, name)
+
+    def observe(self, name, seconds):
+        with self._lock:
+            if name not in self._histograms:
+                self._histograms[name] = LatencyHistogram(self.window)
+            self._histograms[name].add(seconds)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def gauge(self, name, fn):
+        '''
+        fn() is called at every snapshot, ex: a queue depth
+        '''
+        with self._lock:
+            self._gauges[name] = fn
+
+    def snapshot(self):
+        '''
+        Returns
+        ----------
+        snapshot: dict
+          latency: {name: (p50, p90, p99, count, sum)} in second
+          counters: {name: (total, per second since last snapshot)}
+          gauges: {name: value}
+        '''
+        with self._lock:
+            now = time.time()
+            elapsed = max(now - self._last_time, 1e-6)
+
+            latency = {}
+            for name, h in self._histograms.items():
+                latency[name] = tuple(h.percentiles(self.quantiles)) + (h.count, h.sum)
+
+            counters = {}
+            for name, total in self._counters.items():
+                rate = (total - self._last_counters.get(name, 0)) / elapsed
+                counters[name] = (total, rate)
+
+            self._last_time = now
+            self._last_counters = dict(self._counters)
+            gauges = list(self._gauges.items())
+
+        return {
+            'time': now,
+            'latency': latency,
+            'counters': counters,
+            'gauges': dict([(name, float(fn())) for name, fn in gauges])}
+
+    def to_prometheus(self, snapshot):
+        p = self.prefix
+        lines = ['# TYPE %s_latency_seconds summary' % p]
+        for name, v in sorted(snapshot['latency'].items()):
+            for q, value in zip(self.quantiles, v[:3]):
+                lines.append('%s_latency_seconds{stage="%s",quantile="%g"} %f' % (
+                    p, name, q / 100., value))
+            lines.append('%s_latency_seconds_count{stage="%s"} %d' % (p, name, v[3]))
+            lines.append('%s_latency_seconds_sum{stage="%s"} %f' % (p, name, v[4]))
+
+        lines.append('# TYPE %s_events_total counter' % p)
+        for name, (total, _) in sorted(snapshot['counters'].items()):
+            lines.append('%s_events_total{name="%s"} %d' % (p, name, total))
+
+        lines.append('# TYPE %s_events_per_second gauge' % p)
+        for name, (_, rate) in sorted(snapshot['counters'].items()):
+            lines.append('%s_events_per_second{name="%s"} %f' % (p, name, rate))
+
+        lines.append('# TYPE %s_gauge gauge' % p)
+        for name, value in sorted(snapshot['gauges'].items()):
+            lines.append('%s_gauge{name="%s"} %f' % (p, name, value))
+
+        return '\n'.join(lines) + '\n'
+
+    def to_row(self, snapshot):
+        '''
+        Returns
+        ----------
+        row: dict
+          flat {column: value} for csv, latency in ms
+        '''
+        row = {'time': '%.3f' % snapshot['time']}
+        for name, v in snapshot['latency'].items():
+            for q, value in zip(self.quantiles, v[:3]):
+                row['%s_p%d_ms' % (name, q)] = '%.3f' % (value * 1000)
+            row['%s_count' % name] = v[3]
+
+        for name, (total, rate) in snapshot['counters'].items():
+            row['%s_total' % name] = total
+            row['%s_per_s' % name] = '%.2f' % rate
+
+        for name, value in snapshot['gauges'].items():
+            row[name] = value
+
+        return row
+
+
+class MetricsWriter(object):
+    '''
+    Dump a Metrics snapshot every interval seconds, in a thread.
+    prom: the file is replaced by the latest snapshot, for the node
+    exporter textfile collector.
+    csv: one row per snapshot is appended.
+    '''
+    def __init__(self, metrics, path=None, fmt='prom', interval=5.,
+                 publish_fn=None):
+        '''
+        Parameter:
+        ----------
+        metrics: Metrics
+        path: string
+          output file, None to only publish
+        fmt: string
+          'prom' or 'csv'
+        publish_fn: function
+          publish_fn(prometheus_text), ex: publish on a ros topic
+        '''
+        assert fmt in ['prom', 'csv'], (
+            global_variable.red + 'metrics format should be prom or csv')
+
+        self.metrics = metrics
+        self.path = path
+        self.fmt = fmt
+        self.interval = interval
+        self.publish_fn = publish_fn
+
+        self._columns = None  # header of the csv file
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+        self.dump()
+
+    def dump(self):
+        snapshot = self.metrics.snapshot()
+        text = self.metrics.to_prometheus(snapshot)
+
+        if self.path is not None and self.fmt == 'prom':
+            with open(self.path + '.tmp', 'w') as f:
+                f.write(text)
+            os.rename(self.path + '.tmp', self.path)
+
+        elif self.path is not None and self.fmt == 'csv':
+            self._write_row(self.metrics.to_row(snapshot))
+
+        if self.publish_fn is not None:
+            self.publish_fn(text)
+
+    def _write_row(self, row):
+        if not os.path.exists(self.path):
+            self._columns = None
+        elif self._columns is None:
+            with open(self.path) as f:
+                self._columns = next(csv.reader(f), None)
+
+        columns = ['time'] + sorted(set(self._columns or []) | set(row.keys()) - set(['time']))
+        if columns != self._columns:
+            # a stage showed up after the header was written,
+            # rewrite the file with the new columns
+            rows = []
+            if self._columns is not None:
+                with open(self.path) as f:
+                    rows = list(csv.DictReader(f))
+
+            with open(self.path + '.tmp', 'w') as f:
+                writer = csv.DictWriter(f, columns, restval='')
+                writer.writeheader()
+                writer.writerows(rows)
+            os.rename(self.path + '.tmp', self.path)
+            self._columns = columns
+
+        with open(self.path, 'a') as f:
+            csv.DictWriter(f, self._columns, restval='').writerow(row)
+
+    def _loop(self):
+        while not self._closed.wait(self.interval):
+            try:
+                self.dump()
+            except Exception as e:
+                print(global_variable.red + 'metrics dump error: %s' % e)
+                print(global_variable.reset_color)
+
+
+def init_metrics(args, prefix, publish_fn=None):
+    '''
+    Parameter:
+    ----------
+    args: argparse.Namespace
+      from yolo_cv.add_video_parser
+    publish_fn: function
+      publish_fn(prometheus_text), used when args.metrics_topic is set
+
+    Returns
+    ----------
+    metrics: Metrics
+    writer: MetricsWriter
+      None if neither --metrics nor --metrics_topic is set
+    '''
+    metrics = Metrics(prefix)
+    path = args.metrics if args.metrics else None
+    publish_fn = publish_fn if args.metrics_topic else None
+    if path is None and publish_fn is None:
+        return metrics, None
+
+    writer = MetricsWriter(
+        metrics, path=path, fmt=args.metrics_format,
+        interval=args.metrics_interval, publish_fn=publish_fn)
+
+    return metrics, writer
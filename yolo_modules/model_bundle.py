@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+import json
+import os
+import shutil
+import time
+
+import numpy
+import mxnet
+from mxnet import nd
+
+from yolo_modules import global_variable
+
+# An exported model as one folder, <export_folder>/bundle:
+#   symbol.json    copy of export-symbol.json
+#   params.bin     raw parameter data, every array 64 byte aligned
+#   manifest.json  step, name/shape/dtype/offset of every array,
+#                  spec (size, anchors, slice_point, classes ...) and
+#                  preprocess metadata
+# params.bin is memory-mapped, an array is a view of the page cache,
+# nothing is parsed and on CPU nothing is copied either.
+BUNDLE_VERSION = 1
+ALIGN = 64
+
+
+def bundle_path(export_folder):
+    return os.path.join(export_folder, 'bundle')
+
+
+def write_bundle(export_folder, step=0, spec=None, preprocess=None):
+    '''
+    Pack export-symbol.json and export-%04d.params of export_folder.
+
+    Parameter:
+    ----------
+    spec: dict
+      network spec, ex: the content of spec.yaml
+    preprocess: dict
+      how a frame becomes the input, ex: {'scale': 1/255., 'channels': 'bgr'}
+
+    Returns
+    ----------
+    path: string
+      the bundle folder
+    '''
+    prefix = os.path.join(export_folder, 'export')
+    params = nd.load('%s-%04d.params' % (prefix, step))
+
+    path = bundle_path(export_folder)
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    entries = []
+    offset = 0
+    with open(os.path.join(path, 'params.bin.tmp'), 'wb') as f:
+        for key in sorted(params.keys()):
+            kind, name = key.split(':', 1) if ':' in key else ('arg', key)
+            array = params[key].asnumpy()
+
+            pad = -offset % ALIGN
+            f.write(b'\0' * pad)
+            offset += pad
+
+            entries.append({
+                'name': name, 'kind': kind, 'offset': offset,
+                'shape': list(array.shape), 'dtype': array.dtype.name})
+            f.write(numpy.ascontiguousarray(array).tobytes())
+            offset += array.nbytes
+
+    shutil.copyfile(prefix + '-symbol.json', os.path.join(path, 'symbol.json'))
+
+    manifest = {
+        'version': BUNDLE_VERSION,
+        'step': step,
+        'params': entries,
+        'spec': spec or {},
+        'preprocess': preprocess or {}}
+
+    with open(os.path.join(path, 'manifest.json.tmp'), 'w') as f:
+        json.dump(manifest, f)
+
+    # manifest last, a bundle with a manifest is complete
+    os.rename(os.path.join(path, 'params.bin.tmp'), os.path.join(path, 'params.bin'))
+    os.rename(os.path.join(path, 'manifest.json.tmp'), os.path.join(path, 'manifest.json'))
+
+    print(global_variable.green)
+    print('bundle: %s, %d arrays, %.1f MB' % (path, len(entries), offset / 1e6))
+    print(global_variable.reset_color)
+    return path
+
+
+def find_bundle(export_folder, step=0):
+    '''
+    Returns
+    ----------
+    bundle: ModelBundle
+      None if there is no bundle, or the export is newer than it
+    '''
+    path = bundle_path(export_folder)
+    manifest = os.path.join(path, 'manifest.json')
+    if not os.path.exists(manifest):
+        return None
+
+    params = os.path.join(export_folder, 'export-%04d.params' % step)
+    if os.path.exists(params) and \
+       os.path.getmtime(params) > os.path.getmtime(manifest):
+        print(global_variable.yellow)
+        print('bundle is older than %s, not used' % params)
+        print(global_variable.reset_color)
+        return None
+
+    bundle = ModelBundle(path)
+    if bundle.step != step:
+        return None
+    return bundle
+
+
+class ModelBundle(object):
+    def __init__(self, path):
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+
+        assert manifest['version'] == BUNDLE_VERSION, (
+            global_variable.red + 'bundle version %s, re-export the model' %
+            manifest['version'])
+
+        self.path = path
+        self.step = manifest['step']
+        self.spec = manifest['spec']
+        self.preprocess = manifest['preprocess']
+        self.entries = manifest['params']
+        self._blob = None
+
+    def symbol(self):
+        return mxnet.sym.load(os.path.join(self.path, 'symbol.json'))
+
+    def arrays(self):
+        '''
+        Returns
+        ----------
+        arg_arrays, aux_arrays: dict of np.array
+          read-only views of the memory-mapped params.bin
+        '''
+        if self._blob is None:
+            self._blob = numpy.memmap(
+                os.path.join(self.path, 'params.bin'), dtype=numpy.uint8, mode='r')
+
+        arrays = {'arg': {}, 'aux': {}}
+        for e in self.entries:
+            arrays[e['kind']][e['name']] = numpy.ndarray(
+                tuple(e['shape']), dtype=e['dtype'],
+                buffer=self._blob, offset=e['offset'])
+
+        return arrays['arg'], arrays['aux']
+
+    def params(self, ctx):
+        '''
+        Returns
+        ----------
+        arg_params, aux_params: dict of mxnet.ndarray
+          on CPU they share memory with params.bin (mxnet >= 1.6),
+          on GPU every array is one host to device copy
+        '''
+        zero_copy = ctx.device_type == 'cpu' and hasattr(nd, 'from_numpy')
+
+        def to_nd(array):
+            if zero_copy:
+                return nd.from_numpy(array, zero_copy=True)
+            return nd.array(array, ctx=ctx, dtype=array.dtype)
+
+        arg_arrays, aux_arrays = self.arrays()
+        arg_params = dict([(k, to_nd(v)) for k, v in arg_arrays.items()])
+        aux_params = dict([(k, to_nd(v)) for k, v in aux_arrays.items()])
+        return arg_params, aux_params
+
+    def bind(self, size, ctx, batch=1, fp16=False):
+        '''
+        Same executor as yolo_gluon.init_executor, bound on the bundle
+        arrays instead of copies of them.
+
+        Parameter:
+        ----------
+        size: list of int
+          [h, w] of the input
+        '''
+        sym = self.symbol()
+        arg_params, aux_params = self.params(ctx)
+
+        dtype = numpy.float16 if fp16 else numpy.float32
+        args = {'data': nd.zeros((batch, 3, size[0], size[1]), ctx=ctx, dtype=dtype)}
+        args.update(arg_params)
+        aux = dict([(k, aux_params[k]) for k in sym.list_auxiliary_states()])
+
+        return sym.bind(ctx, args, aux_states=aux, grad_req='null')
+
+
+def benchmark_cold_start(export_folder, size, spec_path=None, fp16=False,
+                         ctx=mxnet.cpu(), step=0):
+    '''
+    Startup time of load_checkpoint + simple_bind + copy_params_from
+    (+ spec.yaml) against the bundle loader, first forward included.
+    The page cache is warm after the first run, so this measures the
+    parse and copy work, not the disk.
+    '''
+    import yaml
+    h, w = size
+
+    if find_bundle(export_folder, step) is None:
+        spec = None
+        if spec_path is not None:
+            with open(spec_path) as f:
+                spec = yaml.load(f)
+        write_bundle(export_folder, step, spec=spec)
+
+    def checkpoint():
+        if spec_path is not None:
+            with open(spec_path) as f:
+                yaml.load(f)
+        sym, arg_params, aux_params = mxnet.model.load_checkpoint(
+            os.path.join(export_folder, 'export'), step)
+        executor = sym.simple_bind(
+            ctx=ctx, data=(1, 3, h, w),
+            type_dict={'data': numpy.float16 if fp16 else numpy.float32},
+            grad_req='null', force_rebind=True)
+        executor.copy_params_from(arg_params, aux_params)
+        return executor
+
+    def bundle():
+        return find_bundle(export_folder, step).bind(size, ctx, fp16=fp16)
+
+    print(global_variable.yellow)
+    for name, fn in [('checkpoint', checkpoint), ('bundle', bundle)]:
+        t = time.time()
+        executor = fn()
+        t_bind = time.time() - t
+        executor.forward(is_train=False)
+        executor.outputs[0].wait_to_read()
+        print('%s: bind %.1f ms, first forward %.1f ms' % (
+            name, t_bind * 1000, (time.time() - t) * 1000))
+
+    print(global_variable.reset_color)
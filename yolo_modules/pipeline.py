@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+import multiprocessing
+import threading
+import time
+import traceback
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from yolo_modules import global_variable
+
+
+class Stage(object):
+    '''
+    One step of a Pipeline, fn runs on every item of its input queue
+    and its return value goes to the next stage.
+    '''
+    def __init__(self, name, fn, workers=1, maxsize=2, process=False,
+                 init_fn=None):
+        '''
+        Parameter:
+        ----------
+        name: string
+        fn: function
+          first stage: fn() -> item, the source, ex: wait for a frame
+          other stages: fn(item) -> item
+          return None to drop the item
+        workers: int
+          number of threads/processes running fn,
+          0: run in the thread that calls Pipeline.run(), ex: matplotlib,
+          cv2.imshow or TensorRT, only one stage can do this.
+          Items of a stage with more than one worker can be reordered.
+        maxsize: int
+          size of the input queue, a full queue blocks the stage before,
+          so a slow stage slows down everything upstream (backpressure)
+          instead of piling up frames
+        process: bool
+          run the workers in forked processes, items are pickled, so
+          pass np.array, not mxnet.ndarray, and do not touch ROS or the
+          GPU in the child
+        init_fn: function
+          init_fn() called once in every worker before the first item
+        '''
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.maxsize = maxsize
+        self.process = process
+        self.init_fn = init_fn
+
+
+class Pipeline(object):
+    '''
+    Stages connected by bounded queues, ex:
+    capture -> preprocess -> infer -> decode -> publish
+    '''
+    def __init__(self, stages, poll=0.1, metrics=None):
+        '''
+        Parameter:
+        ----------
+        stages: list of Stage
+        poll: float
+          seconds between checks of close() while blocked
+        metrics: metrics.Metrics
+          records the busy time of every thread stage but the source,
+          and the depth of every queue
+        '''
+        assert len([s for s in stages if s.workers == 0]) <= 1, (
+            global_variable.red + 'only one stage can run in the main thread')
+        assert not any(s.workers == 0 and s.process for s in stages), (
+            global_variable.red + 'main thread stage can not be a process')
+
+        self.stages = stages
+        self.poll = poll
+        self.metrics = metrics
+
+        use_process = any(s.process for s in stages)
+        self._closed = multiprocessing.Event() if use_process else threading.Event()
+
+        # queues[i] is the input of stages[i], the source has none
+        self.queues = [None]
+        for prev, stage in zip(stages[:-1], stages[1:]):
+            if prev.process or stage.process:
+                self.queues.append(multiprocessing.Queue(stage.maxsize))
+            else:
+                self.queues.append(queue.Queue(stage.maxsize))
+
+        # count, busy, input stall, output stall, shared with the children
+        self._lock = multiprocessing.Lock()
+        self._stats = [multiprocessing.RawArray('d', 4) for _ in stages]
+        self._workers = []
+
+        if metrics is not None:
+            for stage, q in zip(stages[1:], self.queues[1:]):
+                metrics.gauge(stage.name + '_queue', q.qsize)
+
+    @property
+    def closed(self):
+        return self._closed.is_set()
+
+    def start(self):
+        for i, stage in enumerate(self.stages):
+            for _ in range(stage.workers):
+                if stage.process:
+                    w = multiprocessing.Process(target=self._loop, args=(i,))
+                else:
+                    w = threading.Thread(target=self._loop, args=(i,))
+                w.daemon = True
+                w.start()
+                self._workers.append(w)
+
+    def run(self, is_shutdown=None):
+        '''
+        Start the workers, run the main-thread stage if there is one,
+        and block until close() or is_shutdown() is True.
+
+        Parameter:
+        ----------
+        is_shutdown: function
+          ex: rospy.is_shutdown
+        '''
+        self.start()
+        main = [i for i, s in enumerate(self.stages) if s.workers == 0]
+
+        try:
+            if main:
+                self._loop(main[0], is_shutdown)
+            else:
+                while not self.closed and \
+                      (is_shutdown is None or not is_shutdown()):
+                    time.sleep(self.poll)
+        finally:
+            self.close()
+
+    def close(self, timeout=5.0):
+        self._closed.set()
+        for w in self._workers:
+            w.join(timeout)
+            if isinstance(w, multiprocessing.Process) and w.is_alive():
+                w.terminate()
+
+    def stats(self):
+        '''
+        Returns
+        ----------
+        stats: dict
+          {stage name: count of items processed (made, for the source),
+          mean busy/input stall/output stall in second, input queue depth}
+        '''
+        stats = {}
+        for stage, s, q in zip(self.stages, self._stats, self.queues):
+            with self._lock:
+                count, busy, in_stall, out_stall = s[:]
+            n = max(count, 1)
+            try:
+                depth = q.qsize() if q is not None else 0
+            except NotImplementedError:  # multiprocessing.Queue on macOS
+                depth = -1
+
+            stats[stage.name] = {
+                'count': int(count), 'busy': busy / n, 'in_stall': in_stall / n,
+                'out_stall': out_stall / n, 'depth': depth}
+
+        return stats
+
+    def _loop(self, i, is_shutdown=None):
+        stage = self.stages[i]
+        in_q = self.queues[i]
+        out_q = self.queues[i+1] if i + 1 < len(self.stages) else None
+
+        def stopped():
+            return self.closed or (is_shutdown is not None and is_shutdown())
+
+        try:
+            if stage.init_fn is not None:
+                stage.init_fn()
+
+            while not stopped():
+                # -------------------- input -------------------- #
+                t0 = time.time()
+                if in_q is None:
+                    args = ()
+                else:
+                    try:
+                        args = (in_q.get(timeout=self.poll),)
+                    except queue.Empty:
+                        continue
+
+                # -------------------- work -------------------- #
+                t1 = time.time()
+                item = stage.fn(*args)
+                t2 = time.time()
+                if self.metrics is not None and in_q is not None:
+                    self.metrics.observe(stage.name, t2 - t1)
+
+                # -------------------- output -------------------- #
+                while item is not None and out_q is not None and not stopped():
+                    try:
+                        out_q.put(item, timeout=self.poll)
+                        break
+                    except queue.Full:
+                        continue
+
+                with self._lock:
+                    s = self._stats[i]
+                    s[0] += in_q is not None or item is not None
+                    s[1] += t2 - t1
+                    s[2] += t1 - t0
+                    s[3] += time.time() - t2
+
+        except Exception:
+            print(global_variable.red)
+            print('pipeline stage %s error' % stage.name)
+            traceback.print_exc()
+            print(global_variable.reset_color)
+            self._closed.set()
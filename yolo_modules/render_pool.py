@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+import multiprocessing
+import random
+import time
+import traceback
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import numpy
+import mxnet
+from mxnet import nd
+
+
+class RenderPool(object):
+    '''
+    N render processes write finished batches into a ring of shared-memory
+    slots, the trainer reads a slot as numpy views (no pickling) and
+    copies it to ctx once. get()/close()/stats() are the same as
+    batch_queue.BatchQueue, so the training thread does not care which
+    one feeds it.
+
+    Workers are forked, init_fn runs in each child and everything the
+    parent built before (e.g. pre-loaded datasets) is shared copy-on-write.
+    Workers render on cpu, never touch a GPU context in a child.
+    The fork happens after the parent has started the MXNet engine and,
+    when training on GPU, created its CUDA context. MXNet restarts its
+    engine threads in the child, CUDA can not be used there at all, so
+    init_fn and render_fn must only create cpu arrays and must not use
+    anything of the parent that lives on a GPU (nets, ctx, ndarrays).
+
+    A worker that raises sends its traceback and exits, get() raises it
+    in the trainer. get() also raises once every worker is gone.
+    '''
+    def __init__(self, init_fn, render_fn, shapes, num_workers=2,
+                 num_slots=None, ctx=mxnet.cpu(), seed=None, poll=0.1):
+        '''
+        Parameter:
+        ----------
+        init_fn: function
+          init_fn(worker_id) -> state, called once in each worker
+        render_fn: function
+          render_fn(state) -> tuple of mxnet.ndarray or np.array
+        shapes: list of tuple
+          shape of each element of a batch, stored as float32
+        num_workers: int
+          number of render processes
+        num_slots: int
+          number of shared-memory batches, default 2 * num_workers
+        ctx: mxnet.context
+          where get() puts the batch
+        seed: int
+          worker i uses seed + i, default random
+        '''
+        self.shapes = [tuple(s) for s in shapes]
+        self.num_workers = num_workers
+        self.num_slots = 2 * num_workers if num_slots is None else num_slots
+        self.maxsize = self.num_slots
+        self.ctx = ctx
+        self.poll = poll
+
+        if seed is None:
+            seed = numpy.random.randint(2**31 - num_workers)
+
+        # -------------------- shared memory -------------------- #
+        self._buffers = [
+            [multiprocessing.RawArray('f', int(numpy.prod(s))) for s in self.shapes]
+            for _ in range(self.num_slots)]
+        self._views = [_slot_views(slot, self.shapes) for slot in self._buffers]
+
+        self._free = multiprocessing.Queue()
+        self._ready = multiprocessing.Queue()
+        for i in range(self.num_slots):
+            self._free.put(i)
+
+        self._closed = multiprocessing.Event()
+        self._put_count = multiprocessing.Value('i', 0)
+        self._put_stall = multiprocessing.Value('d', 0.)
+
+        self.get_count = 0
+        self.get_stall = 0.
+
+        # -------------------- workers -------------------- #
+        self._workers = []
+        for i in range(num_workers):
+            p = multiprocessing.Process(
+                target=_worker,
+                args=(i, seed + i, init_fn, render_fn, self))
+            p.daemon = True
+            p.start()
+            self._workers.append(p)
+
+    @property
+    def closed(self):
+        return self._closed.is_set()
+
+    def close(self, timeout=5.0):
+        self._closed.set()
+        for p in self._workers:
+            p.join(timeout)
+            if p.is_alive():
+                p.terminate()
+
+    def get(self):
+        '''
+        Returns
+        ----------
+        batch: tuple of mxnet.ndarray
+          None if the pool is closed
+        '''
+        t = time.time()
+        while True:
+            try:
+                slot = self._ready.get(timeout=self.poll)
+                break
+
+            except queue.Empty:
+                if self.closed:
+                    return None
+                if not any(p.is_alive() for p in self._workers):
+                    raise RuntimeError('render pool: all workers are dead')
+
+        if isinstance(slot, tuple):
+            worker_id, trace = slot
+            raise RuntimeError(
+                'render pool: worker %d failed\n%s' % (worker_id, trace))
+
+        self.get_stall += time.time() - t
+        self.get_count += 1
+
+        # nd.array copies synchronously, the slot is free right after
+        batch = tuple(nd.array(v, ctx=self.ctx) for v in self._views[slot])
+        self._free.put(slot)
+
+        return batch
+
+    def depth(self):
+        return self._ready.qsize()
+
+    def stats(self):
+        '''
+        Returns
+        ----------
+        stats: dict
+          depth, put/get count and mean put/get stall in second
+        '''
+        put_count = self._put_count.value
+        return {
+            'depth': self.depth(),
+            'put_count': put_count,
+            'get_count': self.get_count,
+            'put_stall': self._put_stall.value / max(put_count, 1),
+            'get_stall': self.get_stall / max(self.get_count, 1)}
+
+
+def _slot_views(slot, shapes):
+    return [numpy.ctypeslib.as_array(buf).reshape(s)
+            for buf, s in zip(slot, shapes)]
+
+
+def _worker(worker_id, seed, init_fn, render_fn, pool):
+    try:
+        _render_loop(worker_id, seed, init_fn, render_fn, pool)
+    except Exception:
+        # the slot it holds is lost, the trainer has to stop anyway
+        pool._ready.put((worker_id, traceback.format_exc()))
+
+
+def _render_loop(worker_id, seed, init_fn, render_fn, pool):
+    numpy.random.seed(seed)
+    random.seed(seed)
+    mxnet.random.seed(seed)
+
+    state = init_fn(worker_id)
+    t = time.time()
+    while not pool.closed:
+        try:
+            slot = pool._free.get(timeout=pool.poll)
+
+        except queue.Empty:
+            continue
+
+        with pool._put_stall.get_lock():
+            pool._put_stall.value += time.time() - t
+
+        batch = render_fn(state)
+        for view, data in zip(pool._views[slot], batch):
+            if isinstance(data, nd.NDArray):
+                data = data.asnumpy()
+            view[...] = data
+
+        with pool._put_count.get_lock():
+            pool._put_count.value += 1
+
+        pool._ready.put(slot)
+        t = time.time()
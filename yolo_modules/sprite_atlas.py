@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+import os
+
+import numpy
+import PIL
+from PIL import Image
+
+from yolo_modules import global_variable
+
+
+def build_sprite_atlas(paths, atlas_path, meta=None, pad=2):
+    '''
+    Crop every RGBA image to its alpha bbox and pack the crops into one
+    uint8 file, atlas_path.u8, with an index atlas_path.npz.
+
+    Parameter:
+    ----------
+    paths: list of string
+      image paths, sprite i is paths[i]
+    atlas_path: string
+      path without extension
+    meta: dict
+      extra arrays saved in the index, ex: per-sprite labels
+    pad: int
+      transparent pixels kept around the alpha bbox
+    '''
+    meta = {} if meta is None else meta
+    offsets = numpy.zeros(len(paths), dtype=numpy.int64)
+    shapes = numpy.zeros((len(paths), 2), dtype=numpy.int32)
+
+    data_path = atlas_path + '.u8'
+    tmp_path = data_path + '.tmp'
+    offset = 0
+    with open(tmp_path, 'wb') as f:
+        for i, path in enumerate(paths):
+            img = Image.open(path).convert('RGBA')
+            l, t, r, b = img.getbbox() or (0, 0, 1, 1)
+            w, h = img.size
+            img = img.crop((max(l-pad, 0), max(t-pad, 0),
+                            min(r+pad, w), min(b+pad, h)))
+
+            sprite = numpy.asarray(img, dtype=numpy.uint8)
+            f.write(sprite.tobytes())
+
+            offsets[i] = offset
+            shapes[i] = sprite.shape[:2]
+            offset += sprite.size
+
+            if i % 1000 == 0:
+                print('%s: %d/%d' % (atlas_path, i, len(paths)))
+
+    index = dict([(k, numpy.array(v)) for k, v in meta.items()])
+    index.update(offsets=offsets, shapes=shapes, paths=numpy.array(paths))
+    with open(atlas_path + '.npz.tmp', 'wb') as f:
+        numpy.savez(f, **index)
+
+    os.rename(tmp_path, data_path)
+    os.rename(atlas_path + '.npz.tmp', atlas_path + '.npz')
+
+
+def load_sprite_atlas(atlas_path, paths=None):
+    '''
+    Returns
+    ----------
+    atlas: SpriteAtlas
+      None if the atlas does not exist or was built from other paths
+    '''
+    if not os.path.exists(atlas_path + '.npz') or \
+       not os.path.exists(atlas_path + '.u8'):
+        return None
+
+    atlas = SpriteAtlas(atlas_path)
+    if paths is not None and list(atlas.meta['paths']) != list(paths):
+        print(global_variable.yellow)
+        print('sprite atlas %s is outdated, rebuild it' % atlas_path)
+        print(global_variable.reset_color)
+        return None
+
+    return atlas
+
+
+class SpriteAtlas(object):
+    '''
+    Read-only, memory-mapped sprites built by build_sprite_atlas.
+    Pages are shared by every process that maps the same file.
+    '''
+    def __init__(self, atlas_path):
+        with numpy.load(atlas_path + '.npz') as f:
+            self.meta = dict([(k, f[k]) for k in f.files])
+
+        self.offsets = self.meta.pop('offsets')
+        self.shapes = self.meta.pop('shapes')
+        self.data = numpy.memmap(atlas_path + '.u8', dtype=numpy.uint8, mode='r')
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def get(self, i):
+        '''
+        Returns
+        ----------
+        sprite: np.array
+          (h, w, 4) uint8 RGBA view of the mapped file
+        '''
+        h, w = self.shapes[i]
+        start = self.offsets[i]
+        return self.data[start:start+h*w*4].reshape((h, w, 4))
+
+    def pil(self, i):
+        return PIL.Image.fromarray(numpy.array(self.get(i)), 'RGBA')
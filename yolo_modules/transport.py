@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+import threading
+import time
+
+import numpy
+
+
+# Video nodes talk to the outside world only through a transport, so the
+# same pipeline runs under ROS or, without a ROS master, in memory.
+#
+# kind of a topic:
+#   array: np.array/list <-> std_msgs/Float32MultiArray
+#   image: bgr8 cv2 image <-> sensor_msgs/Image
+#   depth: float32 cv2 image <- sensor_msgs/Image 32FC1 (subscribe only)
+#   string: str <-> std_msgs/String
+#
+# Subscriber callbacks are callback(data, stamp, seq), stamp in second.
+
+
+def get_transport(bench=False, name='YOLO_ros_node'):
+    '''
+    Returns
+    ----------
+    transport: MemoryTransport if bench else RosTransport
+    '''
+    if bench:
+        return MemoryTransport(name)
+    return RosTransport(name)
+
+
+class RosTransport(object):
+    def __init__(self, name):
+        import rospy
+        from cv_bridge import CvBridge
+        from sensor_msgs.msg import Image
+        from std_msgs.msg import Float32MultiArray, String
+
+        self.rospy = rospy
+        self.bridge = CvBridge()
+        self.msg_types = {
+            'array': Float32MultiArray, 'image': Image,
+            'depth': Image, 'string': String}
+
+        rospy.init_node(name, anonymous=True)
+
+    def now(self):
+        return self.rospy.get_rostime().to_sec()
+
+    def is_shutdown(self):
+        return self.rospy.is_shutdown()
+
+    def signal_shutdown(self, reason=''):
+        self.rospy.signal_shutdown(reason)
+
+    def on_shutdown(self, fn):
+        self.rospy.on_shutdown(fn)
+
+    def rate(self, hz):
+        return self.rospy.Rate(hz)
+
+    def publisher(self, topic, kind, queue_size=1):
+        pub = self.rospy.Publisher(topic, self.msg_types[kind], queue_size=queue_size)
+        return _RosPublisher(pub, kind, self.bridge, self.msg_types[kind])
+
+    def subscribe(self, topic, kind, callback):
+        bridge = self.bridge
+
+        def _callback(msg):
+            if kind == 'image':
+                data = bridge.imgmsg_to_cv2(msg, 'bgr8')
+            elif kind == 'depth':
+                data = numpy.array(bridge.imgmsg_to_cv2(msg, '32FC1'), dtype=numpy.float32)
+            elif kind == 'array':
+                data = numpy.array(msg.data, dtype=numpy.float32)
+            else:
+                data = msg.data
+
+            header = getattr(msg, 'header', None)
+            if header is None:
+                callback(data, self.now(), None)
+            else:
+                callback(data, header.stamp.to_sec(), header.seq)
+
+        return self.rospy.Subscriber(topic, self.msg_types[kind], _callback)
+
+
+class _RosPublisher(object):
+    def __init__(self, pub, kind, bridge, msg_type):
+        self.pub = pub
+        self.kind = kind
+        self.bridge = bridge
+        self.msg = msg_type() if kind == 'array' else None  # reused
+
+    def publish(self, data):
+        if self.kind == 'image':
+            self.pub.publish(self.bridge.cv2_to_imgmsg(data, 'bgr8'))
+        elif self.kind == 'array':
+            self.msg.data = data
+            self.pub.publish(self.msg)
+        else:
+            self.pub.publish(data)
+
+
+class MemoryTransport(object):
+    '''
+    In-process transport, no ROS needed. A publish is delivered to the
+    subscribers of the same topic in the publishing thread, publishers
+    keep a count and the last message for checks and benchmarks.
+    '''
+    def __init__(self, name=None):
+        self.name = name
+        self.publishers = {}
+        self._subscribers = {}
+        self._shutdown = threading.Event()
+        self._hooks = []
+        self._lock = threading.Lock()
+
+    def now(self):
+        return time.time()
+
+    def is_shutdown(self):
+        return self._shutdown.is_set()
+
+    def signal_shutdown(self, reason=''):
+        with self._lock:
+            if self._shutdown.is_set():
+                return
+            self._shutdown.set()
+
+        for fn in self._hooks:
+            fn()
+
+    def on_shutdown(self, fn):
+        self._hooks.append(fn)
+
+    def rate(self, hz):
+        return _Rate(hz)
+
+    def publisher(self, topic, kind, queue_size=1):
+        if topic not in self.publishers:
+            self.publishers[topic] = _MemoryPublisher(self, topic)
+        return self.publishers[topic]
+
+    def subscribe(self, topic, kind, callback):
+        self._subscribers.setdefault(topic, []).append(callback)
+
+    def _deliver(self, topic, data, seq):
+        for callback in self._subscribers.get(topic, []):
+            callback(data, self.now(), seq)
+
+
+class _MemoryPublisher(object):
+    def __init__(self, transport, topic):
+        self.transport = transport
+        self.topic = topic
+        self.count = 0
+        self.last = None
+
+    def publish(self, data):
+        self.last = data
+        self.count += 1
+        self.transport._deliver(self.topic, data, self.count)
+
+
+class _Rate(object):
+    '''
+    same as rospy.Rate, sleep() keeps the loop at hz
+    '''
+    def __init__(self, hz):
+        self.period = 1. / hz
+        self.last = time.time()
+
+    def sleep(self):
+        remaining = self.last + self.period - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
+        self.last = max(self.last + self.period, time.time() - self.period)
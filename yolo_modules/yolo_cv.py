@@ -161,7 +161,27 @@ def add_video_parser(parser):
     parser.add_argument(
         "--trt",
         dest="trt", default=0, type=int,
-        help="use TensorRT or not")
+        help="use TensorRT or not, same as --backend trt")
+
+    parser.add_argument(
+        "--backend",
+        dest="backend", default="mxnet",
+        help="mxnet, onnx(onnxruntime CPU) or trt")
+
+    parser.add_argument(
+        "--async_forward",
+        dest="async_forward", default=0, type=int,
+        help="mxnet only, 2 ping-pong buffers, load the next frame while this one runs")
+
+    parser.add_argument(
+        "--onnx_threads",
+        dest="onnx_threads", default=0, type=int,
+        help="intra-op threads of onnxruntime, 0: one per core")
+
+    parser.add_argument(
+        "--bench_backends",
+        dest="bench_backends", default=0, type=int,
+        help="run every backend N times on CPU, print the latency and exit")
 
     parser.add_argument(
         "--topic",
@@ -193,6 +213,51 @@ def add_video_parser(parser):
         dest="show", default=1, type=int,
         help="show processed image")
 
+    parser.add_argument(
+        "--max_frame_age",
+        dest="max_frame_age", default=0., type=float,
+        help="seconds, skip frames older than this, 0: keep all")
+
+    parser.add_argument(
+        "--preprocess_workers",
+        dest="preprocess_workers", default=1, type=int,
+        help="threads resizing frames in the video pipeline")
+
+    parser.add_argument(
+        "--queue_size",
+        dest="queue_size", default=2, type=int,
+        help="frames waiting between two pipeline stages")
+
+    parser.add_argument(
+        "--metrics",
+        dest="metrics", default="",
+        help="file to dump latency/fps metrics to, empty: no file")
+
+    parser.add_argument(
+        "--metrics_format",
+        dest="metrics_format", default="prom",
+        help="prom: prometheus text, csv: one row per dump")
+
+    parser.add_argument(
+        "--metrics_interval",
+        dest="metrics_interval", default=5., type=float,
+        help="seconds between two metrics dumps")
+
+    parser.add_argument(
+        "--metrics_topic",
+        dest="metrics_topic", default="",
+        help="ros topic to publish the prometheus text on, empty: off")
+
+    parser.add_argument(
+        "--bench",
+        dest="bench", default="",
+        help="video file, run the whole pipeline on it without ros and print fps/latency")
+
+    parser.add_argument(
+        "--bench_rate",
+        dest="bench_rate", default=0., type=float,
+        help="fps of the --bench video, 0: as fast as possible, no frame dropped")
+
     parser.parse_args().show = bool(parser.parse_args().show)
     parser.parse_args().trt = bool(parser.parse_args().trt)
 
@@ -4,13 +4,16 @@ import numpy
 import os
 import time
 import PIL
+import threading
 import numpy
 
 import mxnet
 from mxnet import nd, gpu
 
 from yolo_modules import global_variable
+from yolo_modules import model_bundle
 
+_thread_local = threading.local()
 
 # -------------------- train/valid -------------------- #
 def record_loss(losses, loss_names, summary_writer, step=0, exp=''):
@@ -203,6 +206,12 @@ def init_NN(target, weight, ctx):
 
 def init_executor(export_folder, size, ctx, use_tensor_rt=False, step=0, fp16=False):
     print('checkpoint folder: %s' % export_folder)
+    bundle = None if use_tensor_rt else model_bundle.find_bundle(export_folder, step)
+    if bundle is not None:
+        # memory-mapped params, no load_checkpoint and copy_params_from
+        print('load bundle: %s' % bundle.path)
+        return bundle.bind(size, ctx, fp16=fp16)
+
     export_file = os.path.join(export_folder, 'export')
     sym, arg_params, aux_params = mxnet.model.load_checkpoint(
         export_file, step)
@@ -242,7 +251,14 @@ def init_executor(export_folder, size, ctx, use_tensor_rt=False, step=0, fp16=Fa
     return executor
 
 
-def export(net, batch_shape, ctx, export_folder, onnx=True, epoch=0, fp16=False):
+def export(net, batch_shape, ctx, export_folder, onnx=True, epoch=0, fp16=False,
+           spec=None):
+    '''
+    Parameter:
+    ----------
+    spec: dict
+      saved in the model bundle with the parameters, ex: spec.yaml
+    '''
     data = nd.zeros(batch_shape).as_in_context(ctx)
 
     if fp16:
@@ -268,6 +284,11 @@ def export(net, batch_shape, ctx, export_folder, onnx=True, epoch=0, fp16=False)
         mxnet.contrib.onnx.export_model(
             sym, params, [batch_shape], numpy.float32, onnx_file)
 
+    preprocess = {
+        'size': list(batch_shape[2:]), 'dtype': 'float16' if fp16 else 'float32',
+        'scale': 1 / 255., 'channels': 'bgr', 'layout': 'NCHW'}
+    model_bundle.write_bundle(export_folder, epoch, spec=spec, preprocess=preprocess)
+
     print(global_variable.green)
     print('Export Done')
 
@@ -313,6 +334,161 @@ def pil_rgb_2_rgb_ndarray(pil_img, augs=None):
     return img.transpose((2, 0, 1)) / 255.
 
 
+class ROICompositor(object):
+    '''
+    Alpha-blend RGBA sprites into a preallocated (bs, 3, h, w) batch,
+    only inside each sprite's bounding box, clipped at the frame edges.
+    Replaces a full-frame PIL.Image.new + pil_rgb_2_rgb_ndarray +
+    pil_mask_2_rgb_ndarray + full-frame blend per sample.
+    '''
+    def __init__(self, bs, h, w, augs=None):
+        '''
+        Parameter:
+        ----------
+        bs, h, w: int
+          batch shape
+        augs: mxnet.image.CreateAugmenter
+          applied to the sprite only, crop augmenters are dropped
+          because they would resize the sprite to (h, w)
+        '''
+        self.h = h
+        self.w = w
+        self.batch = numpy.zeros((bs, 3, h, w), dtype=numpy.float32)
+        self.augs = [] if augs is None else [
+            aug for aug in augs if not isinstance(
+                aug, (mxnet.image.CenterCropAug, mxnet.image.RandomCropAug))]
+
+    def reset(self, bg, scale=1/255.):
+        '''
+        bg: mxnet.ndarray or np.array
+          (bs, 3, h, w) background, bg*scale should be 0~1
+        '''
+        bg = bg.asnumpy() if isinstance(bg, nd.NDArray) else bg
+        numpy.multiply(bg, scale, out=self.batch)
+
+    def paste(self, i, sprite, x, y):
+        '''
+        Same as PIL paste of sprite at top-left (x, y) followed by
+        bg*(1-alpha) + sprite*alpha, on image i of the batch.
+
+        Parameter:
+        ----------
+        i: int
+          index in the batch
+        sprite: PIL.Image or np.array
+          RGBA, (sh, sw, 4) uint8
+        x, y: int
+          top-left of the sprite in the frame, can be out of the frame
+        '''
+        sprite = numpy.asarray(sprite)
+        sh, sw = sprite.shape[:2]
+
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + sw, self.w), min(y + sh, self.h)
+        if x1 <= x0 or y1 <= y0:
+            return
+
+        roi = sprite[y0-y:y1-y, x0-x:x1-x]
+        rgb = roi[:, :, :3]
+        if self.augs:
+            rgb = nd.array(rgb)
+            for aug in self.augs:
+                rgb = aug(rgb)
+            rgb = rgb.asnumpy()
+
+        rgb = rgb.transpose((2, 0, 1)) / 255.  # (3, roi_h, roi_w)
+        alpha = roi[:, :, 3] / 255.  # (roi_h, roi_w), broadcast to rgb
+
+        dst = self.batch[i, :, y0:y1, x0:x1]
+        dst += alpha * (rgb - dst)
+
+    def paste_batch(self, sprites):
+        '''
+        paste of every sprite, a convenience loop, not one batched blend:
+        every sprite has its own ROI shape and its own random draw of
+        the augmenters, so there is nothing to stack.
+
+        sprites: list of (i, sprite, x, y), the arguments of paste
+        '''
+        for i, sprite, x, y in sprites:
+            self.paste(i, sprite, x, y)
+
+    def get(self, ctx=mxnet.cpu()):
+        '''
+        Returns
+        ----------
+        img_batch: mxnet.ndarray
+          (bs, 3, h, w) in 0~1, a copy, the buffer can be reset after
+        '''
+        numpy.clip(self.batch, 0, 1, out=self.batch)
+        return nd.array(self.batch, ctx=ctx)
+
+
+def get_roi_compositor(owner, bs, h, w, augs=None):
+    '''
+    ROICompositor of the calling thread, kept per (owner, bs, h, w),
+    so render threads sharing one renderer never share a buffer.
+    '''
+    if not hasattr(_thread_local, 'compositors'):
+        _thread_local.compositors = {}
+
+    key = (id(owner), bs, h, w)
+    if key not in _thread_local.compositors:
+        _thread_local.compositors[key] = ROICompositor(bs, h, w, augs=augs)
+
+    return _thread_local.compositors[key]
+
+
+def benchmark_compositing(bs=30, h=320, w=512, sprite_hw=(120, 200), cycles=5):
+    '''
+    compare full-frame pasting (RenderCar.render before ROICompositor)
+    with ROICompositor on random RGBA sprites, no augmentation
+    '''
+    sh, sw = sprite_hw
+    sprite = numpy.random.randint(0, 256, (sh, sw, 4)).astype(numpy.uint8)
+    pil_sprite = PIL.Image.fromarray(sprite, 'RGBA')
+    bg = nd.array(numpy.random.randint(0, 256, (bs, 3, h, w)))
+    xy = numpy.random.randint(-sw//2, w - sw//2, (cycles, bs, 2))
+
+    t = time.time()
+    for c in range(cycles):
+        mask = nd.zeros((bs, 3, h, w))
+        img_batch = nd.zeros((bs, 3, h, w))
+        for i in range(bs):
+            tmp = PIL.Image.new('RGBA', (w, h))
+            tmp.paste(pil_sprite, tuple(int(v) for v in xy[c, i]))
+            img_batch[i] = pil_rgb_2_rgb_ndarray(tmp)
+            mask[i] = pil_mask_2_rgb_ndarray(tmp.split()[-1])
+
+        img_batch = nd.clip((bg / 255.) * (1 - mask) + img_batch * mask, 0, 1)
+        img_batch.wait_to_read()
+    full_cost = (time.time() - t) / (cycles * bs)
+
+    compositor = ROICompositor(bs, h, w)
+    t = time.time()
+    for c in range(cycles):
+        compositor.reset(bg)
+        for i in range(bs):
+            compositor.paste(i, sprite, *xy[c, i])
+
+        roi_batch = compositor.get()
+        roi_batch.wait_to_read()
+    roi_cost = (time.time() - t) / (cycles * bs)
+
+    # temporaries per sample, in byte
+    full_bytes = h*w*4 + h*w*3 + 2 * 3*h*w*4 + h*w + 2 * 3*h*w*4
+    roi_bytes = 2 * 3*sh*sw*8 + sh*sw*8
+
+    print(global_variable.yellow)
+    print('full frame: %.2f ms/sample, ~%.1f MB temporaries/sample' % (
+        full_cost * 1000, full_bytes / 1e6))
+    print('ROI: %.2f ms/sample, ~%.1f MB temporaries/sample' % (
+        roi_cost * 1000, roi_bytes / 1e6))
+    print('max abs diff of last batch: %f' % (
+        nd.max(nd.abs(img_batch - roi_batch)).asscalar()))
+    print(global_variable.reset_color)
+
+
 # -------------------- video -------------------- #
 def test_inference_rate(net, shape, cycles=100, ctx=mxnet.gpu(0)):
     # shape =  (1, 3, size[0], size[1])